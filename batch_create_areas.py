@@ -0,0 +1,166 @@
+"""
+Create areas for many municipalities (kommuner) in one run.
+
+The municipalities are solved in a process pool with the largest (most units) first
+to balance the load. Each job writes to its own scratch geodatabase and stage cache, so
+no two processes write to the same file geodatabase, and the parent copies the areas of
+each finished job to its own feature class in the output geodatabase. Each municipality
+is recorded in a checkpoint manifest, so a crashed or stopped run can be resumed and will
+skip the municipalities already done.
+
+Usage:
+  python batch_create_areas.py all D:\\Data\\Roder.gdb --workers 4
+  python batch_create_areas.py Sandnes Stavanger D:\\Data\\Roder.gdb --max-units 70
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import as_completed
+from modules.backend import arcpy
+from create_areas import AreaJob, create_location_allocation_areas, matrikkel_units, open_matrikkel_store, aoi_name_field, unit_type, unit_type_field
+from modules.parallel import create_process_pool
+from modules.log import Log
+
+log = Log(arcgis=True)
+
+def count_units_by_municipality(municipalities: list = None) -> dict:
+  """Counts the units of the analysed unit type in each municipality in one pass"""
+
+  counts = Counter()
+  store = open_matrikkel_store()
+  if store is not None: # Counted from the catalogue of the store
+    name_index = store.partition_fields.index(aoi_name_field)
+    for partition in store.partitions(**{unit_type_field: unit_type}):
+      counts[partition['key'][name_index]] += partition['rows']
+  else:
+    with arcpy.da.SearchCursor(matrikkel_units, [aoi_name_field], f"{unit_type_field} = '{unit_type}'") as cursor:
+      for row in cursor:
+        counts[row[0]] += 1
+
+  if municipalities is not None:
+    missing = [name for name in municipalities if name not in counts]
+    if missing:
+      log.warning(f'Fant ingen bruksenheter i: {", ".join(missing)}')
+    counts = Counter({name: counts[name] for name in municipalities if name in counts})
+  return counts
+
+def output_name(municipality: str) -> str:
+  """Returns a valid feature class name for a municipality"""
+  return 'Roder_' + re.sub(r'\W', '_', municipality)
+
+def create_job_workspaces(jobs: list, scratch_folder: str, cache_folder: str) -> None:
+  """Creates a scratch geodatabase for each job and sets its output and cache workspace
+     to its own, before the workers are started"""
+
+  os.makedirs(scratch_folder, exist_ok=True)
+  for job in jobs:
+    name = output_name(job['municipality'])
+    if not arcpy.Exists(os.path.join(scratch_folder, f'{name}.gdb')):
+      arcpy.management.CreateFileGDB(scratch_folder, f'{name}.gdb')
+    job['result_polys'] = os.path.join(scratch_folder, f'{name}.gdb', name)
+    job['cache_workspace'] = os.path.join(cache_folder, name)
+
+def copy_result(job: dict, output: str) -> None:
+  """Copies the areas (and the units with their area, if written) of a job from its scratch
+     geodatabase to the output"""
+
+  arcpy.management.CopyFeatures(job['result_polys'], output)
+  if arcpy.Exists(f"{job['result_polys']}_punkter"):
+    arcpy.management.CopyFeatures(f"{job['result_polys']}_punkter", f'{output}_punkter')
+
+def read_manifest(path: str) -> dict:
+  if not os.path.exists(path):
+    return {}
+  with open(path, encoding='utf-8') as f:
+    return json.load(f)
+
+def write_manifest(path: str, manifest: dict) -> None:
+  """Writes the manifest to a temporary file first so a crash never leaves it half written"""
+
+  with open(path + '.tmp', 'w', encoding='utf-8') as f:
+    json.dump(manifest, f, ensure_ascii=False, indent=2)
+  os.replace(path + '.tmp', path)
+
+def run_job(settings: dict) -> tuple:
+  """Creates the areas of one municipality. Runs in a worker process.
+
+  Returns:
+    tuple: Municipality, status (done or failed), elapsed seconds and an error message
+  """
+  start = time.perf_counter()
+  try:
+    succeeded = create_location_allocation_areas(AreaJob(**settings))
+    return settings['municipality'], 'done' if succeeded else 'failed', time.perf_counter() - start, None
+  except Exception as e:
+    return settings['municipality'], 'failed', time.perf_counter() - start, str(e)
+
+def create_areas_batch(municipalities, output_gdb: str, workers: int = None, manifest_path: str = None, **job_settings) -> dict:
+  """Creates the areas of each municipality
+
+  Args:
+    municipalities (list|str): Names of the municipalities (kommunenavn), or 'all'
+    output_gdb (str): Geodatabase for the resulting areas, one feature class pr municipality
+    workers (int): Optional; Number of worker processes, default is the number of cpus - 1
+    manifest_path (str): Optional; Checkpoint manifest, default is batch_manifest.json next to the output
+    job_settings: Optional; Settings passed on to each AreaJob, e.g. max_units. A cache_workspace
+      is used as the folder of one stage cache pr municipality
+
+  Returns:
+    dict: The manifest with the status, output and elapsed time of each municipality
+  """
+  manifest_path = manifest_path if manifest_path is not None else os.path.join(os.path.dirname(output_gdb), 'batch_manifest.json')
+  manifest = read_manifest(manifest_path)
+
+  counts = count_units_by_municipality(None if municipalities == 'all' else list(municipalities))
+  done = [name for name in counts if manifest.get(name, {}).get('status') == 'done']
+  if done:
+    log.info(f'Hopper over {len(done)} kommuner som er ferdige i {manifest_path}')
+
+  folder = os.path.dirname(output_gdb)
+  cache_folder = job_settings.pop('cache_workspace', None) or os.path.join(folder, 'stage_cache')
+  jobs = [{**job_settings, 'municipality': name} for name, _ in counts.most_common() if name not in done]
+  create_job_workspaces(jobs, os.path.join(folder, 'batch_scratch'), cache_folder)
+  log.info(f'Lager roder for {len(jobs)} kommuner, største først...')
+
+  with create_process_pool(workers) as pool:
+    futures = {pool.submit(run_job, job): job for job in jobs}
+    for future in as_completed(futures):
+      job = futures[future]
+      output = os.path.join(output_gdb, output_name(job['municipality']))
+      try:
+        name, status, elapsed, error = future.result()
+        if status == 'done':
+          copy_result(job, output)
+      except Exception as e: # The worker process died or the result could not be copied
+        name, status, elapsed, error = job['municipality'], 'failed', None, str(e)
+
+      manifest[name] = {'status': status, 'output': output, 'units': counts[name], 'elapsed': elapsed, 'error': error}
+      write_manifest(manifest_path, manifest)
+      if status == 'done':
+        log.info(f'{name} ferdig på {round(elapsed)} s')
+      else:
+        log.error(f'{name} feilet: {error}')
+
+  return manifest
+
+###############################################################################
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Create areas for many municipalities')
+  parser.add_argument('municipalities', nargs='+', help='Names of the municipalities (kommunenavn) or all')
+  parser.add_argument('output_gdb', help='Geodatabase for the resulting areas')
+  parser.add_argument('--workers', type=int, default=None)
+  parser.add_argument('--manifest', default=None, help='Checkpoint manifest (json)')
+  parser.add_argument('--areas', type=int, default=0, help='Number of areas pr municipality, 0 calculates it')
+  parser.add_argument('--max-units', type=int, default=0, help='Max units pr area, 0 for no limit')
+  parser.add_argument('--native', action='store_true', help='Solve location-allocation in-process')
+  args = parser.parse_args()
+
+  create_areas_batch(
+    'all' if args.municipalities == ['all'] else args.municipalities,
+    args.output_gdb, args.workers, args.manifest,
+    areas_to_create=args.areas, max_units=args.max_units, use_native_solver=args.native
+  )
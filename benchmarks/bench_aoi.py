@@ -0,0 +1,58 @@
+"""
+Benchmark of the AOI stage: the grid closing (modules.local.aoi) against the double
+buffer of features_to_aoi, done here with shapely buffers as a stand-in for
+arcpy.analysis.Buffer. Reports runtime, traced peak memory and how far the grid
+outline is from the buffer outline. tracemalloc only sees NumPy and Python allocations,
+not the memory GEOS uses for the buffers.
+
+Usage:
+  python -m benchmarks.bench_aoi 10000 50000
+"""
+
+import sys
+import time
+import tracemalloc
+import numpy as np
+import shapely
+from modules.local.aoi import points_to_aoi
+
+BUFFER_DISTANCE = 1000
+
+def synthetic_units(n: int, seed: int = 0) -> np.ndarray:
+  """Points clustered around a number of settlements"""
+
+  rng = np.random.default_rng(seed)
+  side = np.sqrt(n) * 150
+  centers = rng.random((max(n // 700, 1), 2)) * side
+  return centers[rng.integers(0, len(centers), n)] + rng.normal(0, side / 40, (n, 2))
+
+def buffer_aoi(xy: np.ndarray, buffer_distance: float):
+  merged = shapely.union_all(shapely.buffer(shapely.points(xy), buffer_distance))
+  return shapely.buffer(merged, -abs(buffer_distance * 0.9))
+
+def measure(function, *args) -> tuple:
+  """Returns the result, the elapsed time and the peak memory (in a second, traced run)"""
+
+  start = time.perf_counter()
+  result = function(*args)
+  elapsed = time.perf_counter() - start
+  tracemalloc.start()
+  function(*args)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return result, elapsed, peak
+
+if __name__ == '__main__':
+  sizes = [int(n) for n in sys.argv[1:]] or [10000, 50000]
+  for n in sizes:
+    xy = synthetic_units(n)
+    grid, grid_time, grid_peak = measure(points_to_aoi, xy, BUFFER_DISTANCE)
+    vector, vector_time, vector_peak = measure(buffer_aoi, xy, BUFFER_DISTANCE)
+
+    outline = grid.boundary
+    samples = shapely.line_interpolate_point(outline, np.linspace(0, outline.length, 5000))
+    deviation = np.percentile(shapely.distance(samples, vector.boundary), [50, 95, 100])
+    print(f'{n:>8} punkter: rutenett {grid_time:6.2f} s ({grid_peak / 2**20:5.0f} MB), '
+          f'buffer {vector_time:6.2f} s ({vector_peak / 2**20:5.0f} MB), '
+          f'avvik median/95%/maks {deviation[0]:.0f}/{deviation[1]:.0f}/{deviation[2]:.0f} m, '
+          f'arealavvik {shapely.symmetric_difference(grid, vector).area / vector.area:.1%}')
@@ -0,0 +1,75 @@
+"""
+Benchmark of the area polygon stage: local Voronoi, dissolve and clip (modules.local.voronoi)
+against CreateThiessenPolygons, Dissolve (SINGLE_PART) and Clip. The tool chain is only
+timed when arcpy is available.
+
+Usage:
+  python -m benchmarks.bench_area_polygons 10000 100000
+"""
+
+import sys
+import time
+import tracemalloc
+import numpy as np
+import shapely
+from modules.local.voronoi import area_polygons
+
+def synthetic_areas(n: int, seed: int = 0) -> tuple:
+  """Clustered points with about 50 points pr area and a circular AOI around them"""
+
+  rng = np.random.default_rng(seed)
+  side = np.sqrt(n) * 40
+  centers = rng.random((max(n // 500, 1), 2)) * side
+  xy = centers[rng.integers(0, len(centers), n)] + rng.normal(0, side / 20, (n, 2))
+  cell = side / np.sqrt(n / 50)
+  ids = (np.floor(xy[:, 0] / cell) * 100000 + np.floor(xy[:, 1] / cell)).astype(np.int64)
+  aoi = np.array([shapely.Point(side / 2, side / 2).buffer(side * 0.6)])
+  return xy, ids, aoi
+
+def time_local(xy, ids, aoi) -> tuple:
+  """Returns the elapsed time, the peak memory (in a second, traced run) and the number of polygons"""
+
+  start = time.perf_counter()
+  result_ids, _ = area_polygons(xy, ids, aoi)
+  elapsed = time.perf_counter() - start
+
+  tracemalloc.start()
+  area_polygons(xy, ids, aoi)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return elapsed, peak, len(result_ids)
+
+def time_tools(xy, ids, aoi) -> float:
+  import arcpy
+  arcpy.env.overwriteOutput = True
+  sr = arcpy.SpatialReference(25833)
+  arcpy.management.CreateFeatureclass('memory', 'BenchPoints', 'POINT', spatial_reference=sr)
+  arcpy.management.AddField(r'memory\BenchPoints', 'AreaID', 'TEXT')
+  with arcpy.da.InsertCursor(r'memory\BenchPoints', ['AreaID', 'SHAPE@XY']) as cursor:
+    for area_id, point in zip(ids.tolist(), xy.tolist()):
+      cursor.insertRow([str(area_id), tuple(point)])
+  arcpy.management.CreateFeatureclass('memory', 'BenchAOI', 'POLYGON', spatial_reference=sr)
+  with arcpy.da.InsertCursor(r'memory\BenchAOI', ['SHAPE@']) as cursor:
+    cursor.insertRow([arcpy.FromWKB(bytearray(shapely.to_wkb(aoi[0])), sr)])
+
+  start = time.perf_counter()
+  arcpy.analysis.CreateThiessenPolygons(r'memory\BenchPoints', r'memory\BenchThiessen', 'ALL')
+  arcpy.management.Dissolve(r'memory\BenchThiessen', r'memory\BenchDissolved', 'AreaID', None, 'SINGLE_PART', 'DISSOLVE_LINES')
+  arcpy.analysis.Clip(r'memory\BenchDissolved', r'memory\BenchAOI', r'memory\BenchAreas')
+  return time.perf_counter() - start
+
+if __name__ == '__main__':
+  sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000]
+  try:
+    import arcpy # noqa: F401
+    has_arcpy = True
+  except ImportError:
+    has_arcpy = False
+
+  for n in sizes:
+    xy, ids, aoi = synthetic_areas(n)
+    elapsed, peak, count = time_local(xy, ids, aoi)
+    line = f'{n:>8} punkter: lokal {elapsed:7.2f} s ({peak / 2**20:6.0f} MB, {count} polygoner)'
+    if has_arcpy:
+      line += f', verktøy {time_tools(xy, ids, aoi):7.2f} s'
+    print(line)
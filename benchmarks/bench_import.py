@@ -0,0 +1,55 @@
+"""
+Benchmark of the import time of the scripts and modules. Each module is imported in a
+fresh interpreter, so nothing is cached from an earlier import, and the best of a few runs
+is reported with whether the import pulled in arcpy. The run fails (exit code 1) if a
+module loads arcpy or takes longer than the limit.
+
+Usage:
+  python -m benchmarks.bench_import
+  python -m benchmarks.bench_import create_areas split_areas --limit 0.5
+"""
+
+import argparse
+import subprocess
+import sys
+
+MODULES = [
+  'modules', 'modules.log', 'modules.arcgis.dataset', 'modules.arcgis.na.location_allocation',
+  'modules.local.spatial', 'modules.local.na',
+  'create_areas', 'batch_create_areas', 'split_areas', 'merge_areas',
+  'create_areas_statistics', 'traveltime_weight', 'traveltime_pr_area', 'update_areas', 'rebalance_areas'
+]
+
+MEASURE = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, 'arcpy' in sys.modules)
+'''
+
+def import_time(module: str, repeat: int = 3) -> tuple:
+  """Returns the best import time in seconds of the module and whether it loaded arcpy"""
+
+  best, arcpy_loaded = None, False
+  for _ in range(repeat):
+    result = subprocess.run([sys.executable, '-c', MEASURE.format(module=module)], capture_output=True, text=True, check=True)
+    seconds, loaded = result.stdout.split()
+    best = float(seconds) if best is None else min(best, float(seconds))
+    arcpy_loaded = arcpy_loaded or loaded == 'True'
+  return best, arcpy_loaded
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('modules', nargs='*', default=MODULES)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--limit', type=float, default=1.0, help='Max seconds to import a module')
+  args = parser.parse_args()
+
+  failed = []
+  for module in args.modules:
+    seconds, arcpy_loaded = import_time(module, args.repeat)
+    slow = seconds > args.limit
+    if slow or arcpy_loaded:
+      failed.append(module)
+    print(f'{module:<45} {seconds:6.3f} s{"  laster arcpy" if arcpy_loaded else ""}{"  for treg" if slow else ""}')
+  sys.exit(1 if failed else 0)
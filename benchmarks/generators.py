@@ -0,0 +1,111 @@
+"""
+Synthetic matrikkel-like point sets and walking networks for the benchmarks. Everything is
+generated from a seed, so a size, layout and seed always give the same data.
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial import Delaunay, cKDTree
+from modules.local.na.network_dataset import NetworkDataset
+
+WALK_SPEED = 5000 / 60 # Meters pr minute
+UNIT_SPACING = 40 # Mean distance in meters between units, sets the extent of a point set
+STACKED_SHARE = 0.2 # Share of the units in clustered layouts that share a building (same coordinate)
+
+def point_extent(n: int) -> float:
+  return np.sqrt(n) * UNIT_SPACING
+
+def matrikkel_points(n: int, layout: str = 'clustered', seed: int = 0) -> np.ndarray:
+  """Returns n units (bruksenheter) as a structured array with OID@, SHAPE@X and SHAPE@Y
+     like arcpy.da.FeatureClassToNumPyArray.
+
+  Args:
+    n (int): Number of units
+    layout (str): Optional; 'clustered' (villages and towns with apartment buildings) or 'dispersed' (scattered farms)
+    seed (int): Optional; Random seed
+
+  Returns:
+    np.ndarray: Structured array with one record pr unit
+  """
+  rng = np.random.default_rng(seed)
+  side = point_extent(n)
+  if layout == 'clustered':
+    centers = rng.random((max(n // 700, 1), 2)) * side
+    sizes = rng.pareto(1.5, len(centers)) + 1 # A few towns and many small villages
+    center = rng.choice(len(centers), n, p=sizes / sizes.sum())
+    xy = centers[center] + rng.normal(0, side / 40, (n, 2)) * np.sqrt(sizes[center] / sizes.mean())[:, None]
+
+    stacked = rng.random(n) < STACKED_SHARE
+    buildings = np.flatnonzero(~stacked)
+    xy[stacked] = xy[rng.choice(buildings, stacked.sum())] # Apartments share the coordinate of a building
+  elif layout == 'dispersed':
+    xy = rng.random((n, 2)) * side
+  else:
+    raise ValueError(f'Unknown layout: {layout}')
+
+  points = np.empty(n, dtype=[('OID@', np.int64), ('SHAPE@X', np.float64), ('SHAPE@Y', np.float64)])
+  points['OID@'] = np.arange(1, n + 1)
+  points['SHAPE@X'], points['SHAPE@Y'] = np.clip(xy, 0, side).T
+  return points
+
+def network_edges(from_node: np.ndarray, to_node: np.ndarray, node_xy: np.ndarray, detour: np.ndarray = None) -> dict:
+  """Returns an ELVEG-style edge list (see modules.local.na.network_dataset.EDGE_COLUMNS)"""
+
+  length = np.hypot(*(node_xy[to_node] - node_xy[from_node]).T)
+  length = length * detour if detour is not None else length
+  return {
+    'from_node': from_node, 'to_node': to_node, 'length': length, 'minutes': length / WALK_SPEED,
+    'from_x': node_xy[from_node, 0], 'from_y': node_xy[from_node, 1],
+    'to_x': node_xy[to_node, 0], 'to_y': node_xy[to_node, 1]
+  }
+
+def grid_network(side: float, spacing: float = 100) -> NetworkDataset:
+  """A regular street grid covering a square with the given side"""
+
+  count = int(np.ceil(side / spacing)) + 1
+  ids = np.arange(count * count).reshape(count, count)
+  node_xy = np.column_stack([(ids % count).ravel(), (ids // count).ravel()]) * spacing
+  from_node = np.concatenate([ids[:, :-1].ravel(), ids[:-1, :].ravel()])
+  to_node = np.concatenate([ids[:, 1:].ravel(), ids[1:, :].ravel()])
+  return NetworkDataset(network_edges(from_node, to_node, node_xy.astype(np.float64)), 'Rutenett')
+
+def organic_network(side: float, spacing: float = 100, seed: int = 0, extra_edges: float = 0.4) -> NetworkDataset:
+  """An irregular network of paths and roads: a minimum spanning tree of a Delaunay
+     triangulation of random nodes (so all nodes are connected) with a share of the other
+     triangulation edges added back, and curved edges longer than the straight line"""
+
+  rng = np.random.default_rng(seed)
+  node_xy = rng.random((max(int((side / spacing) ** 2), 4), 2)) * side
+  triangles = Delaunay(node_xy).simplices
+  edges = np.unique(np.sort(np.vstack([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [0, 2]]]), axis=1), axis=0)
+  length = np.hypot(*(node_xy[edges[:, 1]] - node_xy[edges[:, 0]]).T)
+
+  tree = minimum_spanning_tree(coo_matrix((length, (edges[:, 0], edges[:, 1])), shape=(len(node_xy), len(node_xy)))).tocoo()
+  in_tree = np.zeros(len(edges), dtype=bool)
+  tree_edges = np.sort(np.column_stack([tree.row, tree.col]), axis=1)
+  in_tree[np.searchsorted(edges[:, 0] * len(node_xy) + edges[:, 1], tree_edges[:, 0] * len(node_xy) + tree_edges[:, 1])] = True
+  keep = in_tree | (rng.random(len(edges)) < extra_edges)
+
+  detour = rng.uniform(1.05, 1.4, keep.sum())
+  return NetworkDataset(network_edges(edges[keep, 0], edges[keep, 1], node_xy, detour), 'Organisk')
+
+def walking_network(n: int, kind: str = 'grid', seed: int = 0) -> NetworkDataset:
+  """Returns a walking network covering the extent of matrikkel_points(n)"""
+
+  side = point_extent(n)
+  if kind == 'grid':
+    return grid_network(side)
+  if kind == 'organic':
+    return organic_network(side, seed=seed)
+  raise ValueError(f'Unknown network: {kind}')
+
+def area_ids(xy: np.ndarray, units_pr_area: int = 40, seed: int = 0) -> np.ndarray:
+  """Assigns each point to the nearest of n / units_pr_area randomly chosen unit locations,
+     a stand-in for the areas from the location-allocation. The point counts of the areas
+     vary like unbalanced areas do, with areas both to split and to merge."""
+
+  rng = np.random.default_rng(seed)
+  locations = np.unique(xy, axis=0)
+  centers = locations[rng.choice(len(locations), max(min(len(xy) // units_pr_area, len(locations)), 1), replace=False)]
+  return cKDTree(centers).query(xy)[1].astype(np.int64)
@@ -0,0 +1,366 @@
+"""
+Benchmark suite timing each pipeline stage on synthetic data, without ArcGIS. The stages
+run the same local code as the pipeline, with the network analyses solved in-process by
+modules.local.na (the local stand-in for arcpy.nax) on a generated walking network.
+
+Each stage is timed in a span (see modules.log), once pr size or the best of --repeat runs.
+The results are written as json, and compared to a baseline file when one is given: the
+run fails (exit code 1) if a stage is slower than the baseline by more than the threshold.
+
+Usage:
+  python -m benchmarks.suite --sizes 1000 10000 --output results.json
+  python -m benchmarks.suite --baseline baseline.json --threshold 1.25
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime
+import numpy as np
+import numpy.lib.recfunctions as rfn
+import scipy
+from scipy.spatial import cKDTree
+import shapely
+from benchmarks.generators import matrikkel_points, walking_network, area_ids
+from modules.local.aoi import points_to_aoi
+from modules.local.areas import polygon_adjacency, AreaGroups, plan_merges
+from modules.local.partition import Partition, share_facilities
+from modules.local.rebalance import rebalance_areas
+from modules.local.solvers.tour import DETOUR_FACTOR, WALK_SPEED
+from modules.local.store import PointStore
+from modules.local.na.network_dataset import calculate_locations
+from modules.local.spatial import cluster_points, average_nearest_neighbor, assign_points_to_polygons, unique_points
+from modules.local.traveltime import get_travel_lengths, group_mean_by_origin
+from modules.local.voronoi import area_polygons
+from modules.local.na.odmatrix import create_origin_destination_analysis, load_and_solve_od_matrix, OriginDestinationCostMatrixOutputDataType
+from modules.local.na.location_allocation import create_location_allocation_analysis, load_and_solve_location_allocation, LocationAllocationOutputDataType
+from modules.local.na.routing import create_route_analysis, load_and_solve_route, get_routes_cursor
+from modules.log import Log, tracer
+
+log = Log()
+
+SIZES = [1000, 10000, 100000, 500000]
+THRESHOLD = 1.25 # Max ratio between the time of a stage and its baseline
+MIN_SECONDS = 0.05 # Stages faster than this in the baseline are not compared, the timing noise is too large
+
+# Settings of the pipeline stages (see create_areas, split_areas, merge_areas and traveltime_weight)
+BUFFER_DISTANCE = 1000
+DEMAND_TOLERANCE = 10
+NEIGHBORS = 10
+UNITS_PR_AREA = 40
+STORE_MUNICIPALITIES = 10
+LA_TILE_POINTS = 1000
+SPLIT_MAX_COUNT = 70
+SPLIT_TARGET_COUNT = 40
+MERGE_ABS_MIN_COUNT = 5
+MERGE_MIN_COUNT = 20
+MERGE_MAX_COUNT = 50
+MERGE_MAX_TIME = 60
+REBALANCE_TIME_LIMIT = 10 # Seconds
+WALK_OPTIONS = {
+  'travelMode': 'Gange',
+  'defaultImpedanceCutoff': 15
+}
+
+class Case:
+  """Synthetic input of one size. Inputs of later stages (AOI, areas, area polygons) are
+     made once, outside the timed stages.
+
+  Attributes:
+    points (np.ndarray): Units as a structured array with OID@, SHAPE@X and SHAPE@Y
+    xy (np.ndarray): Unit coordinates as a (n, 2) array
+    network (NetworkDataset): Walking network covering the units
+    ids (np.ndarray): Area index of each unit
+  """
+  def __init__(self, n: int, layout: str, network: str, seed: int) -> None:
+    self.n = n
+    self.points = matrikkel_points(n, layout, seed)
+    self.xy = np.column_stack([self.points['SHAPE@X'], self.points['SHAPE@Y']])
+    self.network = walking_network(n, network, seed)
+    self.ids = area_ids(self.xy, UNITS_PR_AREA, seed)
+    self._aoi = None
+    self._polygons = None
+    self._store = None
+    self._stops = None
+
+  def aoi(self):
+    if self._aoi is None:
+      self._aoi = points_to_aoi(self.xy, BUFFER_DISTANCE)
+    return self._aoi
+
+  def polygons(self) -> tuple:
+    """Returns the single part area polygons with the area index of each polygon"""
+    if self._polygons is None:
+      self._polygons = area_polygons(self.xy, self.ids, np.array([self.aoi()]))
+    return self._polygons
+
+  def store(self) -> PointStore:
+    """Returns a store of the units partitioned by STORE_MUNICIPALITIES municipalities
+       (vertical bands) and two unit types, in a temporary folder"""
+    if self._store is None:
+      self._store_folder = tempfile.TemporaryDirectory()
+      x = self.xy[:, 0]
+      width = max(float(x.max() - x.min()), 1.0) # UTM eastings start far from 0, the bands span the extent of the points
+      band = np.minimum(((x - x.min()) / width * STORE_MUNICIPALITIES).astype(int), STORE_MUNICIPALITIES - 1)
+      unit_type = np.where(self.points['OID@'] % 5 == 0, 'Fritidsbolig', 'Bolig')
+      data = rfn.append_fields(self.points, ['kommunenavn', 'bruksenhetstype'], [np.char.add('Kommune ', band.astype(str)), unit_type], usemask=False)
+      self._store = PointStore.create(os.path.join(self._store_folder.name, 'store'), data, ['kommunenavn', 'bruksenhetstype'])
+    return self._store
+
+  def stops(self) -> tuple:
+    """Returns the unique stops of the areas with their coordinates, area index, unit count
+       and a walk minutes matrix from the straight line distance within the cutoff (in place
+       of an OD matrix on the network)"""
+
+    if self._stops is None:
+      keys = np.column_stack([np.round(self.xy, 3), self.ids])
+      unique, weights = np.unique(keys, axis=0, return_counts=True)
+      xy = unique[:, :2]
+      tree = cKDTree(xy)
+      matrix = tree.sparse_distance_matrix(tree, WALK_OPTIONS['defaultImpedanceCutoff'] * WALK_SPEED, output_type='coo_matrix').tocsr()
+      matrix.data = matrix.data * DETOUR_FACTOR / WALK_SPEED
+      self._stops = xy, unique[:, 2].astype(np.int64), weights, matrix
+    return self._stops
+
+def stage_deduplicate(case: Case) -> int:
+  return len(cluster_points(case.xy, DEMAND_TOLERANCE).representatives)
+
+def stage_spread(case: Case) -> int:
+  average_nearest_neighbor(case.xy, 'convex_hull')
+  return case.n
+
+def stage_aoi(case: Case) -> int:
+  points_to_aoi(case.xy, BUFFER_DISTANCE)
+  return case.n
+
+def stage_network_locations(case: Case) -> int:
+  """Locates the units on the network once, as create_areas does before the network stages"""
+  return len(calculate_locations(case.points, case.network))
+
+def stage_traveltime_weight(case: Case) -> int:
+  """The mean walk length to the nearest neighbours of each unit, as traveltime_weight"""
+
+  od_matrix = create_origin_destination_analysis({**WALK_OPTIONS, 'defaultDestinationCount': NEIGHBORS}, case.network)
+  lines = load_and_solve_od_matrix(od_matrix, case.points, case.points).table(OriginDestinationCostMatrixOutputDataType.Lines)
+  travel_lengths = get_travel_lengths(lines['Total_Distance'], lines['SHAPE@LENGTH'])
+  return len(group_mean_by_origin(lines['OriginOID'], travel_lengths)[0])
+
+def stage_location_allocation(case: Case) -> int:
+  """Location-allocation with the units as facilities, solved in tiles of at most
+     LA_TILE_POINTS units as the partitioned mode of create_areas"""
+
+  partition = Partition(case.xy, LA_TILE_POINTS)
+  groups = partition.groups()
+  shares = share_facilities([len(rows) for rows in groups], max(case.n // UNITS_PR_AREA, 1))
+  la = create_location_allocation_analysis(WALK_OPTIONS, case.network)
+  allocated = 0
+  for rows, share in zip(groups, shares.tolist()):
+    if share == 0 or len(rows) == 0:
+      continue
+    la.facilityCount = share
+    result = load_and_solve_location_allocation(la, case.points[unique_points(case.xy, rows)], case.points[rows])
+    if result.solveSucceeded:
+      allocated += int((result.table(LocationAllocationOutputDataType.DemandPoints)['FacilityOID'] >= 0).sum())
+  return allocated
+
+def stage_store_extract(case: Case) -> int:
+  """Reads the homes of one municipality from the partitioned store, as create_areas
+     does before writing them to the units feature class"""
+
+  store = case.store()
+  return len(store.read(['OID@', 'SHAPE@X', 'SHAPE@Y'], kommunenavn='Kommune 0', bruksenhetstype='Bolig'))
+
+def stage_area_polygons(case: Case) -> int:
+  return len(area_polygons(case.xy, case.ids, np.array([case.aoi()]))[0])
+
+def stage_split_areas(case: Case) -> int:
+  """Splits the areas with more than SPLIT_MAX_COUNT units with a location-allocation pr
+     area, as split_areas_batch"""
+
+  order = np.argsort(case.ids, kind='stable')
+  _, starts, counts = np.unique(case.ids[order], return_index=True, return_counts=True)
+  la = create_location_allocation_analysis(WALK_OPTIONS, case.network)
+  split = 0
+  for start, count in zip(starts.tolist(), counts.tolist()):
+    if count <= SPLIT_MAX_COUNT:
+      continue
+    rows = order[start:start + count]
+    la.facilityCount = round(count / SPLIT_TARGET_COUNT)
+    result = load_and_solve_location_allocation(la, case.points[unique_points(case.xy, rows)], case.points[rows])
+    split += result.solveSucceeded
+  return split
+
+def stage_merge_areas(case: Case) -> int:
+  """Merges areas with fewer than MERGE_MIN_COUNT units into a neighbour, as merge_areas"""
+
+  ids, polygons = case.polygons()
+  counts = np.bincount(case.ids, minlength=ids.max() + 1)[ids].astype(np.float64)
+  groups = AreaGroups(counts, counts * 1.5, counts * 0.1, polygon_adjacency(polygons))
+  return len(plan_merges(groups, MERGE_MIN_COUNT, MERGE_MAX_COUNT, MERGE_MAX_TIME, MERGE_ABS_MIN_COUNT))
+
+def stage_statistics(case: Case) -> int:
+  """Counts the units in each area and solves a route through the unique locations of
+     each area, as create_areas_statistics"""
+
+  _, polygons = case.polygons()
+  assignment = assign_points_to_polygons(case.xy, polygons)
+  routing = create_route_analysis({'travelMode': 'Gange', 'findBestSequence': True}, case.network)
+  solved = 0
+  for _, rows in assignment.groups():
+    stops = unique_points(case.xy, rows)
+    if len(stops) >= 2:
+      solved += get_routes_cursor(load_and_solve_route(routing, case.points[stops])) is not None
+  return solved
+
+def stage_rebalance(case: Case) -> int:
+  """Moves boundary stops between areas to balance the walk time, as rebalance_areas"""
+
+  xy, area, weights, matrix = case.stops()
+  _, area = np.unique(area, return_inverse=True)
+  return rebalance_areas(matrix, xy, area, weights, MERGE_MIN_COUNT, SPLIT_MAX_COUNT, time_limit=REBALANCE_TIME_LIMIT).moves
+
+# Stage name, function and the largest size it is run for by default (None for all sizes).
+# The network stages run the Python Dijkstra of modules.local.na and take minutes at 100k
+# units, the location-allocation solves every unit pair within the cutoff in each tile.
+STAGES = [
+  ('store_extract', stage_store_extract, None),
+  ('deduplicate', stage_deduplicate, None),
+  ('spread', stage_spread, None),
+  ('aoi', stage_aoi, None),
+  ('network_locations', stage_network_locations, None),
+  ('traveltime_weight', stage_traveltime_weight, 100000),
+  ('location_allocation', stage_location_allocation, 10000),
+  ('area_polygons', stage_area_polygons, None),
+  ('split_areas', stage_split_areas, 100000),
+  ('merge_areas', stage_merge_areas, None),
+  ('statistics', stage_statistics, 100000),
+  ('rebalance', stage_rebalance, 100000)
+]
+
+# Inputs made before a stage is timed
+PREPARE = {
+  'store_extract': Case.store,
+  'merge_areas': Case.polygons,
+  'statistics': Case.polygons,
+  'rebalance': Case.stops
+}
+
+def run_stage(name: str, function, case: Case, repeat: int, verbose: bool) -> dict:
+  """Runs a stage repeat times and returns the span of the fastest run as a dict"""
+
+  if name in PREPARE:
+    PREPARE[name](case)
+  best = None
+  for _ in range(repeat):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+      with log.span(name) as span:
+        span.rows = function(case)
+    if best is None or span.wall < best.wall:
+      best = span
+  tracer.spans.clear()
+  return {
+    'seconds': best.wall, 'cpu': best.cpu, 'rows': best.rows,
+    'peak_mb': best.traced_peak / 2**20 if best.traced_peak is not None else None
+  }
+
+def run_suite(sizes: list, stages: list, layout: str = 'clustered', network: str = 'grid', seed: int = 0,
+              repeat: int = 1, memory: bool = False, limits: bool = True, verbose: bool = False) -> dict:
+  """Runs the stages for each size
+
+  Args:
+    sizes (list): Numbers of units
+    stages (list): Names of the stages to run
+    layout (str): Optional; Point layout, 'clustered' or 'dispersed'
+    network (str): Optional; Network, 'grid' or 'organic'
+    seed (int): Optional; Random seed of the generators
+    repeat (int): Optional; Runs pr stage, the fastest run is kept
+    memory (bool): Optional; Trace the peak memory of each stage with tracemalloc (slower)
+    limits (bool): Optional; Skip stages for sizes above their limit in STAGES
+    verbose (bool): Optional; Show the log messages of the stages
+
+  Returns:
+    dict: Run settings and environment in 'meta', and 'results' by stage and size
+  """
+  results = {}
+  log.start_trace(memory=memory)
+  try:
+    for n in sizes:
+      log.info(f'Lager {n} {layout} bruksenheter og {network} nettverk...')
+      case = Case(n, layout, network, seed)
+      for name, function, max_units in STAGES:
+        if name not in stages:
+          continue
+        if limits and max_units is not None and n > max_units:
+          log.info(f'{name:<20} {n:>8}: hoppet over (over {max_units} bruksenheter)')
+          continue
+        result = run_stage(name, function, case, repeat, verbose)
+        results.setdefault(name, {})[str(n)] = result
+        log.info(f'{name:<20} {n:>8}: {result["seconds"]:8.2f} s ({result["rows"]} rader)')
+  finally:
+    log.stop_trace()
+
+  return {
+    'meta': {
+      'created': datetime.now().isoformat(timespec='seconds'), 'layout': layout, 'network': network,
+      'seed': seed, 'repeat': repeat, 'sizes': sizes, 'python': platform.python_version(),
+      'numpy': np.__version__, 'scipy': scipy.__version__, 'shapely': shapely.__version__,
+      'platform': platform.platform(), 'cpus': os.cpu_count()
+    },
+    'results': results
+  }
+
+def compare(results: dict, baseline: dict, threshold: float = THRESHOLD, min_seconds: float = MIN_SECONDS) -> list:
+  """Compares the stage times to a baseline run
+
+  Returns:
+    list: (stage, size, baseline seconds, seconds, ratio) for each stage and size in both runs, slowest ratio first
+  """
+  rows = []
+  for stage, sizes in results['results'].items():
+    for size, result in sizes.items():
+      base = baseline['results'].get(stage, {}).get(size)
+      if base is None or base['seconds'] < min_seconds:
+        continue
+      rows.append((stage, size, base['seconds'], result['seconds'], result['seconds'] / base['seconds']))
+  return sorted(rows, key=lambda row: -row[4])
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark of the pipeline stages on synthetic data')
+  parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Numbers of units')
+  parser.add_argument('--stages', nargs='+', default=[name for name, _, _ in STAGES], choices=[name for name, _, _ in STAGES])
+  parser.add_argument('--layout', default='clustered', choices=['clustered', 'dispersed'])
+  parser.add_argument('--network', default='grid', choices=['grid', 'organic'])
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=1, help='Runs pr stage, the fastest is kept')
+  parser.add_argument('--memory', action='store_true', help='Trace the peak memory of each stage (slower)')
+  parser.add_argument('--no-limits', action='store_true', help='Run every stage for every size')
+  parser.add_argument('--output', help='Json file for the results')
+  parser.add_argument('--baseline', help='Json results of an earlier run to compare to')
+  parser.add_argument('--threshold', type=float, default=THRESHOLD, help='Max slowdown as a ratio to the baseline')
+  parser.add_argument('--min-seconds', type=float, default=MIN_SECONDS, help='Skip stages faster than this in the baseline')
+  parser.add_argument('--verbose', action='store_true', help='Show the log messages of the stages')
+  args = parser.parse_args()
+
+  results = run_suite(args.sizes, args.stages, args.layout, args.network, args.seed,
+                      args.repeat, args.memory, not args.no_limits, args.verbose)
+  if args.output:
+    with open(args.output, 'w', encoding='utf-8') as f:
+      json.dump(results, f, indent=2)
+    log.info(f'Lagret resultatene i {args.output}')
+
+  if args.baseline:
+    with open(args.baseline, encoding='utf-8') as f:
+      baseline = json.load(f)
+    slower = []
+    for stage, size, base, seconds, ratio in compare(results, baseline, args.threshold, args.min_seconds):
+      log.info(f'{stage:<20} {size:>8}: {base:8.2f} s -> {seconds:8.2f} s ({ratio:.2f}x)')
+      if ratio > args.threshold:
+        slower.append(f'{stage} ({size})')
+    if slower:
+      log.error(f'Tregere enn {args.threshold}x grunnlinjen: {", ".join(slower)}')
+      sys.exit(1)
+    log.info(f'Ingen steg er tregere enn {args.threshold}x grunnlinjen')
@@ -1,69 +1,170 @@
 import os
-import arcpy
+import numpy as np
+from modules.backend import arcpy
 from modules.filepaths import Path
-from modules.arcgis.dataset import export_dataset, count_rows, get_path
-from modules.arcgis.conversion import features_to_aoi
-from modules.arcgis.na.location_allocation import create_location_allocation_analysis, load_and_solve_location_allocation, get_la_demand_points
+from modules.arcgis.dataset import export_dataset, export_from_store, count_rows, get_path, deduplicate_points
+from modules.arcgis.conversion import features_to_aoi, features_to_aoi_grid
+from modules.arcgis.na.location_allocation import create_location_allocation_analysis, create_native_location_allocation_analysis, load_and_solve_location_allocation, get_la_demand_points, expand_demand_allocation
+from modules.arcgis.na.pool import pool
+from modules.arcgis.na.network_dataset import calculate_locations, network_path
+from modules.arcgis.na.partition import solve_partitioned_location_allocation, write_allocation
+from modules.arcgis.stage_cache import StageCache, source_fingerprint, dataset_state
+from modules.arcgis.spatial import create_area_polygons, nearest_neighbor_statistics, write_area_points
+from modules.local.store import PointStore
 from modules.log import Log
 from modules.utils import create_uuid
 from traveltime_weight import calculate_traveltime_weight
+import split_areas as split
 from split_areas import split_areas
 
 log = Log(arcgis=True)
-arcpy.env.overwriteOutput = True
-
-# Script inputs
-municipality = arcpy.GetParameter(0)
-selected_matrikkel_units = arcpy.GetParameter(1)
-areas_to_create = arcpy.GetParameter(2)
-units_area_factor_weight = arcpy.GetParameter(3)
-max_units = arcpy.GetParameter(4) # Max units pr area to create
-result_polys = arcpy.GetParameter(5)
 
 # Analysis config
 aoi_name_field = 'kommunenavn'
 unit_type = 'Bolig'
 unit_type_field = 'bruksenhetstype'
 units_area_factor = 40 # 60 on previous runs
-use_mean_distance_weight = True
-use_travel_weight = False
-
 aoi_buffer_size = 1000
+facility_tolerance = 100 # Meters, facility candidates closer than this are collapsed to one
 
 """ options = {
   'decayFunctionType': arcpy.nax.DecayFunctionType.Power,
   'decayFunctionParameterValue': 2
 } """
 
-options = {
-  'travelMode': 'Gange',
-  'defaultImpedanceCutoff': 15,
-  'problemType': arcpy.nax.LocationAllocationProblemType.MinimizeImpedance,
-  'timeUnits': arcpy.nax.TimeUnits.Minutes
-}
-
-if max_units > 0:
-  log.info(f'Setter maks antall bruksenheter pr rode til: {max_units}')
-  options['problemType'] = arcpy.nax.LocationAllocationProblemType.MaximizeCapacitatedCoverage
-  options['defaultCapacity'] = max_units
-
 # Input dataset
 input_gdb = r'D:\Data\Geodata Online\MATRIKKEL_BruksenhetPunkt.gdb'
 matrikkel_units = os.path.join(input_gdb, 'MATRIKKEL_BruksenhetPunkt')
+matrikkel_store = r'D:\Data\Geodata Online\MATRIKKEL_BruksenhetPunkt_store' # Partitioned copy of matrikkel_units, see python -m modules ingest
 
-la_analysis = create_location_allocation_analysis(options)
+def open_matrikkel_store():
+  """Returns the partitioned matrikkel store, or None if it has not been ingested or is stale.
+     A store is stale when the matrikkel units have changed since the store was ingested
+     (see modules.arcgis.stage_cache.dataset_state), the units are then read from the matrikkel."""
 
-def create_location_allocation_areas(aoi_name):
-  global areas_to_create
-  global use_mean_distance_weight
-  
+  if not PointStore.exists(matrikkel_store):
+    return None
+  store = PointStore(matrikkel_store)
+  if arcpy.Exists(matrikkel_units):
+    ingested, current = store.catalogue.get('source_state'), dataset_state(matrikkel_units)
+    if ingested != current:
+      log.warning(f'{matrikkel_store} er utdatert ({ingested} ved innlesing, {current} nå), leser fra {matrikkel_units}. Kjør python -m modules ingest på nytt')
+      return None
+  return store
+
+class AreaJob:
+  """Settings for creating the areas of one municipality (or a selection of units).
+     Each job has its own settings and location-allocation analysis so consecutive
+     jobs in the same process do not share state.
+
+  Args:
+    municipality (str): Name of the municipality (kommunenavn), or None to use the selected units
+    result_polys (str): Output feature class for the areas
+    areas_to_create (int): Optional; Number of areas, 0 calculates it from the number of units
+    units_area_factor_weight (float): Optional; Units pr area used with the mean distance weight
+    max_units (int): Optional; Max units pr area, 0 for no limit
+    selected_units (str): Optional; Units to use when no municipality is given
+    use_mean_distance_weight (bool): Optional; Weight the number of areas by the spread of the units
+    use_travel_weight (bool): Optional; Calculate the travel time weight of each unit
+    use_native_solver (bool): Optional; Solve location-allocation in-process (p-median on a cutoff limited cost matrix)
+    demand_tolerance (float): Optional; Collapse units within this distance in meters (e.g. 10 for apartment
+      buildings) to weighted demand points, None uses every unit as a demand point
+    max_tile_points (int): Optional; Split the location-allocation into tiles of at most this many demand points
+      solved in parallel, None solves all demand points at once
+    workers (int): Optional; Number of processes solving tiles, default is the number of cpus - 1
+    use_grid_aoi (bool): Optional; Create the AOI with a closing on a grid instead of the double buffer
+    use_local_geometry (bool): Optional; Build the area polygons in-process instead of with CreateThiessenPolygons, Dissolve and Clip.
+      Off by default until the local polygons have been checked against the ArcGIS output
+    use_network_locations (bool): Optional; Locate the units on the network once and reuse the locations in every
+      location-allocation, split and route load (see modules.arcgis.na.network_dataset.calculate_locations)
+    use_stage_cache (bool): Optional; Reuse the results of stages whose inputs have not changed since an earlier run
+    cache_workspace (str): Optional; Folder for the stage cache, default is stage_cache next to the output geodatabase
+    trace (bool): Optional; Record the time, rows and memory of each stage and log a summary at the end
+    trace_memory (bool): Optional; Also trace the peak memory allocated in each stage with tracemalloc (slower)
+    trace_path (str): Optional; Json lines file for the stage records, default is {output name}_trace.jsonl next to the output geodatabase
+    result_points (str): Optional; Output feature class for the units with the AreaID of their area, the input of
+      update_areas for the next matrikkel extract. True writes {result_polys}_punkter, default is no output
+
+  The engines and side outputs added to the original script (stage cache, trace, network locations, local
+  geometry and result points) are off by default, so the script tool runs and writes as before.
+  """
+  def __init__(self, municipality, result_polys, areas_to_create = 0, units_area_factor_weight = 62.5, max_units = 0,
+               selected_units = None, use_mean_distance_weight = True, use_travel_weight = False, use_native_solver = False,
+               demand_tolerance = None, max_tile_points = None, workers = None, use_grid_aoi = False, use_local_geometry = False, use_network_locations = False, use_stage_cache = False, cache_workspace = None,
+               trace = False, trace_memory = False, trace_path = None, result_points = None) -> None:
+    self.municipality = municipality
+    self.result_polys = result_polys
+    self.areas_to_create = areas_to_create
+    self.units_area_factor_weight = units_area_factor_weight
+    self.max_units = max_units
+    self.selected_units = selected_units
+    self.use_mean_distance_weight = use_mean_distance_weight and areas_to_create == 0
+    self.use_travel_weight = use_travel_weight
+    self.use_native_solver = use_native_solver
+    self.demand_tolerance = demand_tolerance
+    self.max_tile_points = max_tile_points
+    self.workers = workers
+    self.use_grid_aoi = use_grid_aoi
+    self.use_local_geometry = use_local_geometry
+    self.use_network_locations = use_network_locations
+    self.use_stage_cache = use_stage_cache
+    self.cache_workspace = cache_workspace if cache_workspace is not None else os.path.join(os.path.dirname(Path(str(result_polys)).path), 'stage_cache')
+    self.trace = trace
+    self.trace_memory = trace_memory
+    self.trace_path = trace_path if trace_path is not None else os.path.join(os.path.dirname(Path(str(result_polys)).path), f'{Path(str(result_polys)).filename}_trace.jsonl')
+    self.result_points = f'{result_polys}_punkter' if result_points is True else result_points
+
+  def la_options(self) -> dict:
+    options = {
+      'travelMode': 'Gange',
+      'defaultImpedanceCutoff': 15,
+      'problemType': arcpy.nax.LocationAllocationProblemType.MinimizeImpedance,
+      'timeUnits': arcpy.nax.TimeUnits.Minutes
+    }
+
+    if self.max_units > 0:
+      log.info(f'Setter maks antall bruksenheter pr rode til: {self.max_units}')
+      options['problemType'] = arcpy.nax.LocationAllocationProblemType.MaximizeCapacitatedCoverage
+      options['defaultCapacity'] = self.max_units
+
+    if self.use_native_solver:
+      options['maxIterations'] = 20 # Vertex substitution passes
+      options['timeLimit'] = 600 # Seconds
+    return options
+
+  def create_la_analysis(self):
+    options = self.la_options()
+    return create_native_location_allocation_analysis(options, stage='areas') if self.use_native_solver else create_location_allocation_analysis(options, stage='areas')
+
+def create_location_allocation_areas(job: AreaJob) -> bool:
+  """Creates the areas of a job. Returns True if the location-allocation analysis succeeded.
+     Each stage is run through a stage cache, stages whose inputs are unchanged since an
+     earlier run are copied from the cache instead. With job.trace the stages are timed
+     (see Log.span) and a summary is logged at the end."""
+
+  pool.clear() # No analysis is reused from an earlier run in the process
+  if not job.trace:
+    return run_area_stages(job)
+
+  log.start_trace(job.trace_path, job.trace_memory)
+  try:
+    with log.span(str(job.municipality or 'Utvalg')):
+      return run_area_stages(job)
+  finally:
+    log.summary()
+    log.stop_trace()
+
+def run_area_stages(job: AreaJob) -> bool:
+
+  aoi_name = job.municipality
+  areas_to_create = job.areas_to_create
   if areas_to_create > 0: # Number of areas to find is set by user
     log.info(f'Finner et brukerdefinert antall områder ({areas_to_create})')
-    use_mean_distance_weight = False
-  
+  cache = StageCache(job.cache_workspace, job.use_stage_cache)
+
   # Create output dataset names
   #units_in_aoi = f'memory\AOI_Bruksenheter'
-  result_ds = Path(str(result_polys))
+  result_ds = Path(str(job.result_polys))
 
   units_in_aoi = os.path.join(result_ds.path, f'AOI_Bruksenheter_{create_uuid()}')
   unique_units_in_aoi = r'memory\AOI_UnikeBruksenheter'
@@ -72,66 +173,142 @@ def create_location_allocation_areas(aoi_name):
   result_points =  r'memory\AOI_RodePunkter'
   
   # Get demand points from Matrikkelen
-  if aoi_name:
+  store = open_matrikkel_store() if aoi_name else None
+  if store is not None:
+    # Memory-mapped slice of the kommune partition, the count is read from the catalogue
+    where = {aoi_name_field: aoi_name, unit_type_field: unit_type}
+    units_key, _ = cache.run('units', {'source': source_fingerprint(store.catalogue_path, str(where))}, [units_in_aoi],
+                             lambda: export_from_store(store, units_in_aoi, **where))
+    units_count = store.count(**where)
+  elif aoi_name:
     query = f"{aoi_name_field} = '{aoi_name}' AND {unit_type_field} = '{unit_type}'"
-    result = export_dataset(matrikkel_units, units_in_aoi, query)
+    units_key, units_count = cache.run('units', {'source': source_fingerprint(matrikkel_units, query)}, [units_in_aoi],
+                                       lambda: count_rows(export_dataset(matrikkel_units, units_in_aoi, query)[0]))
   else:
-    result = export_dataset(selected_matrikkel_units, units_in_aoi)
-  
-  units_count = count_rows(result[0])
+    units_key, units_count = cache.run('units', {'source': source_fingerprint(job.selected_units)}, [units_in_aoi],
+                                       lambda: count_rows(export_dataset(job.selected_units, units_in_aoi)[0]))
 
   if areas_to_create == 0:
     areas_to_create = int(units_count / units_area_factor)
 
   log.info(f'{units_count} bruksenheter valgt ut som demand points i location-allocation')
 
+  # Locate the units on the network once, the copies made by later stages keep the locations
+  if job.use_network_locations:
+    travel_mode = job.la_options()['travelMode']
+    units_key, unlocated = cache.run('network_locations', {'units': units_key, 'network': network_path(), 'travelMode': travel_mode}, [units_in_aoi],
+                                     lambda: int(np.isnan(calculate_locations(units_in_aoi, travel_mode=travel_mode)).sum()))
+    if unlocated:
+      log.warning(f'{unlocated} bruksenheter ble ikke plassert på nettverket')
+
   # Get facilites from Matrikkelen
-  result2 = export_dataset(units_in_aoi, unique_units_in_aoi)
-  arcpy.management.DeleteIdentical(unique_units_in_aoi, ['SHAPE'], '100 meters')
-  unique_units_count = count_rows(result2[0])
- 
+  unique_key, unique_units_count = cache.run('unique_units', {'units': units_key, 'tolerance': facility_tolerance}, [unique_units_in_aoi],
+                                             lambda: len(deduplicate_points(units_in_aoi, unique_units_in_aoi, facility_tolerance)[2].representatives))
   log.info(f'{unique_units_count} bruksenheter valgt ut som facilities i location-allocation')
 
   # Calculate travel weights
-  if use_travel_weight:
+  if job.use_travel_weight:
     log.info(f'Kalkulerer nærhet til naboer index for {units_in_aoi}')
-    calculate_traveltime_weight(units_in_aoi, 10)
+    units_key, _ = cache.run('travel_weight', {'units': units_key, 'neighbors': 10}, [units_in_aoi],
+                             lambda: calculate_traveltime_weight(units_in_aoi, 10))
 
-  if use_mean_distance_weight:
+  if job.use_mean_distance_weight:
     # Find unit point distribution for use in weighting
-    stats = arcpy.stats.AverageNearestNeighbor(units_in_aoi, 'EUCLIDEAN_DISTANCE')
-    log.info(f'Brukenhetenes spredningsindeks er: {stats[0]} (Mindre enn 1 betyr mer clustret enn spredt)')
-    areas_to_create = int(units_count / (units_area_factor_weight - float(stats[0])*50))
+    _, spread = cache.run('spread', {'units': units_key}, [],
+                          lambda: nearest_neighbor_statistics(units_in_aoi).ratio)
+    log.info(f'Brukenhetenes spredningsindeks er: {spread} (Mindre enn 1 betyr mer clustret enn spredt)')
+    areas_to_create = int(units_count / (job.units_area_factor_weight - spread*50))
 
-  log.info(f'Antall roder for {municipality} er {areas_to_create}')
+  log.info(f'Antall roder for {aoi_name} er {areas_to_create}')
 
   # Create analysis AOI
-  log.info(f'Avgrenser analyseområde for {municipality}')
-  features_to_aoi(unique_units_in_aoi, aoi, aoi_buffer_size)
+  log.info(f'Avgrenser analyseområde for {aoi_name}')
+  create_aoi = features_to_aoi_grid if job.use_grid_aoi else features_to_aoi
+  aoi_key, _ = cache.run('aoi', {'units': unique_key, 'buffer': aoi_buffer_size, 'grid': job.use_grid_aoi}, [aoi],
+                         lambda: create_aoi(unique_units_in_aoi, aoi, aoi_buffer_size))
+
+  # Weighted demand points
+  demand_points = units_in_aoi
+  demand_key = units_key
+  if job.demand_tolerance is not None:
+    demand_points = r'memory\AOI_VektedeBruksenheter'
+    demand_key, demand_count = cache.run('demand_points', {'units': units_key, 'tolerance': job.demand_tolerance}, [demand_points, units_in_aoi],
+                                         lambda: len(deduplicate_points(units_in_aoi, demand_points, job.demand_tolerance, representative_field='RepresentativeOID')[2].representatives))
+    log.info(f'{units_count} bruksenheter slått sammen til {demand_count} vektede demand points')
 
   # Create Location-Allocation analysis
-  la_analysis.facilityCount = areas_to_create
-  result = load_and_solve_location_allocation(la_analysis, unique_units_in_aoi, units_in_aoi)
+  def solve_location_allocation():
+    arcpy.management.Delete(result_points) # Points from an earlier job in this process must not be cached as the result
+    allocated_points = result_points if demand_points == units_in_aoi else r'memory\AOI_VektedeRodePunkter'
 
-  if result.solveSucceeded:
-    get_la_demand_points(result, result_points)
-    
-    result_points = split_areas(result_points)
+    if job.max_tile_points is not None and count_rows(demand_points) > job.max_tile_points:
+      allocation, demand_oids, errors = solve_partitioned_location_allocation(job.la_options(), unique_units_in_aoi, demand_points, areas_to_create,
+                                                                              job.max_tile_points, job.workers, job.use_native_solver)
+      if allocation is None: # No output, so the failed solve is not cached
+        return '\n'.join(errors)
+      write_allocation(demand_points, allocated_points, allocation, demand_oids)
+      key_field = 'SourceOID' # Copied from the demand points
+    else:
+      la_analysis = job.create_la_analysis()
+      la_analysis.facilityCount = areas_to_create
+      result = load_and_solve_location_allocation(la_analysis, unique_units_in_aoi, demand_points)
+      if not result.solveSucceeded:
+        return result.solverMessages(arcpy.nax.MessageSeverity.All)
+      get_la_demand_points(result, allocated_points)
+      key_field = 'SourceOID' if job.use_native_solver else 'Name' # Name is the SourceOID of the demand point, see demand_mappings
 
-    log.info(f'Lager Thiessen polygoner fra resultatpunktene')
-    arcpy.analysis.CreateThiessenPolygons(result_points, r'memory\ResultPolygons', "ALL")
+    if allocated_points != result_points:
+      expand_demand_allocation(allocated_points, units_in_aoi, result_points, key_field=key_field)
 
-    log.info(f'Slår sammen Thiessen polygoner med lik Facility ID')
-    arcpy.management.Dissolve(r'memory\ResultPolygons', r'memory\ResultPolygonsDissolved', "AreaID", None, "SINGLE_PART", "DISSOLVE_LINES", '')
-    
-    log.info(f'Klipper polygonene til interesseområdet')
-    arcpy.analysis.Clip(r'memory\ResultPolygonsDissolved', aoi, result_polys, None)
+  la_inputs = {'facilities': unique_key, 'demand_points': demand_key, 'options': job.la_options(), 'facilityCount': areas_to_create,
+               'native': job.use_native_solver, 'max_tile_points': job.max_tile_points}
+  la_key, messages = cache.run('location_allocation', la_inputs, [result_points], solve_location_allocation)
+
+  if arcpy.Exists(result_points):
+    split_inputs = {'points': la_key, 'max_count': split.MAX_COUNT, 'target_count': split.TARGET_COUNT, 'options': split.get_la_options(), 'batch': split.BATCH_SPLIT}
+    split_key, _ = cache.run('split', split_inputs, [result_points], lambda: split_areas(result_points))
+
+    def create_polygons():
+      if job.use_local_geometry:
+        create_area_polygons(result_points, aoi, job.result_polys, 'AreaID')
+        return
+
+      log.info(f'Lager Thiessen polygoner fra resultatpunktene')
+      arcpy.analysis.CreateThiessenPolygons(result_points, r'memory\ResultPolygons', "ALL")
+
+      log.info(f'Slår sammen Thiessen polygoner med lik Facility ID')
+      arcpy.management.Dissolve(r'memory\ResultPolygons', r'memory\ResultPolygonsDissolved', "AreaID", None, "SINGLE_PART", "DISSOLVE_LINES", '')
+      
+      log.info(f'Klipper polygonene til interesseområdet')
+      arcpy.analysis.Clip(r'memory\ResultPolygonsDissolved', aoi, job.result_polys, None)
+
+    polygons_key, _ = cache.run('polygons', {'points': split_key, 'aoi': aoi_key, 'local': job.use_local_geometry}, [job.result_polys], create_polygons)
+
+    # Units with their area, so the areas can be updated from the next matrikkel extract (see update_areas)
+    if job.result_points:
+      _, outside = cache.run('area_points', {'units': units_key, 'polygons': polygons_key}, [job.result_points],
+                             lambda: write_area_points(units_in_aoi, job.result_polys, job.result_points))
+      if outside:
+        log.warning(f'{outside} bruksenheter ligger utenfor rodene')
 
     log.info(f'Vellykket analyse av arealer :-)')
+    pool.report()
+    cache.report()
+    return True
 
-  else:
-    log.error('Solving the location-allocation analysis failed:')
-    log.error(result.solverMessages(arcpy.nax.MessageSeverity.All))
+  log.error('Solving the location-allocation analysis failed:')
+  log.error(messages)
+  cache.report()
+  return False
 
 ###############################################################################
-create_location_allocation_areas(municipality)
\ No newline at end of file
+if __name__ == '__main__':
+  # Script inputs
+  create_location_allocation_areas(AreaJob(
+    municipality = arcpy.GetParameter(0),
+    selected_units = arcpy.GetParameter(1),
+    areas_to_create = arcpy.GetParameter(2),
+    units_area_factor_weight = arcpy.GetParameter(3),
+    max_units = arcpy.GetParameter(4), # Max units pr area to create
+    result_polys = arcpy.GetParameter(5)
+  ))
@@ -1,12 +1,14 @@
 import os
-import arcpy
+from modules.backend import arcpy
+import numpy as np
 from modules.log import Log
 from modules.filepaths import Path
-from modules.arcgis.dataset import delete_identical_features, get_path
+from modules.arcgis.dataset import export_dataset, get_path, update_table
+from modules.arcgis.spatial import assign_points_to_areas
+from modules.arcgis.na.pool import pool
 from traveltime_pr_area import calculate_traveltime_pr_area
 
 log = Log(arcgis=True)
-arcpy.env.overwriteOutput = True
 
 # For debugging
 #source_gdb = r'D:\Data\Kreftforeningen_roder\namsos.gdb'
@@ -16,28 +18,36 @@ arcpy.env.overwriteOutput = True
 #points = os.path.join(source_gdb, 'Bruksenheter_i_krk_roder')
 #travelmode = 'Gange'
 
-# Script inputs
-areas = arcpy.GetParameter(0) # Areas to enrich with statistics
-points = arcpy.GetParameter(1) # Points to visit within area
-travelmode = arcpy.GetParameter(2)
+use_tour_solver = False # Sequence stops locally on one OD matrix instead of a route solve pr area
+workers = 1 # Number of processes solving routes, None uses all but one cpu
+chunk_size = 50 # Areas pr process pool task
 
-def enrich_areas() -> None:
+def enrich_areas(areas, points, travelmode) -> str:
   """Adds statistics to area, like point counts and total traveltime to visit
-     each point in area"""
+     each point in area. Returns the new feature class {areas}_statistics"""
 
   #p = Path(areas)
   #result_areas = os.path.join(p.path, f'{p.filename}_statistics')
   result_areas = f'{areas}_statistics'
 
-  log.info(f'Counting number of points within each area...')
-  arcpy.analysis.SpatialJoin(areas, points, result_areas)
+  export_dataset(areas, result_areas)
 
-  log.info(f'Getting unique points...')
-  unique_points = r'memory/unique_points'
-  result = delete_identical_features(points, unique_points, None)
+  log.info(f'Counting number of points within each area...')
+  assignment = assign_points_to_areas(points, result_areas)
+  counts = np.empty(len(assignment[1].area_ids), dtype=[('OID@', np.int64), ('Join_Count', np.int64)])
+  counts['OID@'], counts['Join_Count'] = assignment[1].area_ids, assignment[1].counts
+  update_table(result_areas, counts)
 
   log.info(f'Calculating traveltime for each area...')
-  calculate_traveltime_pr_area(unique_points, result_areas, travelmode)
+  calculate_traveltime_pr_area(points, result_areas, travelmode, use_tour_solver, workers, chunk_size, assignment)
+  return result_areas
 
 ###############################################################################
-enrich_areas()
+if __name__ == '__main__':
+  pool.clear() # No analysis is reused from an earlier run of the tool in the process
+  # Script inputs
+  enrich_areas(
+    arcpy.GetParameter(0), # Areas to enrich with statistics
+    arcpy.GetParameter(1), # Points to visit within area
+    arcpy.GetParameter(2)
+  )
@@ -0,0 +1,195 @@
+"""
+Command line entry point for the area scripts, for running them outside the ArcGIS Pro
+toolboxes. Each command imports its script when it is run, so the CLI itself starts
+without arcpy, and 'info' works on machines without ArcGIS.
+
+Usage:
+  python -m modules info
+  python -m modules areas Sandnes D:\\Data\\Roder.gdb\\Roder_Sandnes --max-units 70
+  python -m modules batch all D:\\Data\\Roder.gdb --workers 4
+  python -m modules split D:\\Data\\Roder.gdb\\Bruksenheter
+  python -m modules merge D:\\Data\\Roder.gdb\\Roder_statistics D:\\Data\\Roder.gdb\\Roder_merge
+  python -m modules statistics D:\\Data\\Roder.gdb\\Roder D:\\Data\\Roder.gdb\\Bruksenheter
+  python -m modules weight D:\\Data\\Roder.gdb\\Bruksenheter --neighbors 10
+  python -m modules ingest
+  python -m modules update Sandnes D:\\Data\\Roder.gdb\\Roder_Sandnes_punkter D:\\Data\\Roder.gdb\\Roder_Sandnes D:\\Data\\Roder.gdb\\Roder_Sandnes_2
+  python -m modules rebalance D:\\Data\\Roder.gdb\\Roder_Sandnes_punkter D:\\Data\\Roder.gdb\\Roder_Sandnes D:\\Data\\Roder.gdb\\Roder_Sandnes_balansert
+  python -m modules od origins.csv destinations.csv lines.csv --backend local --network kanter.npz
+"""
+
+import argparse
+import platform
+import sys
+from modules.backend import arcpy
+from modules.na import backend_name
+
+def run_info(args) -> int:
+  print(f'Python {platform.python_version()} ({sys.executable})')
+  print(f'arcpy: {"tilgjengelig" if arcpy.available() else "ikke installert, bare lokale analyser kan kjøres"}')
+  return 0
+
+def run_areas(args) -> int:
+  from create_areas import AreaJob, create_location_allocation_areas
+  job = AreaJob(args.municipality, args.output, areas_to_create=args.areas, max_units=args.max_units,
+                use_native_solver=args.native, demand_tolerance=args.demand_tolerance,
+                max_tile_points=args.max_tile_points, workers=args.workers, use_grid_aoi=args.grid_aoi, use_local_geometry=args.local_geometry,
+                use_network_locations=args.network_locations, use_stage_cache=args.cache, trace=args.trace,
+                result_points=args.result_points or None)
+  return 0 if create_location_allocation_areas(job) else 1
+
+def run_batch(args) -> int:
+  from batch_create_areas import create_areas_batch
+  manifest = create_areas_batch('all' if args.municipalities == ['all'] else args.municipalities,
+                                args.output_gdb, args.workers, args.manifest,
+                                areas_to_create=args.areas, max_units=args.max_units, use_native_solver=args.native)
+  return 0 if all(entry['status'] == 'done' for entry in manifest.values()) else 1
+
+def run_split(args) -> int:
+  from split_areas import split_areas
+  split_areas(args.points, workers=args.workers or None)
+  return 0
+
+def run_merge(args) -> int:
+  from merge_areas import merge_areas
+  merge_areas(args.areas, args.output)
+  return 0
+
+def run_statistics(args) -> int:
+  from create_areas_statistics import enrich_areas
+  enrich_areas(args.areas, args.points, args.travel_mode)
+  return 0
+
+def run_weight(args) -> int:
+  from traveltime_weight import calculate_traveltime_weight
+  calculate_traveltime_weight(args.points, args.neighbors)
+  return 0
+
+def run_ingest(args) -> int:
+  from create_areas import matrikkel_units, matrikkel_store, aoi_name_field, unit_type_field
+  from modules.arcgis.dataset import ingest_store
+  ingest_store(args.input or matrikkel_units, args.store or matrikkel_store, [aoi_name_field, unit_type_field], fields=args.fields)
+  return 0
+
+def run_update(args) -> int:
+  from update_areas import update_areas
+  update_areas(args.municipality, args.previous_points, args.previous_areas, args.output,
+               args.output_points or f'{args.output}_punkter', args.units, args.travel_mode)
+  return 0
+
+def run_rebalance(args) -> int:
+  from rebalance_areas import rebalance_areas
+  rebalance_areas(args.points, args.areas, args.output, args.output_points, args.travel_mode, args.time_limit, args.cost_cache)
+  return 0
+
+def run_od(args) -> int:
+  from modules import na
+  odmatrix = na.module('odmatrix', args.backend)
+  od_matrix = na.create_origin_destination_analysis({'travelMode': args.travel_mode, 'defaultImpedanceCutoff': args.cutoff,
+                                                     'defaultDestinationCount': args.destinations}, args.network, args.backend)
+  result = odmatrix.load_and_solve_od_matrix(od_matrix, args.origins, args.destinations_input)
+  odmatrix.get_od_lines(result, args.output)
+  return 0 if result.solveSucceeded else 1
+
+def create_parser() -> argparse.ArgumentParser:
+  parser = argparse.ArgumentParser(prog='python -m modules', description='Lag roder for dør-til-dør aksjoner')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  command = commands.add_parser('info', help='Show the Python and ArcGIS environment')
+  command.set_defaults(run=run_info)
+
+  command = commands.add_parser('areas', help='Create the areas of one municipality (create_areas)')
+  command.add_argument('municipality', help='Name of the municipality (kommunenavn)')
+  command.add_argument('output', help='Output feature class')
+  command.add_argument('--areas', type=int, default=0, help='Number of areas, 0 calculates it')
+  command.add_argument('--max-units', type=int, default=0, help='Max units pr area, 0 for no limit')
+  command.add_argument('--native', action='store_true', help='Solve location-allocation in-process')
+  command.add_argument('--demand-tolerance', type=float, default=None, help='Collapse units within this distance (meters) to weighted demand points')
+  command.add_argument('--max-tile-points', type=int, default=None, help='Solve the location-allocation in tiles of at most this many demand points')
+  command.add_argument('--workers', type=int, default=None, help='Processes solving tiles')
+  command.add_argument('--grid-aoi', action='store_true', help='Create the AOI on a grid instead of with buffers')
+  command.add_argument('--local-geometry', action='store_true', help='Build the area polygons in-process instead of with CreateThiessenPolygons, Dissolve and Clip')
+  command.add_argument('--network-locations', action='store_true', help='Locate the units on the network once and reuse the locations')
+  command.add_argument('--cache', action='store_true', help='Reuse the results of stages whose inputs have not changed')
+  command.add_argument('--trace', action='store_true', help='Write the time, rows and memory of each stage to {output}_trace.jsonl')
+  command.add_argument('--result-points', nargs='?', const=True, default=None, help='Write the units with their AreaID, default path is {output}_punkter')
+  command.set_defaults(run=run_areas)
+
+  command = commands.add_parser('batch', help='Create the areas of many municipalities (batch_create_areas)')
+  command.add_argument('municipalities', nargs='+', help='Names of the municipalities (kommunenavn) or all')
+  command.add_argument('output_gdb', help='Geodatabase for the resulting areas')
+  command.add_argument('--workers', type=int, default=None)
+  command.add_argument('--manifest', default=None, help='Checkpoint manifest (json)')
+  command.add_argument('--areas', type=int, default=0, help='Number of areas pr municipality, 0 calculates it')
+  command.add_argument('--max-units', type=int, default=0, help='Max units pr area, 0 for no limit')
+  command.add_argument('--native', action='store_true', help='Solve location-allocation in-process')
+  command.set_defaults(run=run_batch)
+
+  command = commands.add_parser('split', help='Split areas with too many units (split_areas)')
+  command.add_argument('points', help='Points with a FacilityOID, updated with an AreaID')
+  command.add_argument('--workers', type=int, default=1, help='Processes splitting areas, 0 uses all but one cpu')
+  command.set_defaults(run=run_split)
+
+  command = commands.add_parser('merge', help='Merge areas with too few units into a neighbour (merge_areas)')
+  command.add_argument('areas', help='Areas with statistics')
+  command.add_argument('output', help='Output feature class for the merged areas')
+  command.set_defaults(run=run_merge)
+
+  command = commands.add_parser('statistics', help='Add unit counts and walk times to areas (create_areas_statistics)')
+  command.add_argument('areas', help='Areas to enrich, written to {areas}_statistics')
+  command.add_argument('points', help='Points to visit within the areas')
+  command.add_argument('--travel-mode', default='Gange')
+  command.set_defaults(run=run_statistics)
+
+  command = commands.add_parser('weight', help='Add the travel time weight to points (traveltime_weight)')
+  command.add_argument('points', help='Points to add Weight and WeightCount to')
+  command.add_argument('--neighbors', type=int, default=10, help='Number of nearest neighbours')
+  command.set_defaults(run=run_weight)
+
+  command = commands.add_parser('ingest', help='Partition the matrikkel units by kommune and unit type into a store for fast extraction')
+  command.add_argument('--input', default=None, help='Point feature class, default is the matrikkel units of create_areas')
+  command.add_argument('--store', default=None, help='Folder of the store, default is the matrikkel store of create_areas')
+  command.add_argument('--fields', nargs='+', default=None, help='Fields to store, default is all')
+  command.set_defaults(run=run_ingest)
+
+  command = commands.add_parser('update', help='Update the areas of a municipality from a new matrikkel extract (update_areas)')
+  command.add_argument('municipality', help='Name of the municipality (kommunenavn)')
+  command.add_argument('previous_points', help='Units of the previous run with AreaID (written by areas --result-points)')
+  command.add_argument('previous_areas', help='Areas of the previous run')
+  command.add_argument('output', help='Output feature class for the updated areas')
+  command.add_argument('--output-points', default=None, help='Output feature class for the updated units, default is {output}_punkter')
+  command.add_argument('--units', default=None, help='The new units, default is the units of the municipality in the matrikkel')
+  command.add_argument('--travel-mode', default='Gange')
+  command.set_defaults(run=run_update)
+
+  command = commands.add_parser('rebalance', help='Move boundary units between areas to balance the walk time (rebalance_areas)')
+  command.add_argument('points', help='Units with AreaID (written by areas --result-points)')
+  command.add_argument('areas', help='The areas, the new areas are clipped to them')
+  command.add_argument('output', help='Output feature class for the rebalanced areas')
+  command.add_argument('--output-points', default=None, help='Output feature class for the units, default is {output}_punkter')
+  command.add_argument('--travel-mode', default='Gange')
+  command.add_argument('--time-limit', type=float, default=300, help='Seconds for moving units')
+  command.add_argument('--cost-cache', default=None, help='SQLite file caching the walk times between stops across runs, default is no cache')
+  command.set_defaults(run=run_rebalance)
+
+  command = commands.add_parser('od', help='Solve an OD cost matrix with the arcgis or local network analysis (modules.na)')
+  command.add_argument('origins', help='Origins, a feature class (arcgis) or .npy/.csv points (local)')
+  command.add_argument('destinations_input', metavar='destinations', help='Destinations, like the origins')
+  command.add_argument('output', help='Output for the OD lines')
+  command.add_argument('--backend', choices=['arcgis', 'local'], default=None, help='Network analysis, default is arcgis if arcpy is installed')
+  command.add_argument('--network', default=None, help='Network dataset (arcgis) or edge list (local), default is ELVEG')
+  command.add_argument('--travel-mode', default='Gange')
+  command.add_argument('--cutoff', type=float, default=15, help='Impedance cutoff in minutes')
+  command.add_argument('--destinations', type=int, default=None, help='Max destinations pr origin, default is all within the cutoff')
+  command.set_defaults(run=run_od)
+  return parser
+
+def main(argv: list = None) -> int:
+  args = create_parser().parse_args(argv)
+  local = args.command == 'info' or (args.command == 'od' and backend_name(args.backend) == 'local')
+  if not local and not arcpy.available():
+    print(f'{args.command} trenger arcpy (ArcGIS Pro), se python -m modules info')
+    return 2
+  return args.run(args)
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,5 +1,8 @@
-import arcpy
-arcpy.env.overwriteOutput = True
+from __future__ import annotations
+from modules.backend import arcpy
+import numpy as np
+from modules.arcgis.spatial import read_points, write_polygons
+from modules.local.aoi import points_to_aoi
 
 def features_to_aoi(input_dataset: str, output_dataset: str, buffer_distance: int) -> arcpy.Result:
   """Creates an AOI from clusters of features by buffering first with a large radius
@@ -14,4 +17,13 @@ def features_to_aoi(input_dataset: str, output_dataset: str, buffer_distance: in
 
   return arcpy.analysis.Buffer(
     r"memory\Buffers", output_dataset, negative_buffer_distance, 
-    "FULL", "ROUND", "ALL", None, "PLANAR")
\ No newline at end of file
+    "FULL", "ROUND", "ALL", None, "PLANAR")
+
+def features_to_aoi_grid(input_dataset: str, output_dataset: str, buffer_distance: int, cell_size: float = None) -> None:
+  """Creates the same AOI as features_to_aoi from the points of the input dataset, with a
+     closing on a grid instead of vector buffers (see modules.local.aoi.points_to_aoi).
+     Much faster on dense datasets, the outline is within a few cell sizes of the buffers."""
+
+  points = read_points(input_dataset)
+  aoi = points_to_aoi(np.column_stack([points['SHAPE@X'], points['SHAPE@Y']]), buffer_distance, cell_size=cell_size)
+  write_polygons(output_dataset, None, np.array([aoi]), None, input_dataset)
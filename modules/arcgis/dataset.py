@@ -1,9 +1,18 @@
+from __future__ import annotations
 import os
-import arcpy
+from modules.backend import arcpy
+import numpy as np
+import numpy.lib.recfunctions as rfn
+from modules.local.dataset import to_arrow, from_arrow
+from modules.local.store import PointStore
+from modules.local.spatial import cluster_points
 from modules.log import Log
 from modules.filepaths import Path
+from modules.arcgis.stage_cache import dataset_state
 log = Log(arcgis=True)
 
+INGEST_CHUNK_ROWS = 500_000 # Object ids read pr chunk by ingest_store
+
 def create_featureclass(fc: str, geometry_type: str = 'POINT', wkid: int = 25833, template_fc: str = None, delete_existing: bool = False) -> str:
   """Creates a new feature class (will delete first if already exist)
   Args:
@@ -63,10 +72,203 @@ def featureclass_to_list(dataset: str, fields: list = "*", sort_field_index: int
   """
   data = [row for row in arcpy.da.SearchCursor(dataset, fields)]
 
-  if sort_field_index > 0: 
-   return data.sort(key=lambda tup: tup[sort_field_index])
+  if sort_field_index >= 0:
+    data.sort(key=lambda tup: tup[sort_field_index])
+  return data
+
+# Null values used when reading fields of each type to NumPy, which has no null for integers and text
+NULL_VALUES = {
+  'SmallInteger': -1,
+  'Integer': -1,
+  'BigInteger': -1,
+  'Single': np.nan,
+  'Double': np.nan,
+  'String': '',
+  'GUID': ''
+}
+
+# Field type used when writing a NumPy column of each kind (see numpy.dtype.kind)
+FIELD_TYPES = {
+  'b': 'SHORT',
+  'i': 'LONG',
+  'u': 'LONG',
+  'f': 'DOUBLE',
+  'U': 'TEXT',
+  'S': 'TEXT',
+  'M': 'DATE'
+}
+
+def table_fields(dataset: str) -> list:
+  """Returns the fields that can be read to NumPy: the ObjectID, X and Y of point feature
+     classes and the attribute fields with a NumPy type"""
+
+  description = arcpy.Describe(dataset)
+  fields = ['OID@'] if description.hasOID else []
+  if getattr(description, 'shapeType', None) == 'Point':
+    fields += ['SHAPE@X', 'SHAPE@Y']
+  return fields + [field.name for field in arcpy.ListFields(dataset) if field.type in NULL_VALUES or field.type == 'Date']
+
+def read_table(dataset, fields: list = None, query: str = None) -> np.ndarray:
+  """Reads a feature class or table to a NumPy structured array in one bulk read, with
+     float64 coordinates and a typed column pr attribute. Null values are read as the
+     NULL_VALUES of the field type. Arrays are returned as they are (with the requested
+     fields), so the result of one stage can be passed on to the next without a copy to disk.
+
+  Args:
+    dataset: Full path to the feature class or table, a layer or a structured array
+    fields (list): Optional; Fields to read, e.g. OID@, SHAPE@X, SHAPE@Y and attributes. Default is table_fields
+    query (str): Optional; Where clause
+
+  Returns:
+    np.ndarray: Structured array with one record pr row
+  """
+  if isinstance(dataset, np.ndarray):
+    return dataset[fields] if fields is not None else dataset
+
+  fields = fields if fields is not None else table_fields(dataset)
+  types = {field.name: field.type for field in arcpy.ListFields(dataset)}
+  null_value = {field: NULL_VALUES[types[field]] for field in fields if types.get(field) in NULL_VALUES}
+  if hasattr(arcpy.Describe(dataset), 'shapeType'): # Feature class or feature layer
+    return arcpy.da.FeatureClassToNumPyArray(dataset, fields, query, null_value=null_value)
+  return arcpy.da.TableToNumPyArray(dataset, fields, query, null_value=null_value)
+
+def read_arrow(dataset, fields: list = None, query: str = None):
+  """Reads a feature class or table to a pyarrow Table, with arcpy.da.TableToArrowTable
+     when the ArcGIS version has it (3.2 and later) and from read_table otherwise"""
+
+  if hasattr(arcpy.da, 'TableToArrowTable') and not isinstance(dataset, np.ndarray) and not any('@' in field for field in fields or []):
+    return arcpy.da.TableToArrowTable(dataset, fields, query)
+  return to_arrow(read_table(dataset, fields, query))
+
+def write_table(data, output_dataset: str, wkid: int = 25833, template_fc: str = None) -> str:
+  """Writes a structured array (or pyarrow Table) to a new feature class or table in one
+     bulk write. Arrays with SHAPE@X and SHAPE@Y are written as points, the coordinate
+     columns are stored as X and Y and an OID@ column is left out.
+
+  Args:
+    data: Structured array (see read_table) or pyarrow Table
+    output_dataset (str): Full path to the new feature class or table, an existing one is deleted
+    wkid (int): Optional; Well known ID of the spatial reference of the points
+    template_fc (str): Optional; Take the spatial reference from this feature class instead
+
+  Returns:
+    str: The output dataset
+  """
+  data = data if isinstance(data, np.ndarray) else from_arrow(data)
+  data = rfn.repack_fields(data[[name for name in data.dtype.names if name != 'OID@']])
+  data = rfn.rename_fields(data, {'SHAPE@X': 'X', 'SHAPE@Y': 'Y'})
+  delete_featureclass(output_dataset)
+
+  log.info(f'Skriver {len(data)} rader til {output_dataset}...')
+  if 'X' in data.dtype.names and 'Y' in data.dtype.names:
+    spatial_reference = arcpy.Describe(template_fc).spatialReference if template_fc is not None else arcpy.SpatialReference(wkid)
+    arcpy.da.NumPyArrayToFeatureClass(data, output_dataset, ['X', 'Y'], spatial_reference)
   else:
-    return data  
+    arcpy.da.NumPyArrayToTable(data, output_dataset)
+  return output_dataset
+
+def update_table(dataset: str, data: np.ndarray, key_field: str = 'OID@', fields: list = None) -> int:
+  """Writes columns of a structured array back to the matching rows of a feature class or
+     table in one UpdateCursor pass. Missing fields are added with a type from FIELD_TYPES,
+     NaN is written as null and rows without a match in the array are left unchanged.
+
+  Args:
+    dataset (str): Full path to the feature class or table
+    data (np.ndarray): Structured array with the key field and the fields to write
+    key_field (str): Optional; Field matching the rows of the dataset and the array
+    fields (list): Optional; Fields to write, default is all fields of the array except the key
+
+  Returns:
+    int: Number of rows updated
+  """
+  fields = fields if fields is not None else [name for name in data.dtype.names if name != key_field]
+  for field in fields:
+    add_field(dataset, field, FIELD_TYPES.get(data.dtype[field].kind, 'TEXT'))
+
+  columns = []
+  for field in fields:
+    values = data[field]
+    if values.dtype.kind == 'f':
+      values = np.where(np.isnan(values), None, values)
+    columns.append(values.tolist())
+  rows = dict(zip(data[key_field].tolist(), zip(*columns)))
+
+  updated = 0
+  with arcpy.da.UpdateCursor(dataset, [key_field] + fields) as cursor:
+    for row in cursor:
+      values = rows.get(row[0])
+      if values is not None:
+        cursor.updateRow([row[0], *values])
+        updated += 1
+  return updated
+
+def compact_text(data: np.ndarray, widths: dict = None) -> np.ndarray:
+  """Returns the array with each text column narrowed to its longest value (or the given width),
+     text fields are read with the full field length (often 255 characters)"""
+
+  widths = widths if widths is not None else text_widths(data)
+  dtype = [(name, f'<U{widths[name]}' if name in widths else data.dtype[name]) for name in data.dtype.names]
+  return data.astype(dtype)
+
+def text_widths(data: np.ndarray) -> dict:
+  """Returns the length of the longest value of each text column"""
+  return {name: max(int(np.char.str_len(data[name]).max()) if len(data) > 0 else 1, 1) for name in data.dtype.names if data.dtype[name].kind == 'U'}
+
+def ingest_store(input_fc: str, store_path: str, partition_fields: list, query: str = None, fields: list = None,
+                 chunk_rows: int = INGEST_CHUNK_ROWS) -> PointStore:
+  """Reads a point feature class in chunks of object ids and writes it to a partitioned store
+     (see modules.local.store), e.g. the national matrikkel partitioned by kommune and unit type.
+     The text columns of each chunk are narrowed to their longest value before the next chunk is
+     read, so only one chunk is held with the full field lengths. The state of the input (see
+     modules.arcgis.stage_cache.dataset_state) is kept in the catalogue to find stale stores.
+
+  Args:
+    input_fc (str): Full path to the point feature class
+    store_path (str): Folder of the store, an existing store is replaced
+    partition_fields (list): Fields partitioning the points
+    query (str): Optional; Where clause selecting the points to store
+    fields (list): Optional; Fields to store, default is table_fields. The partition fields and coordinates are always stored
+    chunk_rows (int): Optional; Object ids read pr chunk
+
+  Returns:
+    PointStore: The new store
+  """
+  fields = fields if fields is not None else table_fields(input_fc)
+  fields = list(dict.fromkeys(['SHAPE@X', 'SHAPE@Y', *fields, *partition_fields]))
+  log.info(f'Leser {input_fc} til {store_path}...')
+  state = dataset_state(input_fc) # Before the read, an edit during the read makes the store stale
+  oid_field = arcpy.Describe(input_fc).OIDFieldName
+  with arcpy.da.SearchCursor(input_fc, ['OID@'], sql_clause=(None, f'ORDER BY {oid_field} DESC')) as cursor:
+    max_oid = next(cursor, [0])[0]
+
+  chunks = []
+  for low in range(0, max_oid + 1, chunk_rows):
+    where = f'{oid_field} >= {low} AND {oid_field} < {low + chunk_rows}'
+    chunk = read_table(input_fc, fields, f'({query}) AND {where}' if query else where)
+    if len(chunk) > 0:
+      chunks.append(compact_text(chunk))
+  widths = {}
+  for chunk in chunks:
+    for name, width in text_widths(chunk).items():
+      widths[name] = max(widths.get(name, 1), width)
+  data = np.concatenate([compact_text(chunk, widths) for chunk in chunks]) if chunks else read_table(input_fc, fields, query)
+  chunks = None
+
+  store = PointStore.create(store_path, data, partition_fields, source=input_fc, source_state=state,
+                            wkid=arcpy.Describe(input_fc).spatialReference.factoryCode)
+  log.info(f'{len(data)} punkter lagret i {len(store.catalogue["partitions"])} partisjoner')
+  return store
+
+@log.timed(rows=lambda count: count)
+def export_from_store(store: PointStore, output_fc: str, fields: list = None, bbox: tuple = None, **where) -> int:
+  """Writes the points of a store matching the conditions to a new feature class (see PointStore.read)
+
+  Returns:
+    int: Number of points written
+  """
+  data = store.read(fields, bbox, **where)
+  write_table(data, output_fc, store.wkid)
+  return len(data)
 
 def add_fields(dataset: str, field_defs: list) -> None:
   log.info(f'Adding {len(field_defs)} fields to input fc {dataset}...')
@@ -104,6 +306,29 @@ def find_field_index(dataset: str, field_name: str) -> int:
   """Returns the index of a field in a feature class or table."""
   return [field.name for field in arcpy.ListFields(dataset)].index(field_name)
 
+@log.timed()
+def export_keyed(input_fc: str, output_fc: str, key_field: str = 'SourceOID', query: str = None) -> arcpy.Result:
+  """Copies the features with the ObjectID of each input feature in the key field. The copy
+     gets new ObjectIDs and is not guaranteed to keep the input order, so values computed from
+     the input are joined to the copy on the key field. The input is only read: the schema is
+     copied, the key field added to the copy and the rows inserted from a cursor on the input.
+     A key field in the input is replaced in the copy.
+
+  Returns:
+    arcpy.Result: The result of copying the schema, the output is its first value
+  """
+  result = export_dataset(input_fc, output_fc, '1 = 0')
+  add_field(output_fc, key_field, 'LONG')
+  input_fields = {field.name for field in arcpy.ListFields(input_fc)}
+  fields = [field.name for field in arcpy.ListFields(output_fc)
+            if field.editable and field.type not in ('OID', 'Geometry') and field.name != key_field and field.name in input_fields]
+  shape = 'SHAPE@XY' if arcpy.Describe(input_fc).shapeType == 'Point' else 'SHAPE@'
+  with arcpy.da.SearchCursor(input_fc, ['OID@', shape] + fields, query) as rows, \
+       arcpy.da.InsertCursor(output_fc, [key_field, shape] + fields) as cursor:
+    for row in rows:
+      cursor.insertRow(row)
+  return result
+
 def export_dataset(input_dataset: str, output_dataset: str, query: str = None) -> arcpy.Result:
   """Copy the features from the input dataset meeting the query expression to the output dataset"""
   
@@ -114,12 +339,16 @@ def export_dataset(input_dataset: str, output_dataset: str, query: str = None) -
     outpath.filename, query
   )
 
+@log.timed(rows=lambda count: count)
 def count_rows(input_dataset: str) -> int:
   result = arcpy.GetCount_management(input_dataset)
   return int(result[0])
 
 def delete_identical_features(input_fc:str, result_fc:str, xy_tolerance) -> arcpy.Result:
-  """Copies the input feature class and removes identical features
+  """Copies the input feature class and removes identical features. Point features within
+     the tolerance of each other are collapsed to one point with the number of points it
+     represents in a Weight field (see deduplicate_points), other features (and points without
+     a tolerance) are removed with DeleteIdentical.
 
     Args:
       input_fc (str): Full path to the input feature class
@@ -128,6 +357,9 @@ def delete_identical_features(input_fc:str, result_fc:str, xy_tolerance) -> arcp
     Returns:
       A arcpy.Result from the copying of features
   """
+  if xy_tolerance is not None and arcpy.Describe(input_fc).shapeType == 'Point': # Without a tolerance the copy keeps the input schema
+    return deduplicate_points(input_fc, result_fc, xy_tolerance)[0]
+
   log.info(f'Kopierer {input_fc}...')
   result = export_dataset(input_fc, result_fc)
   count = count_rows(result[0])
@@ -144,6 +376,51 @@ def delete_identical_features(input_fc:str, result_fc:str, xy_tolerance) -> arcp
   
   return result
 
+@log.timed()
+def deduplicate_points(input_fc: str, result_fc: str, xy_tolerance: float, weight_field: str = 'Weight', representative_field: str = None) -> tuple:
+  """Copies the representative points of clusters of points within the tolerance of each
+     other (see modules.local.spatial.cluster_points). Each copied point gets the number of
+     points (or the sum of the input weights) it represents in the weight field and the
+     ObjectID of the input point in a SourceOID field.
+
+    Args:
+      input_fc (str): Full path to the input point feature class
+      result_fc (str): Full path to the resulting feature class
+      xy_tolerance (float): Max distance in meters from a point to its representative
+      weight_field (str): Optional; Field for the weights, existing weights in the input are summed
+      representative_field (str): Optional; Field in the input for the ObjectID of the representative of each point
+
+    Returns:
+      tuple: A arcpy.Result from the copying of features, the input ObjectIDs and the PointClusters
+  """
+  fields = ['OID@', 'SHAPE@X', 'SHAPE@Y'] + ([weight_field] if field_exists(input_fc, weight_field) else [])
+  points = arcpy.da.FeatureClassToNumPyArray(input_fc, fields, null_value=1)
+  weights = points[weight_field] if len(fields) > 3 else None
+  clusters = cluster_points(np.column_stack([points['SHAPE@X'], points['SHAPE@Y']]), xy_tolerance, weights)
+  log.info(f'Slår sammen {len(points)} punkter innenfor {xy_tolerance} meter til {len(clusters.representatives)} representative punkter')
+
+  result = export_keyed(input_fc, result_fc, 'SourceOID')
+  add_field(result_fc, weight_field, 'DOUBLE')
+  keep = clusters.is_representative()
+  cluster_weight = clusters.weights[clusters.cluster_of_point]
+  weight_by_oid = dict(zip(points['OID@'][keep].tolist(), cluster_weight[keep].tolist()))
+  with arcpy.da.UpdateCursor(result_fc, ['SourceOID', weight_field]) as cursor: # Joined on the ObjectID of the input point
+    for row in cursor:
+      if row[0] not in weight_by_oid:
+        cursor.deleteRow()
+        continue
+      cursor.updateRow([row[0], float(weight_by_oid[row[0]])])
+
+  if representative_field is not None:
+    add_field(input_fc, representative_field, 'LONG')
+    representative_by_oid = dict(zip(points['OID@'].tolist(), points['OID@'][clusters.representative_of_point()].tolist()))
+    with arcpy.da.UpdateCursor(input_fc, ['OID@', representative_field]) as cursor:
+      for row in cursor:
+        cursor.updateRow([row[0], representative_by_oid.get(row[0])])
+
+  log.info(f'Lagret {len(clusters.representatives)} representative punkter i {result_fc}')
+  return result, points['OID@'], clusters
+
 def get_min_row(dataset, fields, value_field):
   """Returns the row in the dataset with the minimum value for one of the fields
   
@@ -1,6 +1,11 @@
-import arcpy
-from .network_dataset import create_network_dataset
-from modules.arcgis.dataset import count_rows
+from __future__ import annotations
+from modules.backend import arcpy
+import numpy as np
+from .network_dataset import create_analysis, location_mappings, location_fields, read_locations, location_rows, location_insert_fields, network_spatial_reference, project_to_network, LOCATION_FIELDS
+from .odmatrix import create_origin_destination_analysis, solve_cost_matrices
+from modules.arcgis.dataset import count_rows, export_dataset, export_keyed, add_field, field_exists
+from modules.local.solvers.pmedian import solve_pmedian
+from modules.local.na.location_allocation import get_capacity
 from modules.object import set_attributes
 from modules.log import Log
 log = Log(arcgis=True)
@@ -10,21 +15,197 @@ defaults = {
   'defaultImpedanceCutoff':15
 }
 
-def create_location_allocation_analysis(options: dict, network: arcpy.nax.NetworkDataset = None) -> arcpy.nax.LocationAllocation:
+def create_location_allocation_analysis(options: dict, network: arcpy.nax.NetworkDataset = None, stage: str = None) -> arcpy.nax.LocationAllocation:
   """Creates and configures a location-allocation analysis 
-     using ELVEG as default network"""
+     using ELVEG as default network. The stage names the caller in the analysis pool."""
 
-  nd = create_network_dataset(network)
-  la = arcpy.nax.LocationAllocation(nd)
-  set_attributes(la, options, defaults)
+  return create_analysis(arcpy.nax.LocationAllocation, options, defaults, network, stage)
+
+def get_native_defaults() -> dict:
+  """Returns the defaults of the native location-allocation (made on use, arcpy is loaded lazily)"""
+  return {
+    'problemType': arcpy.nax.LocationAllocationProblemType.MinimizeImpedance,
+    'timeUnits': arcpy.nax.TimeUnits.Minutes,
+    'facilityCount': 1,
+    'defaultCapacity': 1,
+    'maxIterations': 20,
+    'timeLimit': None
+  }
+
+class NativeLocationAllocation:
+  """Location-allocation solved in-process with the p-median solver on a cutoff limited
+     cost matrix from an OD solve. Has the same load/solve interface as arcpy.nax.LocationAllocation"""
+  def __init__(self, network = None, stage: str = None) -> None:
+    self.network = network
+    self.stage = stage
+    self.inputs = {}
+    self.demand_weights = None # Weights of demand points loaded from coordinates
+
+  def load(self, input_type, features, field_mappings = None, append: bool = False) -> None:
+    self.inputs[input_type] = features
+    if input_type == arcpy.nax.LocationAllocationInputDataType.DemandPoints:
+      self.demand_weights = None
+
+  def solve(self):
+    facilities = self.inputs[arcpy.nax.LocationAllocationInputDataType.Facilities]
+    demand_points = self.inputs[arcpy.nax.LocationAllocationInputDataType.DemandPoints]
+    facility_oids, facility_xy, facility_locations, _ = read_input(facilities, network=self.network)
+    demand_oids, demand_xy, demand_locations, weights = read_input(demand_points, 'Weight', self.network)
+    weights = self.demand_weights if isinstance(demand_points, np.ndarray) else weights
+
+    od_matrix = create_origin_destination_analysis({
+      'travelMode': self.travelMode,
+      'timeUnits': self.timeUnits,
+      'defaultImpedanceCutoff': self.defaultImpedanceCutoff,
+      'defaultDestinationCount': None
+    }, self.network, f'{self.stage or "native"}_location_allocation_od')
+    matrices = solve_cost_matrices(od_matrix, facility_xy, demand_xy, network=self.network,
+                                   origin_locations=facility_locations, destination_locations=demand_locations)
+    if matrices is None:
+      return NativeLocationAllocationResult(facilities, demand_points, None)
+
+    solution = solve_pmedian(matrices[0], self.facilityCount, get_capacity(self), weights, self.maxIterations, self.timeLimit)
+    return NativeLocationAllocationResult(facilities, demand_points, solution, facility_oids, demand_oids)
+
+def read_input(features, weight_field: str = None, network: str = None) -> tuple:
+  """Reads the ObjectIDs, coordinates (in the spatial reference of the network), network
+     locations (see read_locations) and weights of input points in one cursor, so the rows of
+     the cost matrix and the solution are keyed on the ObjectIDs. Coordinates are numbered
+     1..n like their load order.
+
+  Returns:
+    tuple: ObjectIDs, coordinates as a (n, 2) array, network locations (or None) and weights (or None)
+  """
+  if isinstance(features, np.ndarray):
+    return np.arange(1, len(features) + 1), features, None, None
+  fields = location_fields(features)
+  names = list(fields.values()) if fields is not None else []
+  weights = [weight_field] if weight_field is not None and field_exists(features, weight_field) else []
+  rows = arcpy.da.FeatureClassToNumPyArray(features, ['OID@', 'SHAPE@X', 'SHAPE@Y'] + names + weights, null_value=-1,
+                                           spatial_reference=network_spatial_reference(network))
+  return (rows['OID@'].astype(np.int64), np.column_stack([rows['SHAPE@X'], rows['SHAPE@Y']]), read_locations(rows[names]) if names else None,
+          np.where(rows[weight_field] >= 0, rows[weight_field], 1).astype(np.float64) if weights else None)
+
+class NativeLocationAllocationResult:
+  """Result of a native location-allocation solve, mimics the arcpy.nax result object. The
+     solution is keyed on the ObjectIDs of the facilities and demand points (see read_input)."""
+  def __init__(self, facilities: str, demand_points: str, solution, facility_oids: np.ndarray = None, demand_oids: np.ndarray = None) -> None:
+    self.facilities = facilities
+    self.demand_points = demand_points
+    self.solution = solution
+    self.facility_oids = facility_oids
+    self.demand_oids = demand_oids
+    self.solveSucceeded = solution is not None
+
+  def export(self, output_type, output_fc: str) -> None:
+    if output_type == arcpy.nax.LocationAllocationOutputDataType.DemandPoints:
+      # Facility ids are the facility load order, same as the ObjectIDs in a nax solve. The
+      # allocation is joined to the copy on the ObjectID of each demand point
+      facility_by_oid = dict(zip(self.demand_oids.tolist(), (self.solution.allocation + 1).tolist()))
+      export_keyed(self.demand_points, output_fc, 'DemandOID')
+      add_field(output_fc, 'FacilityOID', 'LONG')
+      with arcpy.da.UpdateCursor(output_fc, ['DemandOID', 'FacilityOID']) as cursor:
+        for row in cursor:
+          facility = facility_by_oid.get(row[0], 0)
+          cursor.updateRow([row[0], facility if facility > 0 else None])
+      return
+
+    # The facility type is joined to the copy on the ObjectID of each facility
+    chosen = set(self.facility_oids[self.solution.facilities].tolist())
+    export_keyed(self.facilities, output_fc, 'FacilityInputOID')
+    add_field(output_fc, 'FacilityType', 'LONG')
+    with arcpy.da.UpdateCursor(output_fc, ['FacilityInputOID', 'FacilityType']) as cursor:
+      for row in cursor:
+        cursor.updateRow([row[0], 3 if row[0] in chosen else 0]) # Chosen, same as esriNAFacilityTypeChosen
+
+  def searchCursor(self, output_type, field_names: list):
+    """Returns an iterator over the output rows. Names are the 1-based load order."""
+
+    if output_type == arcpy.nax.LocationAllocationOutputDataType.DemandPoints:
+      names = range(1, len(self.solution.allocation) + 1)
+      columns = {'FacilityOID': [f + 1 if f >= 0 else None for f in self.solution.allocation.tolist()]}
+    else:
+      facility_count = len(self.facility_oids)
+      names = range(1, facility_count + 1)
+      chosen = set(self.solution.facilities.tolist())
+      columns = {'FacilityType': [3 if i in chosen else 0 for i in range(facility_count)]}
+    columns['Name'] = [str(name) for name in names]
+    return iter(list(zip(*[columns[field] for field in field_names])))
+
+  def solverMessages(self, severity = None) -> str:
+    if self.solution is None:
+      return 'Solving the cost matrix for the native location-allocation failed'
+    return (f'{len(self.solution.facilities)} facilities chosen in {self.solution.iterations} iterations '
+            f'({round(self.solution.elapsed, 1)} s), {(self.solution.allocation < 0).sum()} demand points not allocated')
+
+def create_native_location_allocation_analysis(options: dict, network: str = None, stage: str = None) -> NativeLocationAllocation:
+  """Creates and configures a location-allocation analysis solved in-process
+     on a cost matrix from the ELVEG network (default). The OD matrix of the
+     solve is pooled under the stage."""
+
+  la = NativeLocationAllocation(network, stage)
+  set_attributes(la, options, {**defaults, **get_native_defaults()})
   return la
 
+def demand_mappings(la, demand_points, key_field: str = 'SourceOID'):
+  """Returns the field mappings loading the demand points (see location_mappings) with the
+     Name of each demand point read from the key field, if the demand points have it (see
+     deduplicate_points). The solver output is joined to the demand points on the Name,
+     not on the row order. The native solver copies the demand points with their SourceOID."""
+
+  input_type = arcpy.nax.LocationAllocationInputDataType.DemandPoints
+  mappings = location_mappings(la, input_type, demand_points)
+  if isinstance(demand_points, np.ndarray) or not hasattr(la, 'fieldMappings') or not field_exists(demand_points, key_field):
+    return mappings
+  if mappings is None: # Other fields (e.g. Weight) are mapped by name like location_mappings
+    mappings = la.fieldMappings(input_type)
+    names = {field.name for field in arcpy.ListFields(demand_points)}
+    for name, mapping in mappings.items():
+      if name in names and name not in LOCATION_FIELDS:
+        mapping.mappedFieldName = name
+  mappings['Name'].mappedFieldName = key_field
+  return mappings
+
+@log.timed()
 def load_and_solve_location_allocation(la: arcpy.nax.LocationAllocation, facilities: str, demand_points: str):
+  input_type = arcpy.nax.LocationAllocationInputDataType.Facilities
   log.info(f'Loading {count_rows(facilities)} facilities...')
-  la.load(arcpy.nax.LocationAllocationInputDataType.Facilities, facilities, None, False)
+  la.load(input_type, facilities, location_mappings(la, input_type, facilities), False)
 
+  input_type = arcpy.nax.LocationAllocationInputDataType.DemandPoints
   log.info(f'Loading {count_rows(demand_points)} demand points...')
-  la.load(arcpy.nax.LocationAllocationInputDataType.DemandPoints, demand_points, None, False)
+  la.load(input_type, demand_points, demand_mappings(la, demand_points), False)
+
+  log.info(f'Solving location-allocation for {la.facilityCount} facilities...')
+  return la.solve()
+
+@log.timed()
+def load_and_solve_location_allocation_xy(la, facilities_xy, demand_points_xy, demand_weights = None,
+                                          facility_locations: np.ndarray = None, demand_locations: np.ndarray = None, spatial_reference = None):
+  """Loads facilities and demand points from coordinates, with optional demand point weights,
+     and solves. The Name of each input is its 1-based position in the array. Pass the network
+     locations of the inputs (see network_dataset.read_locations) to not locate them again, the
+     native solver locates coordinates in its OD solve. Pass the spatial reference of the
+     coordinates if it can differ from the network (see project_to_network)."""
+
+  network = la.network if isinstance(la, NativeLocationAllocation) else None
+  facilities_xy = project_to_network(np.asarray(facilities_xy, dtype=np.float64), spatial_reference, network)
+  demand_points_xy = project_to_network(np.asarray(demand_points_xy, dtype=np.float64), spatial_reference, network)
+  log.info(f'Loading {len(facilities_xy)} facilities and {len(demand_points_xy)} demand points from coordinates...')
+  if isinstance(la, NativeLocationAllocation):
+    la.load(arcpy.nax.LocationAllocationInputDataType.Facilities, np.asarray(facilities_xy, dtype=np.float64))
+    la.load(arcpy.nax.LocationAllocationInputDataType.DemandPoints, np.asarray(demand_points_xy, dtype=np.float64))
+    la.demand_weights = demand_weights
+  else:
+    fields = ['Name', 'SHAPE@XY'] + location_insert_fields(facility_locations)
+    with la.insertCursor(arcpy.nax.LocationAllocationInputDataType.Facilities, fields, append=False) as cursor:
+      for i, (xy, location) in enumerate(zip(np.asarray(facilities_xy).tolist(), location_rows(facility_locations, len(facilities_xy))), 1):
+        cursor.insertRow([str(i), tuple(xy), *location])
+    weights = np.ones(len(demand_points_xy)) if demand_weights is None else np.asarray(demand_weights)
+    fields = ['Name', 'SHAPE@XY', 'Weight'] + location_insert_fields(demand_locations)
+    with la.insertCursor(arcpy.nax.LocationAllocationInputDataType.DemandPoints, fields, append=False) as cursor:
+      for i, (xy, weight, location) in enumerate(zip(np.asarray(demand_points_xy).tolist(), weights.tolist(), location_rows(demand_locations, len(demand_points_xy))), 1):
+        cursor.insertRow([str(i), tuple(xy), weight, *location])
 
   log.info(f'Solving location-allocation for {la.facilityCount} facilities...')
   return la.solve()
@@ -37,6 +218,23 @@ def get_la_demand_points(result, output_fc):
   log.info(f'Exporting demand points with facility ids...')
   get_result_points(result, output_fc, arcpy.nax.LocationAllocationOutputDataType.DemandPoints)
   
+def expand_demand_allocation(result_fc: str, units_fc: str, output_fc: str, representative_field: str = 'RepresentativeOID',
+                             key_field: str = 'Name') -> None:
+  """Copies the units with the FacilityOID allocated to the weighted demand point that
+     represents each unit (see modules.arcgis.dataset.deduplicate_points). The allocated
+     demand points are joined to the units on the SourceOID of the demand point, read from
+     the key field of the result: the Name of the solver output (see demand_mappings) or
+     the SourceOID copied by write_allocation and the native solver."""
+
+  facility_by_representative = {int(key): facility for key, facility in arcpy.da.SearchCursor(result_fc, [key_field, 'FacilityOID']) if key not in (None, '')}
+
+  log.info(f'Overfører FacilityOID fra {len(facility_by_representative)} vektede punkter til bruksenhetene...')
+  export_dataset(units_fc, output_fc)
+  add_field(output_fc, 'FacilityOID', 'LONG')
+  with arcpy.da.UpdateCursor(output_fc, [representative_field, 'FacilityOID']) as cursor:
+    for row in cursor:
+      cursor.updateRow([row[0], facility_by_representative.get(row[0])])
+
 def get_result_points(result, output_fc, result_type):
   if result.solveSucceeded:
     result.export(result_type, output_fc)
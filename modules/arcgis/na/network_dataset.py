@@ -1,11 +1,164 @@
-import arcpy
-arcpy.env.overwriteOutput = True
+from __future__ import annotations
+import os
+from modules.backend import arcpy
+import numpy as np
+from .pool import pool
+from modules.local.na.network_dataset import LOCATION_FIELDS, LOCATED_FIELDS
+from modules.local.na import cost_cache
+from modules.arcgis.stage_cache import dataset_state
+from modules.log import Log
+log = Log(arcgis=True)
+
+ELVEG = r'D:\Data\Geodata Online\ELVEG_Nettverk.gdb\ELVEG_Nettverk\ELVEG_Nettverk_ND'
+
+_spatial_references = {} # Spatial reference of each network dataset described in this process
+
+def network_path(path:str = None) -> str:
+  """Returns the network dataset path, defaults to ELVEG."""
+  return path if path is not None else ELVEG
+
+def network_version(path: str) -> str:
+  """Returns a version string of a network dataset that changes when the network is edited:
+     the state of each edge and junction source of the network (see dataset_state). The
+     folder of the geodatabase is not used, ArcGIS lock files change it on every open.
+     Edge files outside a geodatabase are versioned by the file itself."""
+
+  if os.path.isfile(path):
+    return cost_cache.network_version(path)
+  description = arcpy.Describe(path)
+  sources = list(getattr(description, 'edgeSources', [])) + list(getattr(description, 'junctionSources', []))
+  feature_dataset = os.path.dirname(path)
+  return f'{path}@' + '|'.join(f'{source.name}:{dataset_state(os.path.join(feature_dataset, source.name))}' for source in sources)
+
+def network_spatial_reference(network: str = None):
+  """Returns the spatial reference of the network dataset, described once pr process"""
+
+  path = network_path(network)
+  if path not in _spatial_references:
+    _spatial_references[path] = arcpy.Describe(path).spatialReference
+  return _spatial_references[path]
+
+def feature_spatial_reference(features) -> int:
+  """Returns the factory code of the spatial reference of the features, passed with coordinates
+     read from them to the loads from coordinates (see project_to_network)"""
+  return arcpy.Describe(features).spatialReference.factoryCode
+
+def project_to_network(xy: np.ndarray, spatial_reference = None, network: str = None) -> np.ndarray:
+  """Returns the coordinates in the spatial reference of the network dataset. Coordinates
+     inserted into an analysis are taken as in the spatial reference of the network, so
+     coordinates in another spatial reference (object or factory code) are projected.
+     Coordinates without a spatial reference (None) are returned as is."""
+
+  if spatial_reference is None or len(xy) == 0:
+    return xy
+  source = arcpy.SpatialReference(spatial_reference) if isinstance(spatial_reference, int) else spatial_reference
+  target = network_spatial_reference(network)
+  same = source.factoryCode == target.factoryCode if source.factoryCode else source.name == target.name
+  if same:
+    return xy
+  log.warning(f'Projiserer {len(xy)} punkter fra {source.name} til {target.name} for nettverket')
+  points = [arcpy.PointGeometry(arcpy.Point(x, y), source).projectAs(target).firstPoint for x, y in np.asarray(xy).tolist()]
+  return np.array([[point.X, point.Y] for point in points], dtype=np.float64)
 
 def create_network_dataset(path:str = None, name:str = None) -> arcpy.nax.NetworkDataset:
-  """Create a network dataset for analysis that defaults to ELVEG."""
+  """Create a network dataset for analysis that defaults to ELVEG.
+     The layer is made once pr network path and process and reused."""
 
   name = name if name is not None else f"Vegnettverk (ELVEG)"
-  path = path if path is not None else r'D:\Data\Geodata Online\ELVEG_Nettverk.gdb\ELVEG_Nettverk\ELVEG_Nettverk_ND'
-  return arcpy.nax.MakeNetworkDatasetLayer(path, name)
+  return pool.network_layer(network_path(path), name)
+
+def create_analysis(solver, options: dict, defaults: dict, network: str = None, stage: str = None):
+  """Returns a configured analysis of the nax solver type from the analysis pool, reused only
+     by later calls from the same stage (see AnalysisPool)"""
+
+  path = network_path(network)
+  create_network_dataset(path)
+  return pool.analysis(path, solver, options, defaults, stage)
+
+def location_fields(features) -> dict:
+  """Returns the field of the features holding each of the LOCATED_FIELDS, the stored names
+     from calculate_locations or the na names (e.g. in exported solver outputs), or None if
+     the features have no network locations"""
+
+  names = set(features.dtype.names or []) if isinstance(features, np.ndarray) else {field.name for field in arcpy.ListFields(features)}
+  fields = {}
+  for name in LOCATED_FIELDS:
+    if LOCATION_FIELDS[name] in names:
+      fields[name] = LOCATION_FIELDS[name]
+    elif name in names:
+      fields[name] = name
+    else:
+      return None
+  return fields
+
+@log.timed()
+def calculate_locations(points_fc: str, network: str = None, travel_mode: str = 'Gange', search_tolerance: str = '5000 Meters') -> np.ndarray:
+  """Calculates the network locations of the points once and stores them in the LOCATION_FIELDS,
+     so every later load of the points (or copies of them) uses them through field mappings
+     (see location_mappings) instead of locating the points again. The distance to the network
+     is kept in SnapDistance as a data quality measure.
+
+  Args:
+    points_fc (str): Full path to the point feature class, updated with the location fields
+    network (str): Optional; Path of the network dataset, default is ELVEG
+    travel_mode (str): Optional; Travel mode deciding which edges the points can be located on
+    search_tolerance (str): Optional; Max distance from a point to the network
+
+  Returns:
+    np.ndarray: The distance to the network of each point, NaN for points not located
+  """
+  log.info(f'Beregner nettverksplassering for {points_fc}...')
+  arcpy.na.CalculateLocations(points_fc, network_path(network), search_tolerance,
+                              source_ID_field=LOCATION_FIELDS['SourceID'], source_OID_field=LOCATION_FIELDS['SourceOID'],
+                              position_field=LOCATION_FIELDS['PosAlong'], side_field=LOCATION_FIELDS['SideOfEdge'],
+                              snap_X_field=LOCATION_FIELDS['SnapX'], snap_Y_field=LOCATION_FIELDS['SnapY'],
+                              distance_field=LOCATION_FIELDS['DistanceToNetworkInMeters'], travel_mode=travel_mode)
+
+  distances = arcpy.da.TableToNumPyArray(points_fc, [LOCATION_FIELDS['DistanceToNetworkInMeters']], null_value=np.nan)
+  distances = distances[LOCATION_FIELDS['DistanceToNetworkInMeters']].astype(np.float64)
+  located = distances[~np.isnan(distances)]
+  if len(located):
+    log.info(f'{len(located)} av {len(distances)} punkter plassert på nettverket, avstand median {np.median(located):.0f} m, maks {located.max():.0f} m')
+  if len(located) < len(distances):
+    log.warning(f'{len(distances) - len(located)} punkter ble ikke plassert på nettverket innenfor {search_tolerance}')
+  return distances
+
+def read_locations(features) -> np.ndarray:
+  """Returns the LOCATED_FIELDS of the features (in cursor order) with the na names, or None
+     if the features have no network locations"""
+
+  fields = location_fields(features)
+  if fields is None:
+    return None
+  data = features if isinstance(features, np.ndarray) else arcpy.da.TableToNumPyArray(features, list(fields.values()), null_value=-1)
+  locations = np.empty(len(data), dtype=[('SourceID', np.int64), ('SourceOID', np.int64), ('PosAlong', np.float64), ('SideOfEdge', np.int64)])
+  for name, field in fields.items():
+    locations[name] = data[field]
+  return locations
+
+def location_mappings(analysis, input_type, features):
+  """Returns field mappings loading the features with their stored network locations, or
+     None (the features are located when loaded) if they have none. Other fields are mapped
+     by name."""
+
+  if isinstance(features, np.ndarray) or not hasattr(analysis, 'fieldMappings'): # Coordinates, or the native solver
+    return None
+  fields = location_fields(features)
+  if fields is None:
+    return None
+
+  mappings = analysis.fieldMappings(input_type, True)
+  names = {field.name for field in arcpy.ListFields(features)}
+  for name, mapping in mappings.items():
+    if name in fields:
+      mapping.mappedFieldName = fields[name]
+    elif name in names and name not in LOCATION_FIELDS:
+      mapping.mappedFieldName = name
+  return mappings
+
+def location_rows(locations: np.ndarray, count: int) -> list:
+  """Returns the values of the LOCATED_FIELDS for each inserted row, or empty values if there are no locations"""
+  return locations[LOCATED_FIELDS].tolist() if locations is not None else [()] * count
 
- 
+def location_insert_fields(locations: np.ndarray) -> list:
+  return LOCATED_FIELDS if locations is not None else []
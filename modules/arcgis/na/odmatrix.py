@@ -1,7 +1,10 @@
-import arcpy
+from __future__ import annotations
+from modules.backend import arcpy
+import numpy as np
+from scipy.sparse import csr_matrix
 from modules.arcgis.dataset import count_rows
-from .network_dataset import create_network_dataset
-from modules.object import set_attributes
+from .network_dataset import create_analysis, network_path, network_version, location_mappings, location_fields, read_locations, location_rows, location_insert_fields, network_spatial_reference, project_to_network
+from modules.local.na.cost_cache import open_cost_cache, cost_context, reach, DestinationSet, cached_cost_matrices
 from modules.log import Log
 log = Log(arcgis=True)
 
@@ -10,22 +13,22 @@ defaults = {
   'defaultImpedanceCutoff':15
 }
 
-def create_origin_destination_analysis(options: dict, network: arcpy.nax.NetworkDataset = None) -> arcpy.nax.OriginDestinationCostMatrix:
+def create_origin_destination_analysis(options: dict, network: arcpy.nax.NetworkDataset = None, stage: str = None) -> arcpy.nax.OriginDestinationCostMatrix:
   """Creates and configures a origin destination matrix analysis 
-     using ELVEG as default network"""
+     using ELVEG as default network. The stage names the caller in the analysis pool."""
   
   log.info('Creating and configuring OD Matrix analysis...')
-  nd = create_network_dataset(network)
-  od_matrix = arcpy.nax.OriginDestinationCostMatrix(nd)
-  set_attributes(od_matrix, options, defaults)
-  return od_matrix
+  return create_analysis(arcpy.nax.OriginDestinationCostMatrix, options, defaults, network, stage)
 
+@log.timed()
 def load_and_solve_od_matrix(od_matrix, origins_fc, destinations_fc):
+  origins = arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins
   log.info(f'Loading {count_rows(origins_fc)} origins...')
-  od_matrix.load(arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins, origins_fc, None, False)
+  od_matrix.load(origins, origins_fc, location_mappings(od_matrix, origins, origins_fc), False)
 
+  destinations = arcpy.nax.OriginDestinationCostMatrixInputDataType.Destinations
   log.info(f'Loading {count_rows(destinations_fc)} as destinations...')
-  od_matrix.load(arcpy.nax.OriginDestinationCostMatrixInputDataType.Destinations, destinations_fc, None, False)
+  od_matrix.load(destinations, destinations_fc, location_mappings(od_matrix, destinations, destinations_fc), False)
   
   log.info(f'Solving OD Matrix finding {od_matrix.defaultDestinationCount} destinations for each origin...')
   return od_matrix.solve()
@@ -36,4 +39,120 @@ def get_od_lines(result, output_fc: str) -> None:
     result.export(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines, output_fc)
   else:
     log.error('Solving the od matrix failed! Message: ')
-    log.error(result.solverMessages(arcpy.nax.MessageSeverity.All))
\ No newline at end of file
+    log.error(result.solverMessages(arcpy.nax.MessageSeverity.All))
+
+def load_od_input(od_matrix, input_type, data, locations: np.ndarray = None, spatial_reference = None, network: str = None) -> None:
+  """Loads a feature class, or point coordinates as a (n, 2) array, as input to the OD matrix.
+     Feature classes are loaded with their stored network locations (see location_mappings),
+     pass the locations of coordinates (see read_locations) to not locate them again, and
+     their spatial reference if it can differ from the network (see project_to_network)."""
+
+  if isinstance(data, np.ndarray):
+    data = project_to_network(data, spatial_reference, network)
+    log.info(f'Loading {len(data)} points from coordinates...')
+    fields = ['Name', 'SHAPE@XY'] + location_insert_fields(locations)
+    with od_matrix.insertCursor(input_type, fields, append=False) as cursor:
+      for i, (xy, location) in enumerate(zip(data.tolist(), location_rows(locations, len(data))), 1):
+        cursor.insertRow([str(i), tuple(xy), *location])
+  else:
+    log.info(f'Loading {count_rows(data)} points...')
+    od_matrix.load(input_type, data, location_mappings(od_matrix, input_type, data), False)
+
+def input_count(data) -> int:
+  return len(data) if isinstance(data, np.ndarray) else count_rows(data)
+
+def input_points(data, locations: np.ndarray = None, network: str = None) -> tuple:
+  """Returns the coordinates (in the spatial reference of the network) and network locations
+     of the inputs from one read: the stored locations of a feature class (see
+     calculate_locations, None if it has none), or the coordinates and locations as given"""
+
+  if isinstance(data, np.ndarray):
+    return data, locations
+  fields = location_fields(data)
+  names = list(fields.values()) if fields is not None else []
+  rows = arcpy.da.FeatureClassToNumPyArray(data, ['SHAPE@X', 'SHAPE@Y'] + names, null_value=-1, spatial_reference=network_spatial_reference(network))
+  return np.column_stack([rows['SHAPE@X'], rows['SHAPE@Y']]), read_locations(rows[names]) if fields is not None else None
+
+def cache_reach(od_matrix, network: str = None) -> tuple:
+  """Returns whether the costs of the analysis can be cached and the reach of an origin (see
+     cost_cache.reach). A distance impedance bounds the reach itself, a time impedance only
+     for walk travel modes (MAX_WALK_SPEED), so other travel modes are not cached."""
+
+  travel_mode = od_matrix.travelMode
+  if isinstance(travel_mode, str):
+    travel_mode = arcpy.nax.GetTravelModes(network_path(network))[travel_mode]
+  distance = travel_mode.impedance == travel_mode.distanceAttributeName
+  if not distance and str(travel_mode.type).upper() != 'WALK':
+    return False, None
+  return True, reach(od_matrix.defaultImpedanceCutoff, od_matrix.distanceUnits if distance else od_matrix.timeUnits, distance)
+
+def solve_cost_matrix(od_matrix, origins_fc, destinations_fc, cache = None, network: str = None) -> csr_matrix:
+  """Solves the OD matrix and returns the cost (in the time units of the analysis) as a
+     sparse origin by destination matrix. Row and column indexes follow the load order
+     of the origins and destinations. Pairs with zero cost are stored as explicit zeros."""
+
+  matrices = solve_cost_matrices(od_matrix, origins_fc, destinations_fc, cache, network)
+  return matrices[0] if matrices is not None else None
+
+@log.timed()
+def solve_cost_matrices(od_matrix, origins_fc, destinations_fc, cache = None, network: str = None,
+                        origin_locations: np.ndarray = None, destination_locations: np.ndarray = None, spatial_reference = None) -> tuple:
+  """Solves the OD matrix and returns sparse origin by destination matrices with the
+     time (time units of the analysis) and distance (distance units of the analysis).
+     Row and column indexes follow the load order of the origins and destinations.
+     Origins and destinations are feature classes or point coordinates as (n, 2) arrays,
+     with optional network locations for coordinates (see load_od_input). Pass the spatial
+     reference of coordinates if it can differ from the network (see project_to_network).
+
+     Caching is opt-in: pass a CostCache, or the path of one (see modules.local.na.cost_cache),
+     to look up the costs first and only solve the origins missing from it. Missing origins
+     are loaded with their network locations like an uncached solve. Only walk travel modes
+     and distance impedances are cached (see cache_reach). The network is the path of the
+     network dataset the analysis was created on, default is ELVEG."""
+
+  if isinstance(origins_fc, np.ndarray):
+    origins_fc = project_to_network(origins_fc, spatial_reference, network)
+  if isinstance(destinations_fc, np.ndarray):
+    destinations_fc = project_to_network(destinations_fc, spatial_reference, network)
+
+  if cache is not None:
+    cacheable, radius = cache_reach(od_matrix, network)
+    if not cacheable:
+      log.warning(f'Kostnadscachen brukes bare for gange og avstand, løser {getattr(od_matrix.travelMode, "name", od_matrix.travelMode)} uten cache')
+    else:
+      cache = open_cost_cache(cache) if isinstance(cache, str) else cache
+      origin_xy, origin_locations = input_points(origins_fc, origin_locations, network)
+      destination_xy, destination_locations = input_points(destinations_fc, destination_locations, network)
+      context = cost_context(network_version(network_path(network)), od_matrix.travelMode, (od_matrix.timeUnits, od_matrix.distanceUnits),
+                             od_matrix.defaultImpedanceCutoff, od_matrix.defaultDestinationCount, cache.quantum)
+      destinations = DestinationSet(destination_xy, radius, cache.quantum)
+      subset = lambda rows: origin_locations[rows] if origin_locations is not None else None
+      matrices = cached_cost_matrices(cache, context, origin_xy, destinations,
+                                      lambda rows: solve_cost_matrices(od_matrix, origin_xy[rows], destination_xy, None, network,
+                                                                       subset(rows), destination_locations))
+      cache.report(log)
+      return matrices
+
+  od_matrix.lineShapeType = arcpy.nax.LineShapeType.NoLine
+  load_od_input(od_matrix, arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins, origins_fc, origin_locations)
+  load_od_input(od_matrix, arcpy.nax.OriginDestinationCostMatrixInputDataType.Destinations, destinations_fc, destination_locations)
+  log.info(f'Solving OD Matrix for all destinations within {od_matrix.defaultImpedanceCutoff} of each origin...')
+  result = od_matrix.solve()
+  if not result.solveSucceeded:
+    log.error('Solving the od matrix failed! Message: ')
+    log.error(result.solverMessages(arcpy.nax.MessageSeverity.All))
+    return None
+
+  lines = np.array(
+    list(result.searchCursor(arcpy.nax.OriginDestinationCostMatrixOutputDataType.Lines, ['OriginOID', 'DestinationOID', 'Total_Time', 'Total_Distance'])),
+    dtype=[('o', np.int64), ('d', np.int64), ('time', np.float64), ('distance', np.float64)]
+  ).reshape(-1)
+  lines.sort(order=['o', 'time'])
+
+  shape = (input_count(origins_fc), input_count(destinations_fc))
+  indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+  np.cumsum(np.bincount(lines['o'] - 1, minlength=shape[0]), out=indptr[1:])
+  return (
+    csr_matrix((lines['time'], lines['d'] - 1, indptr), shape=shape),
+    csr_matrix((lines['distance'], lines['d'] - 1, indptr), shape=shape)
+  )
@@ -0,0 +1,186 @@
+from concurrent.futures import as_completed
+from types import SimpleNamespace
+from modules.backend import arcpy
+import numpy as np
+from .location_allocation import create_location_allocation_analysis, create_native_location_allocation_analysis, load_and_solve_location_allocation_xy, get_capacity
+from .odmatrix import create_origin_destination_analysis, solve_cost_matrices
+from .network_dataset import read_locations, network_spatial_reference
+from modules.arcgis.dataset import export_keyed, add_field, field_exists
+from modules.local.partition import Partition, share_facilities, seam_candidates
+from modules.parallel import create_process_pool
+from modules.log import Log
+log = Log(arcgis=True)
+
+MAX_TILE_POINTS = 20000 # Demand points pr tile, sets the peak memory of a tile solve
+
+_la_analysis = None # Location-allocation analysis in each worker process
+
+def init_tile_worker(options: dict, native: bool) -> None:
+  """Creates the location-allocation analysis once in each worker process"""
+  global _la_analysis
+  _la_analysis = create_native_location_allocation_analysis(options, stage='tile') if native else create_location_allocation_analysis(options, stage='tile')
+
+def solve_tile(tile: tuple) -> tuple:
+  """Solves the location-allocation of one tile. Runs in a worker process.
+
+  Args:
+    tile (tuple): Tile index, facility coordinates, demand point coordinates, demand weights, number of facilities
+                  and the network locations of the facilities and demand points (or None)
+
+  Returns:
+    tuple: Tile index, the index of the facility (in the tile) each demand point is allocated to (-1 if not
+      allocated) and the solver messages if the solve failed, else None
+  """
+  index, facilities_xy, demand_xy, weights, facility_count, facility_locations, demand_locations = tile
+  _la_analysis.facilityCount = facility_count
+  result = load_and_solve_location_allocation_xy(_la_analysis, facilities_xy, demand_xy, weights, facility_locations, demand_locations)
+
+  allocation = np.full(len(demand_xy), -1, dtype=np.int64)
+  if not result.solveSucceeded:
+    return index, allocation, str(result.solverMessages(arcpy.nax.MessageSeverity.All))
+  for name, facility_id in result.searchCursor(arcpy.nax.LocationAllocationOutputDataType.DemandPoints, ['Name', 'FacilityOID']):
+    if facility_id is not None:
+      allocation[int(name) - 1] = facility_id - 1
+  return index, allocation, None
+
+def read_xy_weights(points_fc: str, weight_field: str = 'Weight') -> tuple:
+  """Returns the coordinates (in the spatial reference of the network, they are only used in
+     the solves), weights (default one) and ObjectIDs of the points"""
+  fields = ['OID@', 'SHAPE@X', 'SHAPE@Y'] + ([weight_field] if field_exists(points_fc, weight_field) else [])
+  points = arcpy.da.FeatureClassToNumPyArray(points_fc, fields, null_value=1, spatial_reference=network_spatial_reference())
+  weights = points[weight_field].astype(np.float64) if len(fields) > 3 else np.ones(len(points))
+  return np.column_stack([points['SHAPE@X'], points['SHAPE@Y']]), weights, points['OID@']
+
+def repair_seams(options: dict, demand_xy, weights, allocation, facilities_xy, chosen, tile_of_demand, facility_tile, capacity = None,
+                 facility_locations: np.ndarray = None, demand_locations: np.ndarray = None) -> int:
+  """Moves demand points near tile seams to a chosen facility in another tile when it is
+     closer by the network and (with a capacity) has room for the demand weight. The points
+     are loaded with their network locations if given (see read_locations).
+
+  Returns:
+    int: Number of demand points moved
+  """
+  chosen_xy = facilities_xy[chosen]
+  candidates = seam_candidates(demand_xy, tile_of_demand, chosen_xy, facility_tile[chosen])
+  if len(candidates) == 0:
+    return 0
+
+  log.info(f'Sjekker {len(candidates)} punkter langs flisgrensene...')
+  od_matrix = create_origin_destination_analysis({
+    'travelMode': options.get('travelMode', 'Gange'),
+    'timeUnits': options.get('timeUnits', arcpy.nax.TimeUnits.Minutes),
+    'defaultImpedanceCutoff': options.get('defaultImpedanceCutoff', 15),
+    'defaultDestinationCount': None
+  }, stage='seam_repair')
+  subset = lambda locations, rows: locations[rows] if locations is not None else None
+  matrices = solve_cost_matrices(od_matrix, demand_xy[candidates], chosen_xy, origin_locations=subset(demand_locations, candidates),
+                                 destination_locations=subset(facility_locations, chosen))
+  if matrices is None:
+    return 0
+  costs = matrices[0]
+
+  chosen_index = np.full(len(facilities_xy), -1, dtype=np.int64)
+  chosen_index[chosen] = np.arange(len(chosen))
+  load = np.bincount(chosen_index[allocation[allocation >= 0]], weights[allocation >= 0], len(chosen))
+  moved = 0
+  for row, point in enumerate(candidates.tolist()):
+    start, end = costs.indptr[row], costs.indptr[row + 1]
+    if start == end:
+      continue
+    columns, values = costs.indices[start:end], costs.data[start:end]
+    current = chosen_index[allocation[point]] if allocation[point] >= 0 else -1
+    current_cost = values[columns == current][0] if (columns == current).any() else np.inf
+    best = int(np.argmin(values))
+    target = int(columns[best])
+    if target == current or values[best] >= current_cost:
+      continue
+    if capacity is not None and load[target] + weights[point] > capacity:
+      continue
+
+    if current >= 0:
+      load[current] -= weights[point]
+    load[target] += weights[point]
+    allocation[point] = chosen[target]
+    moved += 1
+  return moved
+
+def solve_partitioned_location_allocation(options: dict, facilities_fc: str, demand_fc: str, facility_count: int,
+                                          max_points: int = MAX_TILE_POINTS, workers: int = None, native: bool = False, repair: bool = True) -> np.ndarray:
+  """Solves a location-allocation too large for one solve as independent tiles. The demand
+     points are split into tiles of at most max_points points (see modules.local.partition),
+     each tile gets a share of the facilities in proportion to its demand weight, and the
+     tiles are solved in a process pool. A repair pass then moves points near the tile seams
+     to a closer chosen facility in a neighbouring tile.
+
+  Args:
+    options (dict): Location-allocation analysis properties
+    facilities_fc (str): Candidate facilities
+    demand_fc (str): Demand points, with an optional Weight field
+    facility_count (int): Number of facilities to choose in total
+    max_points (int): Optional; Max number of demand points pr tile
+    workers (int): Optional; Number of worker processes, default is the number of cpus - 1
+    native (bool): Optional; Solve the tiles in-process with the p-median solver
+    repair (bool): Optional; Run the seam repair pass
+
+  Returns:
+    tuple: Index of the facility (row in facilities_fc) each demand point is allocated to (-1 if not allocated),
+      the ObjectID of each demand point and the error messages of the tiles that failed (empty if all tiles
+      were solved). The allocation is None if a tile failed, a partial allocation must not be used (or cached)
+      as the result
+  """
+  demand_xy, weights, demand_oids = read_xy_weights(demand_fc)
+  facilities_xy, _, _ = read_xy_weights(facilities_fc)
+  partition = Partition(demand_xy, max_points)
+  tile_of_facility = partition.tile_of(facilities_xy)
+  demand_groups = partition.groups()
+  facility_groups = partition.groups(tile_of_facility)
+
+  tile_weights = np.array([weights[rows].sum() for rows in demand_groups])
+  shares = share_facilities(tile_weights, facility_count, [len(rows) for rows in facility_groups])
+  log.info(f'Deler {len(demand_xy)} demand points i {len(shares)} fliser med {shares.tolist()} roder')
+
+  facility_locations, demand_locations = read_locations(facilities_fc), read_locations(demand_fc) # See calculate_locations
+  subset = lambda locations, rows: locations[rows] if locations is not None else None
+  tiles = [(i, facilities_xy[facility_groups[i]], demand_xy[demand_groups[i]], weights[demand_groups[i]], int(shares[i]),
+            subset(facility_locations, facility_groups[i]), subset(demand_locations, demand_groups[i]))
+           for i in range(len(shares)) if shares[i] > 0 and len(demand_groups[i]) > 0]
+  allocation = np.full(len(demand_xy), -1, dtype=np.int64)
+  errors = []
+  with create_process_pool(workers, init_tile_worker, (options, native)) as pool:
+    futures = {pool.submit(solve_tile, tile): tile[0] for tile in tiles}
+    for future in as_completed(futures):
+      try:
+        index, tile_allocation, messages = future.result()
+      except Exception as e:
+        messages, index = str(e), futures[future]
+      if messages is not None:
+        log.error(f'Flis {index} feilet: {messages}')
+        errors.append(f'Flis {index}: {messages}')
+        continue
+      allocated = tile_allocation >= 0
+      allocation[demand_groups[index][allocated]] = facility_groups[index][tile_allocation[allocated]]
+
+  if errors:
+    return None, demand_oids, errors
+
+  if repair:
+    chosen = np.unique(allocation[allocation >= 0])
+    capacity = get_capacity(SimpleNamespace(**{'problemType': None, 'defaultCapacity': None, **options}))
+    moved = repair_seams(options, demand_xy, weights, allocation, facilities_xy, chosen, partition.tile_of_point, tile_of_facility, capacity,
+                         facility_locations, demand_locations)
+    log.info(f'Flyttet {moved} punkter langs flisgrensene til en nærmere rode')
+
+  return allocation, demand_oids, errors
+
+def write_allocation(demand_fc: str, output_fc: str, allocation: np.ndarray, demand_oids: np.ndarray) -> None:
+  """Copies the demand points with the FacilityOID (1-based facility row) of each point,
+     like the DemandPoints output of a location-allocation solve. The allocation is joined
+     to the copy on the ObjectID of the demand point (see export_keyed)."""
+
+  facility_by_oid = dict(zip(demand_oids.tolist(), (allocation + 1).tolist()))
+  export_keyed(demand_fc, output_fc, 'DemandOID')
+  add_field(output_fc, 'FacilityOID', 'LONG')
+  with arcpy.da.UpdateCursor(output_fc, ['DemandOID', 'FacilityOID']) as cursor:
+    for row in cursor:
+      facility = facility_by_oid.get(row[0], 0)
+      cursor.updateRow([row[0], facility if facility > 0 else None])
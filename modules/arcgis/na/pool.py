@@ -0,0 +1,139 @@
+import inspect
+from modules.backend import arcpy
+from modules.object import set_attributes
+from modules.log import Log
+log = Log(arcgis=True)
+
+# Input data types cleared before a pooled analysis is handed out again
+input_types = {
+  'LocationAllocation': lambda: [arcpy.nax.LocationAllocationInputDataType.Facilities, arcpy.nax.LocationAllocationInputDataType.DemandPoints],
+  'OriginDestinationCostMatrix': lambda: [arcpy.nax.OriginDestinationCostMatrixInputDataType.Origins, arcpy.nax.OriginDestinationCostMatrixInputDataType.Destinations],
+  'Route': lambda: [arcpy.nax.RouteInputDataType.Stops]
+}
+
+class AnalysisPool:
+  """Process level cache of network dataset layers, travel modes and configured solver objects.
+
+  Analyses are keyed by (stage, network path, solver type, travel mode, cutoff). Every
+  writable property of an analysis is recorded when it is created, and a pooled analysis has
+  all its properties restored, its loaded inputs cleared and is reconfigured each time it is
+  handed out. Properties set directly by the previous user (e.g. lineShapeType or
+  facilityCount) do not carry over. An analysis is only valid until the next create_* call
+  with the same key, so each caller that keeps an analysis while another one is made (e.g.
+  the split and the create location-allocation) passes its own stage. The pool is cleared at
+  the start of each tool run (see clear).
+
+  Attributes:
+    hits (dict): Number of reuses by kind (layer, travel_mode, analysis)
+    misses (dict): Number of creations by kind (layer, travel_mode, analysis)
+  """
+  def __init__(self) -> None:
+    self.layers = {}
+    self.travel_modes = {}
+    self.analyses = {}
+    self.hits = {'layer': 0, 'travel_mode': 0, 'analysis': 0}
+    self.misses = {'layer': 0, 'travel_mode': 0, 'analysis': 0}
+
+  def network_layer(self, path: str, name: str):
+    """Returns a network dataset layer, made once pr network path"""
+
+    if path in self.layers:
+      self.hits['layer'] += 1
+    else:
+      self.misses['layer'] += 1
+      log.info(f'Lager nettverkslag for {path}...')
+      self.layers[path] = arcpy.nax.MakeNetworkDatasetLayer(path, name)
+    return self.layers[path]
+
+  def travel_mode(self, path: str, travel_mode):
+    """Returns the resolved travel mode object for a travel mode name"""
+
+    if not isinstance(travel_mode, str):
+      return travel_mode
+
+    key = (path, travel_mode)
+    if key in self.travel_modes:
+      self.hits['travel_mode'] += 1
+    else:
+      self.misses['travel_mode'] += 1
+      self.travel_modes[key] = arcpy.nax.GetTravelModes(self.layers[path])[travel_mode]
+    return self.travel_modes[key]
+
+  def analysis(self, path: str, solver, options: dict, defaults: dict, stage: str = None):
+    """Returns a configured analysis of the solver type (e.g. arcpy.nax.Route) on the network
+
+    Args:
+      path (str): Full path to the network dataset
+      solver (type): The nax solver class
+      options (dict): Analysis properties
+      defaults (dict): Default analysis properties
+      stage (str): Optional; Name of the caller, analyses of other stages are never handed out to it
+    """
+    attributes = {**defaults, **options}
+    key = (stage, path, solver.__name__, str(attributes.get('travelMode')), attributes.get('defaultImpedanceCutoff'))
+    if 'travelMode' in attributes:
+      attributes['travelMode'] = self.travel_mode(path, attributes['travelMode'])
+
+    if key in self.analyses:
+      self.hits['analysis'] += 1
+      entry = self.analyses[key]
+      restore_attributes(entry['analysis'], entry['baseline']) # Undo every property set by the previous user
+      clear_inputs(entry['analysis'], solver.__name__)
+    else:
+      self.misses['analysis'] += 1
+      analysis = solver(self.layers[path])
+      entry = {'analysis': analysis, 'baseline': writable_attributes(analysis)}
+      self.analyses[key] = entry
+
+    return set_attributes(entry['analysis'], attributes)
+
+  def clear(self) -> None:
+    """Drops the pooled analyses and network layers, so a tool run never gets an analysis
+       (or a layer of a network dataset edited since) from an earlier run in the process.
+       Travel modes are resolved again from the new layers."""
+
+    self.layers.clear()
+    self.travel_modes.clear()
+    self.analyses.clear()
+
+  def statistics(self) -> dict:
+    return {kind: {'hits': self.hits[kind], 'misses': self.misses[kind]} for kind in self.hits}
+
+  def report(self) -> None:
+    for kind, counts in self.statistics().items():
+      log.info(f'Analysepool {kind}: {counts["hits"]} gjenbrukt, {counts["misses"]} opprettet')
+
+def writable_attributes(analysis) -> dict:
+  """Returns the values of the writable properties of an analysis"""
+
+  values = {}
+  for name in dir(type(analysis)):
+    descriptor = getattr(type(analysis), name, None)
+    if name.startswith('_') or not inspect.isdatadescriptor(descriptor):
+      continue
+    if isinstance(descriptor, property) and descriptor.fset is None:
+      continue
+    try:
+      values[name] = getattr(analysis, name)
+    except Exception: # Properties that can not be read before the analysis is solved
+      continue
+  return values
+
+def restore_attributes(analysis, values: dict) -> None:
+  """Sets the properties that differ from the recorded values back to them"""
+
+  for name, value in values.items():
+    try:
+      if getattr(analysis, name) != value:
+        setattr(analysis, name, value)
+    except Exception as e:
+      log.warning(f'Kunne ikke tilbakestille {name} på gjenbrukt analyse: {e}')
+
+def clear_inputs(analysis, solver_name: str) -> None:
+  """Clears the loaded inputs of an analysis by opening an empty, non-appending insert cursor"""
+
+  for input_type in input_types.get(solver_name, lambda: [])():
+    with analysis.insertCursor(input_type, ['Name'], append=False):
+      pass
+
+pool = AnalysisPool()
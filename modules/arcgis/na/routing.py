@@ -1,7 +1,8 @@
-import arcpy
-from .network_dataset import create_network_dataset
+from __future__ import annotations
+from modules.backend import arcpy
+import numpy as np
+from .network_dataset import create_analysis, location_mappings, location_rows, location_insert_fields, project_to_network
 from modules.arcgis.dataset import count_rows
-from modules.object import set_attributes
 from modules.log import Log
 log = Log(arcgis=True)
 
@@ -10,19 +11,17 @@ defaults = {
   'findBestSequence': True
 }
 
-def create_route_analysis(options: dict, network: arcpy.nax.NetworkDataset = None) -> arcpy.nax.Route:
+def create_route_analysis(options: dict, network: arcpy.nax.NetworkDataset = None, stage: str = None) -> arcpy.nax.Route:
   """Creates and configures a route analysis 
-     using ELVEG as default network"""
+     using ELVEG as default network. The stage names the caller in the analysis pool."""
 
-  nd = create_network_dataset(network)
-  route = arcpy.nax.Route(nd)
-  set_attributes(route, options, defaults)
-  return route
+  return create_analysis(arcpy.nax.Route, options, defaults, network, stage)
 
 
+@log.timed()
 def load_and_solve_route(route: arcpy.nax.Route, stops_fc: str):
   log.info(f'Loading {count_rows(stops_fc)} origins...')
-  route.load(arcpy.nax.RouteInputDataType.Stops, stops_fc, None, False)
+  route.load(arcpy.nax.RouteInputDataType.Stops, stops_fc, location_mappings(route, arcpy.nax.RouteInputDataType.Stops, stops_fc), False)
 
   log.info(f'Solving route with {count_rows(stops_fc)} stops...')
   return route.solve() 
@@ -32,4 +31,20 @@ def get_routes_cursor(result):
     return result.searchCursor(arcpy.nax.RouteOutputDataType.Routes, ['Total_Minutes', 'Total_Kilometers'])
   else:
     log.warning(f'Not able to find a route for the provided stops')
-    log.error(result.solverMessages(arcpy.nax.MessageSeverity.All))
\ No newline at end of file
+    log.error(result.solverMessages(arcpy.nax.MessageSeverity.All))
+
+@log.timed()
+def load_and_solve_route_xy(route: arcpy.nax.Route, stops_xy, locations: np.ndarray = None, spatial_reference = None):
+  """Loads stops from coordinates with an insert cursor and solves the route. No feature class
+     or selection is needed. Pass the network locations of the stops (see
+     network_dataset.read_locations) to not locate them again, and the spatial reference of the
+     coordinates if it can differ from the network (see project_to_network)."""
+
+  stops_xy = project_to_network(np.asarray(stops_xy, dtype=np.float64), spatial_reference)
+  fields = ['Name', 'SHAPE@XY'] + location_insert_fields(locations)
+  with route.insertCursor(arcpy.nax.RouteInputDataType.Stops, fields, append=False) as cursor:
+    for i, (xy, location) in enumerate(zip(stops_xy, location_rows(locations, len(stops_xy))), 1):
+      cursor.insertRow([str(i), (float(xy[0]), float(xy[1])), *location])
+
+  log.info(f'Solving route with {len(stops_xy)} stops...')
+  return route.solve()
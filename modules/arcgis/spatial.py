@@ -0,0 +1,115 @@
+from modules.backend import arcpy
+import numpy as np
+import shapely
+from modules.local.spatial import PointAssignment, NearestNeighborStatistics, assign_points_to_polygons, average_nearest_neighbor
+from modules.local.voronoi import area_polygons
+from modules.arcgis.dataset import create_featureclass, add_field, export_dataset, read_table, update_table
+from modules.log import Log
+log = Log(arcgis=True)
+
+def read_points(points_fc: str, fields: list = None) -> np.ndarray:
+  """Reads the object ids, coordinates and optional attributes of a point feature class
+
+  Returns:
+    np.ndarray: Structured array with OID@, SHAPE@X, SHAPE@Y and the fields
+  """
+  fields = fields if fields is not None else []
+  return read_table(points_fc, ['OID@', 'SHAPE@X', 'SHAPE@Y'] + fields)
+
+def read_polygons(polygons_fc: str, fields: list = None) -> tuple:
+  """Reads the polygons of a feature class as shapely geometries
+
+  Returns:
+    tuple: Array of object ids, array of shapely polygons and a list of attribute rows
+  """
+  fields = fields if fields is not None else []
+  rows = [row for row in arcpy.da.SearchCursor(polygons_fc, ['OID@', 'SHAPE@WKB'] + fields)]
+  oids = np.array([row[0] for row in rows], dtype=np.int64)
+  polygons = shapely.from_wkb([bytes(row[1]) for row in rows])
+  return oids, polygons, [row[2:] for row in rows]
+
+def assign_points_to_areas(points_fc: str, areas_fc: str) -> tuple:
+  """Reads all points and areas once and assigns each point to the area it is within
+
+  Returns:
+    tuple: The points (see read_points) and the PointAssignment keyed by area OBJECTID
+  """
+  log.info(f'Tilordner punkter i {points_fc} til områder i {areas_fc}...')
+  points = read_points(points_fc)
+  oids, polygons, _ = read_polygons(areas_fc)
+  assignment = assign_points_to_polygons(np.column_stack([points['SHAPE@X'], points['SHAPE@Y']]), polygons, oids)
+  log.info(f'{int(assignment.counts.sum())} av {len(points)} punkter ligger i et av {len(oids)} områder')
+  return points, assignment
+
+def write_polygons(output_fc: str, ids: np.ndarray, polygons: np.ndarray, id_field: str, template_fc: str) -> None:
+  """Writes shapely polygons and their ids to a new feature class with the spatial reference
+     of the template. Pass ids and id_field as None to write the polygons only."""
+
+  spatial_reference = arcpy.Describe(template_fc).spatialReference
+  create_featureclass(output_fc, 'POLYGON', spatial_reference.factoryCode, delete_existing=True)
+  wkbs = shapely.to_wkb(polygons).tolist()
+  if id_field is None:
+    with arcpy.da.InsertCursor(output_fc, ['SHAPE@']) as cursor:
+      for wkb in wkbs:
+        cursor.insertRow([arcpy.FromWKB(bytearray(wkb), spatial_reference)])
+    return
+
+  add_field(output_fc, id_field, 'TEXT')
+  with arcpy.da.InsertCursor(output_fc, [id_field, 'SHAPE@']) as cursor:
+    for area_id, wkb in zip(ids.tolist(), wkbs):
+      cursor.insertRow([str(area_id), arcpy.FromWKB(bytearray(wkb), spatial_reference)])
+
+def create_area_polygons(points_fc: str, aoi_fc: str, output_fc: str, id_field: str = 'AreaID') -> None:
+  """Creates single part polygons of the area of each id from Thiessen polygons of the
+     points clipped to the AOI. Replaces CreateThiessenPolygons, Dissolve (SINGLE_PART)
+     and Clip with one in-memory pass (see modules.local.voronoi)."""
+
+  points = read_points(points_fc, [id_field])
+  _, aoi, _ = read_polygons(aoi_fc)
+  log.info(f'Lager polygoner for {len(np.unique(points[id_field]))} områder fra {len(points)} punkter...')
+  ids, polygons = area_polygons(np.column_stack([points['SHAPE@X'], points['SHAPE@Y']]), points[id_field], aoi)
+  write_polygons(output_fc, ids, polygons, id_field, points_fc)
+
+def write_area_points(points_fc: str, areas_fc: str, output_fc: str, id_field: str = 'AreaID') -> int:
+  """Copies the points with the id of the area they are within (empty for points outside
+     all areas), e.g. the units of the areas as input to update_areas
+
+  Returns:
+    int: The number of points outside all areas
+  """
+  export_dataset(points_fc, output_fc)
+  points = read_points(output_fc) # The area of each copied point is found from its own coordinates
+  _, polygons, rows = read_polygons(areas_fc, [id_field])
+  point_area = assign_points_to_polygons(np.column_stack([points['SHAPE@X'], points['SHAPE@Y']]), polygons).point_area
+  area_ids = np.array([str(row[0]) for row in rows] + [''])
+
+  table = np.empty(len(points), dtype=[('OID@', np.int64), (id_field, 'U64')])
+  table['OID@'] = points['OID@']
+  table[id_field] = area_ids[point_area]
+  update_table(output_fc, table)
+  return int((point_area < 0).sum())
+
+def nearest_neighbor_statistics(points_fc: str, area_fc: str = None, distance_field: str = None) -> NearestNeighborStatistics:
+  """Average nearest neighbour statistics of the points (see modules.local.spatial.average_nearest_neighbor)
+     in place of arcpy.stats.AverageNearestNeighbor with EUCLIDEAN_DISTANCE
+
+  Args:
+    points_fc (str): The points
+    area_fc (str): Optional; Polygons (e.g. the AOI) whose area is the study area, default is
+      the rectangle enclosing the points
+    distance_field (str): Optional; Field to write the distance from each point to its nearest neighbour to
+
+  Returns:
+    NearestNeighborStatistics: The statistics and distances
+  """
+  points = read_points(points_fc)
+  area = shapely.union_all(read_polygons(area_fc)[1]) if area_fc is not None else None
+  statistics = average_nearest_neighbor(np.column_stack([points['SHAPE@X'], points['SHAPE@Y']]), area)
+  log.info(f'Gjennomsnittlig nærmeste nabo: forhold {round(statistics.ratio, 3)}, z-verdi {round(statistics.z_score, 2)}')
+
+  if distance_field is not None:
+    distances = np.empty(len(points), dtype=[('OID@', np.int64), (distance_field, np.float64)])
+    distances['OID@'] = points['OID@']
+    distances[distance_field] = statistics.distances[:, 0]
+    update_table(points_fc, distances)
+  return statistics
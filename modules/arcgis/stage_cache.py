@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import time
+from modules.backend import arcpy
+from modules.log import Log
+log = Log(arcgis=True)
+
+def dataset_state(dataset: str) -> str:
+  """Returns the row count, extent and (with editor tracking) last edit date of a dataset on
+     disk. The modification time of the folder is not used: ArcGIS lock files change it on
+     every open, and an edit in place of a geodatabase table may leave it unchanged."""
+
+  if os.path.isfile(dataset): # Shapefiles and other single file datasets
+    stat = os.stat(dataset)
+    return f'{stat.st_mtime_ns}:{stat.st_size}'
+
+  description = arcpy.Describe(dataset)
+  state = [arcpy.management.GetCount(dataset)[0]]
+  extent = getattr(description, 'extent', None)
+  if extent is not None:
+    state.append(f'{extent.XMin:.3f}:{extent.YMin:.3f}:{extent.XMax:.3f}:{extent.YMax:.3f}')
+  edited_field = getattr(description, 'lastEditedAtFieldName', None) if getattr(description, 'editorTrackingEnabled', False) else None
+  if edited_field:
+    with arcpy.da.SearchCursor(dataset, [edited_field], sql_clause=(None, f'ORDER BY {edited_field} DESC')) as cursor:
+      state.append(str(next(cursor, [None])[0]))
+  return ':'.join(state)
+
+def source_fingerprint(dataset, query: str = None) -> str:
+  """Returns a fingerprint of an input dataset. Datasets stored on disk are identified by
+     the path, the query and the state of the dataset itself (see dataset_state), other
+     datasets (layers that may have a selection, memory) by a hash of their object ids
+     and coordinates."""
+
+  if isinstance(dataset, str):
+    workspace = dataset
+    while workspace and not os.path.exists(workspace) and os.path.dirname(workspace) != workspace:
+      workspace = os.path.dirname(workspace)
+    if workspace and os.path.exists(workspace):
+      return f'{dataset}@{dataset_state(dataset)}|{query}'
+
+  digest = hashlib.sha1(str(query).encode())
+  with arcpy.da.SearchCursor(dataset, ['OID@', 'SHAPE@XY'], query) as cursor:
+    for oid, xy in cursor:
+      digest.update(f'{oid}:{xy[0]:.3f}:{xy[1]:.3f};'.encode())
+  return digest.hexdigest()
+
+class StageCache:
+  """Cache of pipeline stage results in a file geodatabase, keyed by a hash of the stage
+     name and its inputs (source fingerprints, queries, parameters and upstream stage keys).
+
+  A stage writes its output feature classes and may return a json serializable value (e.g.
+  a count). Stages that did not write all their outputs (e.g. a failed solve) are not
+  cached. When a stage is run again with the same inputs the cached outputs are copied to
+  the output paths and the stored value is returned instead of running the stage.
+
+  Args:
+    workspace (str): Folder for the cache geodatabase and the stage records
+    enabled (bool): Optional; Run every stage when False
+
+  Attributes:
+    skipped (list): (stage, seconds saved) for each stage reused from the cache
+    ran (list): (stage, seconds) for each stage run
+  """
+  def __init__(self, workspace: str, enabled: bool = True) -> None:
+    self.workspace = workspace
+    self.gdb = os.path.join(workspace, 'stages.gdb')
+    self.enabled = enabled
+    self.skipped = []
+    self.ran = []
+    if enabled and not arcpy.Exists(self.gdb):
+      os.makedirs(workspace, exist_ok=True)
+      arcpy.management.CreateFileGDB(workspace, 'stages.gdb')
+
+  def key(self, stage: str, inputs: dict) -> str:
+    return hashlib.sha1(json.dumps([stage, inputs], sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+  def run(self, stage: str, inputs: dict, outputs: list, function) -> tuple:
+    """Runs a stage unless its outputs are cached
+
+    Args:
+      stage (str): Name of the stage
+      inputs (dict): Everything the stage result depends on, include the keys of upstream stages
+      outputs (list): Paths of the feature classes the stage writes (or updates in place)
+      function (function): Runs the stage, returns an optional json serializable value
+
+    Returns:
+      tuple: Stage key (to pass on to downstream stages) and the value of the stage
+    """
+    key = self.key(stage, inputs)
+    record_path = os.path.join(self.workspace, f'{stage}_{key}.json')
+    cached = [os.path.join(self.gdb, f'{stage}_{key}_{i}') for i in range(len(outputs))]
+
+    if self.enabled and os.path.exists(record_path) and all(arcpy.Exists(fc) for fc in cached):
+      with open(record_path, encoding='utf-8') as f:
+        record = json.load(f)
+      with log.span(f'{stage} (mellomlager)'):
+        for source, output in zip(cached, outputs):
+          arcpy.management.CopyFeatures(source, output)
+      self.skipped.append((stage, record['elapsed']))
+      log.info(f'Gjenbruker {stage} fra mellomlager (sparte {round(record["elapsed"], 1)} s)')
+      return key, record['value']
+
+    start = time.perf_counter()
+    with log.span(stage):
+      value = function()
+    elapsed = time.perf_counter() - start
+    self.ran.append((stage, elapsed))
+
+    if self.enabled and all(arcpy.Exists(output) for output in outputs):
+      for output, target in zip(outputs, cached):
+        arcpy.management.CopyFeatures(output, target)
+      with open(record_path, 'w', encoding='utf-8') as f:
+        json.dump({'stage': stage, 'inputs': inputs, 'value': value, 'elapsed': elapsed}, f, ensure_ascii=False, default=str)
+    return key, value
+
+  def report(self) -> None:
+    if not self.enabled:
+      return
+    saved = sum(seconds for _, seconds in self.skipped)
+    skipped = ', '.join(stage for stage, _ in self.skipped) or 'ingen'
+    log.info(f'Gjenbrukte steg: {skipped}. Kjørte {len(self.ran)} steg, sparte {round(saved, 1)} s')
@@ -0,0 +1,58 @@
+"""
+Lazy access to arcpy. arcpy is only installed with ArcGIS Pro and takes seconds to import,
+so modules use the arcpy proxy from here instead of importing it. The real module is
+imported the first time one of its attributes is used, and the shared environment
+settings are applied once. Modules can then be imported, and the local code run, in
+worker processes and on machines without ArcGIS.
+
+Usage:
+  from modules.backend import arcpy
+"""
+
+import importlib
+import importlib.util
+
+class LazyModule:
+  """Module proxy that imports the module on first attribute access
+
+  Args:
+    name (str): Name of the module
+    setup (function): Optional; Called with the module once after it is imported
+  """
+  def __init__(self, name: str, setup = None) -> None:
+    self.__dict__['_name'] = name
+    self.__dict__['_setup'] = setup
+    self.__dict__['_module'] = None
+    self.__dict__['_available'] = None
+
+  def load(self):
+    """Imports the module if not already imported and returns it"""
+    if self._module is None:
+      module = importlib.import_module(self._name)
+      if self._setup is not None:
+        self._setup(module)
+      self.__dict__['_module'] = module
+    return self._module
+
+  def loaded(self) -> bool:
+    return self._module is not None
+
+  def available(self) -> bool:
+    """Returns True if the module can be imported, without importing it"""
+    if self._available is None:
+      self.__dict__['_available'] = self._module is not None or importlib.util.find_spec(self._name) is not None
+    return self._available
+
+  def __getattr__(self, attribute: str):
+    return getattr(self.load(), attribute)
+
+  def __setattr__(self, attribute: str, value) -> None:
+    setattr(self.load(), attribute, value)
+
+  def __repr__(self) -> str:
+    return f'<lazy module {self._name!r} ({"loaded" if self.loaded() else "not loaded"})>'
+
+def setup_arcpy(module) -> None:
+  module.env.overwriteOutput = True
+
+arcpy = LazyModule('arcpy', setup_arcpy)
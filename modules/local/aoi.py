@@ -0,0 +1,68 @@
+import numpy as np
+import shapely
+from scipy import ndimage
+
+CELLS_PR_BUFFER = 40 # Default cell size is the buffer distance divided by this
+
+def rasterize_points(xy: np.ndarray, cell_size: float, margin: float) -> tuple:
+  """Marks the grid cells containing at least one point
+
+  Returns:
+    tuple: Boolean mask (rows from south to north) and the (x, y) of its lower left corner
+  """
+  origin = xy.min(axis=0) - margin
+  shape = np.ceil((xy.max(axis=0) + margin - origin) / cell_size).astype(np.int64) + 1
+  columns, rows = np.floor((xy - origin) / cell_size).astype(np.int64).T
+  mask = np.zeros((shape[1], shape[0]), dtype=bool)
+  mask[rows, columns] = True
+  return mask, origin
+
+def close_mask(mask: np.ndarray, cell_size: float, dilate_distance: float, erode_distance: float) -> np.ndarray:
+  """Dilates the mask by one distance and erodes the result by another, using exact
+     Euclidean distance transforms (the raster version of a buffer and a negative buffer)"""
+
+  dilated = ndimage.distance_transform_edt(~mask) * cell_size <= dilate_distance
+  return ndimage.distance_transform_edt(dilated) * cell_size > erode_distance
+
+def vectorize_mask(mask: np.ndarray, origin: np.ndarray, cell_size: float):
+  """Returns the union of the cells of the mask as a shapely (multi)polygon. The cells are
+     merged into one rectangle pr run of cells in a row before the union."""
+
+  padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+  padded[:, 1:-1] = mask
+  rows, starts = np.nonzero(np.diff(padded, axis=1) == 1)
+  _, ends = np.nonzero(np.diff(padded, axis=1) == -1) # Same row order as the starts
+  if len(rows) == 0:
+    return shapely.Polygon()
+
+  boxes = shapely.box(origin[0] + starts * cell_size, origin[1] + rows * cell_size,
+                      origin[0] + ends * cell_size, origin[1] + (rows + 1) * cell_size)
+  return shapely.union_all(boxes)
+
+def points_to_aoi(xy: np.ndarray, buffer_distance: float, erode_factor: float = 0.9, cell_size: float = None, smooth: bool = True):
+  """Creates an AOI from clusters of points like features_to_aoi (buffer with a large
+     radius to merge adjacent points, then a negative buffer to reduce the outline), on a
+     grid instead of with vector buffers. With the default cell size (buffer_distance / 40)
+     95% of the outline is within about 1.2 cell sizes of the vector result, and within
+     3 cell sizes in narrow concave corners where the merged buffers meet.
+
+  Args:
+    xy (np.ndarray): Point coordinates as a (n, 2) array
+    buffer_distance (float): The buffer distance
+    erode_factor (float): Optional; The negative buffer as a share of the buffer distance
+    cell_size (float): Optional; Grid cell size
+    smooth (bool): Optional; Remove the staircase outline of the grid cells
+
+  Returns:
+    shapely.Geometry: The AOI as a (multi)polygon
+  """
+  cell_size = cell_size if cell_size is not None else buffer_distance / CELLS_PR_BUFFER
+  mask, origin = rasterize_points(xy, cell_size, buffer_distance + 2 * cell_size)
+
+  # Cells are marked by the cell containing each point, so the distances are measured from the cell centers
+  closed = close_mask(mask, cell_size, buffer_distance, buffer_distance * erode_factor)
+  aoi = vectorize_mask(closed, origin, cell_size)
+
+  if smooth:
+    aoi = shapely.buffer(shapely.simplify(aoi, cell_size), 0)
+  return aoi
@@ -0,0 +1,121 @@
+from heapq import heappush, heappop
+import numpy as np
+import shapely
+
+def polygon_adjacency(polygons: np.ndarray, decimals: int = 2) -> list:
+  """Finds the polygons sharing a part of their boundary longer than a point, like
+     SHARE_A_LINE_SEGMENT_WITH. Candidates are found with an STRtree, so a shared edge is
+     found even if the polygons have different vertices along it.
+
+  Args:
+    polygons (np.ndarray): Array of shapely polygons or multipolygons
+    decimals (int): Optional; Number of decimals the boundaries are snapped to before they are compared
+
+  Returns:
+    list: A set of adjacent polygon indexes for each polygon
+  """
+  boundaries = shapely.boundary(shapely.set_precision(np.asarray(polygons), 10.0 ** -decimals))
+  a, b = shapely.STRtree(boundaries).query(boundaries, predicate='intersects')
+  a, b = a[a < b], b[a < b]
+  shared = shapely.length(shapely.intersection(boundaries[a], boundaries[b])) > 0
+
+  adjacency = [set() for _ in range(len(polygons))]
+  for i, j in zip(a[shared].tolist(), b[shared].tolist()):
+    adjacency[i].add(j)
+    adjacency[j].add(i)
+  return adjacency
+
+class AreaGroups:
+  """Union-find over areas that keeps the point count, walk time and walk length of each merged group
+
+  Args:
+    counts, times, lengths (np.ndarray): Join_Count, Total_traveltime and Total_travellength of each area
+    adjacency (list): Set of adjacent area indexes for each area
+  """
+  def __init__(self, counts, times, lengths, adjacency: list) -> None:
+    self.parent = list(range(len(counts)))
+    self.count = [float(v) for v in counts]
+    self.time = [float(v) for v in times]
+    self.length = [float(v) for v in lengths]
+    self.adjacency = [set(a) for a in adjacency]
+
+  def find(self, i: int) -> int:
+    root = i
+    while self.parent[root] != root:
+      root = self.parent[root]
+    while self.parent[i] != root: # Path compression
+      self.parent[i], i = root, self.parent[i]
+    return root
+
+  def neighbors(self, root: int) -> set:
+    """Returns the groups adjacent to a group"""
+    self.adjacency[root] = {self.find(n) for n in self.adjacency[root]} - {root}
+    return self.adjacency[root]
+
+  def union(self, source: int, target: int) -> int:
+    """Merges the source group into the target group and returns the target root"""
+    source, target = self.find(source), self.find(target)
+    self.parent[source] = target
+    self.count[target] += self.count[source]
+    self.time[target] += self.time[source]
+    self.length[target] += self.length[source]
+    self.adjacency[target] |= self.adjacency[source]
+    self.adjacency[source] = set()
+    return target
+
+  def roots(self) -> np.ndarray:
+    return np.array([self.find(i) for i in range(len(self.parent))], dtype=np.int64)
+
+def plan_merges(groups: AreaGroups, min_count: int, max_count: int, max_time: float, abs_min_count: int, ids: list = None, log = None,
+                candidates: list = None) -> list:
+  """Merges small areas into an adjacent area, smallest areas first. A small area is merged
+     with the neighbour with the fewest points, or else the neighbour with the shortest walk
+     time, if the merged area stays below max_count and max_time. Areas with fewer than
+     abs_min_count points are merged with the neighbour with the fewest points regardless.
+     The optional ids (e.g. OBJECTIDs) are only used in the log messages. Pass candidates
+     (area indexes) to only merge those small areas, e.g. the areas changed in an update.
+
+  Returns:
+    list: (source, target) group roots for each merge in the order they were made
+  """
+  ids = ids if ids is not None else list(range(len(groups.count)))
+  candidates = range(len(groups.count)) if candidates is None else candidates
+  heap = [(groups.count[i], i) for i in candidates if groups.count[i] <= min_count]
+  heap.sort()
+  merges = []
+
+  while heap:
+    count, i = heappop(heap)
+    if groups.find(i) != i or groups.count[i] != count:
+      continue # Stale entry, the area has been merged since it was queued
+
+    neighbors = groups.neighbors(i)
+    if not neighbors:
+      continue
+
+    lowest_count = min(neighbors, key=lambda n: (groups.count[n], n))
+    shortest_time = min(neighbors, key=lambda n: (groups.time[n], n))
+    target = None
+    if count + groups.count[lowest_count] < max_count and groups.time[i] + groups.time[lowest_count] < max_time:
+      target = lowest_count
+      reason = 'som har færrest boenheter'
+    elif count + groups.count[shortest_time] < max_count and groups.time[i] + groups.time[shortest_time] < max_time:
+      target = shortest_time
+      reason = 'som har kortest reisetid'
+    elif count < abs_min_count:
+      target = lowest_count
+      reason = f'da roden har færre enn {abs_min_count} boenheter'
+
+    if target is None:
+      if log is not None:
+        log.info(f'Fant ingen naboer som rode med objektid {ids[i]} kan slås sammen med uten at antall boenheter overskrider {max_count} boenheter og/eller {max_time} min gangtid')
+      continue
+
+    if log is not None:
+      log.info(f' - Slår sammen rode med objektid {ids[i]} ({int(count)} boenheter) med naborode med objektid {ids[target]} {reason}')
+    merges.append((i, target))
+    root = groups.union(i, target)
+    if groups.count[root] <= min_count:
+      heappush(heap, (groups.count[root], root))
+
+  return merges
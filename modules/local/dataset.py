@@ -0,0 +1,88 @@
+import os
+import numpy as np
+
+OID_FIELD = 'OID@'
+X_FIELD = 'SHAPE@X'
+Y_FIELD = 'SHAPE@Y'
+
+def read_dataset(dataset) -> np.ndarray:
+  """Returns a local dataset as a NumPy structured array
+
+  Args:
+    dataset: A structured array (e.g. from arcpy.da.FeatureClassToNumPyArray) or
+             the full path to a .npy or .csv file with a header row
+
+  Returns:
+    np.ndarray: Structured array with one record pr feature
+  """
+  if isinstance(dataset, np.ndarray):
+    return dataset
+
+  extension = os.path.splitext(str(dataset))[1].lower()
+  if extension == '.npy':
+    return np.load(dataset, allow_pickle=False)
+  if extension == '.csv':
+    return np.genfromtxt(dataset, delimiter=',', names=True, dtype=None, encoding='utf-8',
+                         deletechars='', autostrip=True)
+
+  raise ValueError(f'Unsupported local dataset: {dataset}')
+
+def write_dataset(data: np.ndarray, output_dataset: str) -> str:
+  """Writes a structured array to a .npy or .csv file"""
+
+  extension = os.path.splitext(str(output_dataset))[1].lower()
+  if extension == '.csv':
+    np.savetxt(output_dataset, data, delimiter=',', fmt='%s', comments='',
+               header=','.join(data.dtype.names))
+  else:
+    np.save(output_dataset, data, allow_pickle=False)
+  return output_dataset
+
+def get_oids(data: np.ndarray) -> np.ndarray:
+  """Returns the object ids of a local dataset, defaults to 1..n if missing"""
+
+  for field in (OID_FIELD, 'OBJECTID', 'OID'):
+    if field in data.dtype.names:
+      return data[field].astype(np.int64)
+  return np.arange(1, len(data) + 1, dtype=np.int64)
+
+def get_xy(data: np.ndarray) -> np.ndarray:
+  """Returns the coordinates of a local point dataset as a (n, 2) float64 array"""
+
+  for x, y in ((X_FIELD, Y_FIELD), ('X', 'Y'), ('x', 'y')):
+    if x in data.dtype.names and y in data.dtype.names:
+      return np.column_stack([data[x], data[y]]).astype(np.float64)
+  if 'SHAPE@XY' in data.dtype.names:
+    return np.asarray(data['SHAPE@XY'], dtype=np.float64).reshape(-1, 2)
+
+  raise ValueError(f'No coordinate fields found in dataset with fields {data.dtype.names}')
+
+def add_column(data: np.ndarray, name: str, values: np.ndarray) -> np.ndarray:
+  """Returns a copy of the structured array with a new (or replaced) column"""
+
+  values = np.asarray(values)
+  names = [n for n in data.dtype.names if n != name]
+  dtype = [(n, data.dtype[n]) for n in names] + [(name, values.dtype)]
+  result = np.empty(len(data), dtype=dtype)
+  for n in names:
+    result[n] = data[n]
+  result[name] = values
+  return result
+
+def to_arrow(data: np.ndarray):
+  """Returns a structured array as a pyarrow Table with one typed column pr field"""
+
+  import pyarrow # Optional, only needed for Arrow tables
+  return pyarrow.table({name: data[name] for name in data.dtype.names})
+
+def from_arrow(table) -> np.ndarray:
+  """Returns a pyarrow Table as a structured array. Text columns become fixed width
+     unicode, null values must be filled before the conversion."""
+
+  columns = {name: np.asarray(table.column(name).to_numpy(zero_copy_only=False)) for name in table.column_names}
+  dtype = [(name, values.dtype if values.dtype != object else f'U{max(max((len(str(v)) for v in values), default=1), 1)}')
+           for name, values in columns.items()]
+  data = np.empty(table.num_rows, dtype=dtype)
+  for name, values in columns.items():
+    data[name] = values
+  return data
@@ -0,0 +1,140 @@
+"""
+Incremental update of areas when the units change, e.g. a new matrikkel extract. The new
+units are matched to the units of the previous run by id: units kept in place keep their
+area, added and moved units join the area they are within (or the area of the nearest kept
+unit). Only the areas whose unit count then leaves the [min, max] band are split or merged,
+and only the polygons of areas whose units changed are redrawn, so the work scales with the
+size of the change and not with the number of units.
+"""
+
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+from modules.local.areas import polygon_adjacency
+
+class UnitDiff:
+  """Matches the units of a new extract to the units of the previous run by id
+
+  Args:
+    old_ids, new_ids (np.ndarray): Unit ids of the previous and the new units
+    old_xy, new_xy (np.ndarray): Coordinates as (n, 2) arrays
+    move_tolerance (float): Optional; Units moved less than this distance (meters) are kept in place
+
+  Attributes:
+    old_index (np.ndarray): Index of each new unit in the previous units, -1 if added
+    added (np.ndarray): Indexes of the new units that were not in the previous run
+    moved (np.ndarray): Indexes of the new units moved more than the tolerance
+    removed (np.ndarray): Indexes of the previous units not in the new extract
+    kept (np.ndarray): True for the new units kept in place
+  """
+  def __init__(self, old_ids: np.ndarray, old_xy: np.ndarray, new_ids: np.ndarray, new_xy: np.ndarray, move_tolerance: float = 1.0) -> None:
+    order = np.argsort(old_ids, kind='stable')
+    position = np.minimum(np.searchsorted(old_ids[order], new_ids), max(len(order) - 1, 0))
+    found = old_ids[order][position] == new_ids if len(order) > 0 else np.zeros(len(new_ids), dtype=bool)
+    self.old_index = np.where(found, order[position] if len(order) > 0 else -1, -1)
+
+    matched = np.flatnonzero(found)
+    distance = np.hypot(*(new_xy[matched] - old_xy[self.old_index[matched]]).T)
+    self.added = np.flatnonzero(~found)
+    self.moved = matched[distance > move_tolerance]
+    self.kept = found.copy()
+    self.kept[self.moved] = False
+
+    seen = np.zeros(len(old_ids), dtype=bool)
+    seen[self.old_index[found]] = True
+    self.removed = np.flatnonzero(~seen)
+
+  def changed(self) -> int:
+    """Returns the number of added, moved and removed units"""
+    return len(self.added) + len(self.moved) + len(self.removed)
+
+def assign_units(diff: UnitDiff, old_area: np.ndarray, new_xy: np.ndarray, containing_area: np.ndarray = None) -> np.ndarray:
+  """Returns the area of each new unit. Units kept in place keep their area, added and moved
+     units get the area they are within, or else the area of the nearest kept unit.
+
+  Args:
+    diff (UnitDiff): The matched units
+    old_area (np.ndarray): Area id of each previous unit
+    new_xy (np.ndarray): Coordinates of the new units as a (n, 2) array
+    containing_area (np.ndarray): Optional; Area id of the polygon each of the added and
+      moved units (in the order of np.sort of their indexes) is within, None if outside all polygons
+
+  Returns:
+    np.ndarray: Area id of each new unit
+  """
+  area = np.empty(len(new_xy), dtype=old_area.dtype)
+  area[diff.kept] = old_area[diff.old_index[diff.kept]]
+  changed = np.flatnonzero(~diff.kept)
+  if len(changed) == 0:
+    return area
+
+  unplaced = np.ones(len(changed), dtype=bool)
+  if containing_area is not None:
+    inside = np.array([a is not None for a in containing_area], dtype=bool)
+    area[changed[inside]] = np.asarray(containing_area, dtype=object)[inside].astype(old_area.dtype)
+    unplaced = ~inside
+
+  kept = np.flatnonzero(diff.kept)
+  if unplaced.any() and len(kept) > 0:
+    _, nearest = cKDTree(new_xy[kept]).query(new_xy[changed[unplaced]])
+    area[changed[unplaced]] = area[kept[nearest]]
+  return area
+
+def changed_areas(diff: UnitDiff, old_area: np.ndarray, new_area: np.ndarray) -> set:
+  """Returns the ids of the areas (previous or new) that lost or got units"""
+
+  matched = np.flatnonzero(diff.old_index >= 0)
+  reassigned = matched[new_area[matched] != old_area[diff.old_index[matched]]]
+  moved = np.concatenate([diff.moved, reassigned])
+  return (set(old_area[diff.removed].tolist()) | set(old_area[diff.old_index[moved]].tolist())
+          | set(new_area[moved].tolist()) | set(new_area[diff.added].tolist()))
+
+def area_adjacency(ids: np.ndarray, polygons: np.ndarray) -> dict:
+  """Returns the set of adjacent area ids of each area id, for areas of one or more
+     (single part) polygons"""
+
+  adjacency = {area_id: set() for area_id in ids.tolist()}
+  for i, neighbors in enumerate(polygon_adjacency(polygons)):
+    adjacency[ids[i]] |= {ids[n] for n in neighbors}
+  for area_id, neighbors in adjacency.items():
+    neighbors.discard(area_id)
+  return adjacency
+
+def split_adjacency(adjacency: dict, children: dict) -> dict:
+  """Returns the adjacency after areas are split. Each part of a split area is adjacent to
+     the neighbours of the area and to the other parts.
+
+  Args:
+    adjacency (dict): Set of adjacent area ids of each area id
+    children (dict): The ids of the parts of each split area
+  """
+  result = {}
+  for area_id, neighbors in adjacency.items():
+    expanded = set()
+    for neighbor in neighbors:
+      expanded |= set(children.get(neighbor, [neighbor]))
+    if area_id in children:
+      for child in children[area_id]:
+        result[child] = (expanded | set(children[area_id])) - {child}
+    else:
+      result[area_id] = expanded
+  return result
+
+def redraw_region(polygons: np.ndarray, redraw: np.ndarray, outside_xy: np.ndarray = None, buffer_distance: float = 1000) -> shapely.Geometry:
+  """Returns the region the polygons of the changed areas are redrawn within: the polygons
+     of the changed areas and a buffer around changed units outside all polygons, less the
+     polygons of the areas that are kept as they are.
+
+  Args:
+    polygons (np.ndarray): The polygons of the previous areas
+    redraw (np.ndarray): True for the polygons of changed areas
+    outside_xy (np.ndarray): Optional; Units of changed areas outside all previous polygons
+    buffer_distance (float): Optional; Buffer around the outside units, e.g. the AOI buffer
+  """
+  region = shapely.union_all(polygons[redraw])
+  if outside_xy is not None and len(outside_xy) > 0:
+    region = shapely.union(region, shapely.union_all(shapely.buffer(shapely.points(outside_xy), buffer_distance)))
+  kept = polygons[~redraw]
+  if len(kept) > 0:
+    region = shapely.difference(region, shapely.union_all(kept))
+  return region
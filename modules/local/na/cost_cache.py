@@ -0,0 +1,306 @@
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+MAX_PAIRS = 50_000_000 # Roughly 2 GB on disk
+QUANTUM = 1.0 # Meters, points closer than this share a cache entry
+MAX_WALK_SPEED = 100 # Meters pr minute, above the speed of any walk travel mode. Only walk travel modes are cached
+NEIGHBORHOOD_BLOCK = 4096 # Origins pr block when finding the destinations within reach
+SCHEMA_VERSION = 2 # Stores made with another version are emptied when opened
+
+_caches = {} # Cost caches opened in this process by path
+
+def network_version(path: str) -> str:
+  """Returns a version string for a network edge file that changes when the file is written
+     again: the modification time (ns) and size of the file itself. Network datasets in a
+     geodatabase are versioned by modules.arcgis.na.network_dataset.network_version."""
+
+  if not os.path.isfile(path):
+    return path
+  stat = os.stat(path)
+  return f'{path}@{stat.st_mtime_ns}:{stat.st_size}'
+
+def quantize(xy: np.ndarray, quantum: float = QUANTUM) -> np.ndarray:
+  return np.round(np.asarray(xy, dtype=np.float64) / quantum).astype(np.int64)
+
+def cost_context(version: str, travel_mode, units, cutoff, destination_limit, quantum: float = QUANTUM) -> str:
+  """Returns the key of a set of cached origins: the costs from an origin are only valid for
+     the same network version (see network_version), travel mode, cost units, cutoff and
+     destination limit (defaultDestinationCount). The destinations are not part of the
+     context, each origin is checked against its own neighbourhood (see DestinationSet)."""
+
+  return hashlib.sha1(f'{version}|{getattr(travel_mode, "name", travel_mode)}|{units}|{cutoff}|{destination_limit}|{quantum}'.encode()).hexdigest()
+
+def unit_name(units) -> str:
+  return getattr(units, 'name', str(units).split('.')[-1])
+
+def reach(cutoff, units, distance: bool = False) -> float:
+  """Returns the straight line distance in meters no destination within the cutoff can be
+     beyond: the cutoff itself for a distance impedance, else the cutoff at MAX_WALK_SPEED.
+     Returns None (all destinations) without a cutoff or for unknown units.
+
+  Args:
+    cutoff (float): Impedance cutoff of the analysis
+    units: Time units (or distance units with distance=True) of the cutoff, e.g. arcpy.nax.TimeUnits.Minutes
+    distance (bool): Optional; The impedance of the travel mode is a distance
+  """
+  if distance:
+    meters = {'Meters': 1, 'Kilometers': 1000, 'Feet': 0.3048, 'Yards': 0.9144, 'Miles': 1609.344, 'NauticalMiles': 1852}.get(unit_name(units))
+    return float(cutoff) * meters if cutoff is not None and meters is not None else None
+  minutes = {'Seconds': 1 / 60, 'Minutes': 1, 'Hours': 60, 'Days': 1440}.get(unit_name(units))
+  if cutoff is None or minutes is None:
+    return None
+  return float(cutoff) * minutes * MAX_WALK_SPEED
+
+def key_hashes(keys: np.ndarray, seed: int) -> np.ndarray:
+  """Returns a 64 bit hash of each (x, y, rank) key (splitmix64 finalizer)"""
+
+  with np.errstate(over='ignore'):
+    z = keys.astype(np.uint64) * np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9], dtype=np.uint64)
+    z = z[:, 0] ^ z[:, 1] ^ z[:, 2] ^ np.uint64(seed)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def destination_keys(xy: np.ndarray, quantum: float = QUANTUM) -> np.ndarray:
+  """Returns the key of each destination as a (n, 3) array: the quantized coordinates and
+     the rank of the destination among the destinations at the same coordinates (in load
+     order), so destinations stacked at one address keep their own key"""
+
+  q = quantize(xy, quantum).reshape(-1, 2)
+  order = np.lexsort((q[:, 1], q[:, 0]))
+  ordered = q[order]
+  first = np.r_[True, (ordered[1:] != ordered[:-1]).any(axis=1)] if len(q) > 0 else np.zeros(0, dtype=bool)
+  start = np.maximum.accumulate(np.where(first, np.arange(len(q)), 0)) if len(q) > 0 else np.zeros(0, dtype=np.int64)
+  rank = np.empty(len(q), dtype=np.int64)
+  rank[order] = np.arange(len(q)) - start
+  return np.column_stack([q, rank]).astype(np.int64)
+
+def _rows(keys: np.ndarray) -> np.ndarray:
+  return np.ascontiguousarray(keys, dtype=np.int64).view(np.dtype((np.void, 24))).reshape(-1)
+
+class DestinationSet:
+  """The destinations of a solve with the lookups of the cost cache: the neighbourhood digest
+     of an origin and the index of stored destination keys in this set.
+
+  The costs from an origin only depend on the destinations within reach of it (see reach),
+  so a cached origin is valid as long as the destinations within reach are unchanged, and
+  added or removed destinations elsewhere do not invalidate it.
+
+  Args:
+    xy (np.ndarray): Destination coordinates as a (n, 2) array, in load order
+    radius (float): Optional; Meters from an origin that can change its costs, None for all destinations
+    quantum (float): Optional; Coordinate resolution of the keys in meters
+  """
+  def __init__(self, xy: np.ndarray, radius: float = None, quantum: float = QUANTUM) -> None:
+    self.keys = destination_keys(xy, quantum)
+    self.radius = radius
+    self.quantum = quantum
+    rows = _rows(self.keys)
+    self.order = np.argsort(rows, kind='stable')
+    self.sorted = rows[self.order]
+    self.hashes = np.column_stack([key_hashes(self.keys, 1), key_hashes(self.keys, 2)]) if len(self.keys) > 0 else np.zeros((0, 2), dtype=np.uint64)
+    self.tree = cKDTree(self.keys[:, :2] * quantum) if radius is not None and len(self.keys) > 0 else None
+    self.everything = hashlib.sha1(self.sorted.tobytes()).hexdigest()
+
+  def __len__(self) -> int:
+    return len(self.keys)
+
+  def neighborhoods(self, origin_xy: np.ndarray) -> list:
+    """Returns a digest of the destinations within reach of each origin: the count and two
+       order independent 64 bit sums of the key hashes. The pairs within reach are found
+       for a block of origins at a time with one sparse distance matrix."""
+
+    origin_xy = np.asarray(origin_xy, dtype=np.float64).reshape(-1, 2)
+    if self.radius is None:
+      return [self.everything] * len(origin_xy)
+    counts = np.zeros(len(origin_xy), dtype=np.int64)
+    sums = np.zeros((len(origin_xy), 2), dtype=np.uint64)
+    if self.tree is not None:
+      xy = quantize(origin_xy, self.quantum) * self.quantum
+      for start in range(0, len(xy), NEIGHBORHOOD_BLOCK):
+        pairs = cKDTree(xy[start:start + NEIGHBORHOOD_BLOCK]).sparse_distance_matrix(self.tree, self.radius, output_type='ndarray')
+        origin = pairs['i'].astype(np.int64) + start
+        counts += np.bincount(origin, minlength=len(xy))
+        for h in range(2):
+          np.add.at(sums[:, h], origin, self.hashes[pairs['j'], h])
+    return [f'{count}:{a:016x}{b:016x}' for count, a, b in zip(counts.tolist(), sums[:, 0].tolist(), sums[:, 1].tolist())]
+
+  def index(self, keys: np.ndarray) -> np.ndarray:
+    """Returns the index of each destination key in the set, -1 for keys not in the set"""
+
+    rows = _rows(keys.reshape(-1, 3))
+    if len(self.sorted) == 0:
+      return np.full(len(rows), -1, dtype=np.int64)
+    position = np.minimum(np.searchsorted(self.sorted, rows), len(self.sorted) - 1)
+    return np.where(self.sorted[position] == rows, self.order[position], -1)
+
+class CostCache:
+  """Persistent SQLite store of origin to destination walk costs.
+
+  All the costs found from an origin are stored together under a context (see cost_context)
+  and the quantized origin coordinates, with the digest of the destinations within reach of
+  the origin (see DestinationSet.neighborhoods). Destinations are stored by their keys (see
+  destination_keys), so an origin is found again for another destination set with the same
+  destinations near it. When the store holds more than max_pairs costs the least recently
+  used origins are evicted.
+
+  Args:
+    path (str): The SQLite file
+    max_pairs (int): Optional; Max number of origin to destination costs to keep
+    quantum (float): Optional; Coordinate resolution of the cache keys in meters
+
+  Attributes:
+    hits (int): Number of origins found in the cache
+    misses (int): Number of origins not found in the cache, or with changed destinations near them
+  """
+  def __init__(self, path: str, max_pairs: int = MAX_PAIRS, quantum: float = QUANTUM) -> None:
+    self.path = path
+    self.max_pairs = max_pairs
+    self.quantum = quantum
+    self.hits = 0
+    self.misses = 0
+    self.connection = sqlite3.connect(self.path, timeout=60)
+    if self.connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+      self.connection.executescript(f'''
+        DROP TABLE IF EXISTS costs;
+        DROP TABLE IF EXISTS origins;
+        PRAGMA user_version = {SCHEMA_VERSION};
+      ''')
+    self.connection.executescript('''
+      PRAGMA journal_mode=WAL;
+      CREATE TABLE IF NOT EXISTS origins (
+        id INTEGER PRIMARY KEY, context TEXT NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL,
+        neighborhood TEXT NOT NULL, pairs INTEGER NOT NULL, used REAL NOT NULL, UNIQUE (context, x, y));
+      CREATE INDEX IF NOT EXISTS origins_used ON origins (used);
+      CREATE TABLE IF NOT EXISTS costs (
+        origin INTEGER NOT NULL, destinations BLOB NOT NULL, minutes BLOB NOT NULL, lengths BLOB NOT NULL,
+        PRIMARY KEY (origin)) WITHOUT ROWID;
+    ''')
+
+  def get(self, context: str, keys: list, neighborhoods: list, destinations: DestinationSet) -> dict:
+    """Returns the cached (destination indexes, minutes, lengths) by quantized origin
+       coordinates for the origins found in the cache with the same destinations within
+       reach (see DestinationSet.neighborhoods). The indexes are the indexes of the
+       destinations in the destination set."""
+
+    found = {}
+    now = time.time()
+    cursor = self.connection.cursor()
+    for (x, y), neighborhood in zip(keys, neighborhoods):
+      row = cursor.execute('''SELECT o.id, c.destinations, c.minutes, c.lengths FROM origins o JOIN costs c ON c.origin = o.id
+                              WHERE o.context = ? AND o.x = ? AND o.y = ? AND o.neighborhood = ?''', (context, x, y, neighborhood)).fetchone()
+      if row is None:
+        continue
+      cursor.execute('UPDATE origins SET used = ? WHERE id = ?', (now, row[0]))
+      index = destinations.index(np.frombuffer(row[1], dtype=np.int64))
+      kept = index >= 0 # Destinations beyond reach are dropped if they were removed
+      found[(x, y)] = (index[kept], np.frombuffer(row[2], dtype=np.float64)[kept], np.frombuffer(row[3], dtype=np.float64)[kept])
+    self.connection.commit()
+
+    self.hits += len(found)
+    self.misses += len(keys) - len(found)
+    return found
+
+  def put(self, context: str, keys: list, neighborhoods: list, minutes: csr_matrix, lengths: csr_matrix, destinations: DestinationSet) -> None:
+    """Stores the costs of each origin (row) to the destinations (columns) of the sparse
+       matrices, by the quantized origin coordinates and neighbourhood digest of each row"""
+
+    now = time.time()
+    cursor = self.connection.cursor()
+    for i, ((x, y), neighborhood) in enumerate(zip(keys, neighborhoods)):
+      start, end = minutes.indptr[i], minutes.indptr[i + 1]
+      cursor.execute('DELETE FROM costs WHERE origin IN (SELECT id FROM origins WHERE context = ? AND x = ? AND y = ?)', (context, x, y))
+      cursor.execute('INSERT OR REPLACE INTO origins (context, x, y, neighborhood, pairs, used) VALUES (?, ?, ?, ?, ?, ?)',
+                     (context, x, y, neighborhood, int(end - start), now))
+      cursor.execute('INSERT OR REPLACE INTO costs VALUES (?, ?, ?, ?)', (
+        cursor.lastrowid,
+        destinations.keys[minutes.indices[start:end]].tobytes(),
+        minutes.data[start:end].astype(np.float64).tobytes(),
+        lengths.data[start:end].astype(np.float64).tobytes()))
+    self.connection.commit()
+    self.evict()
+
+  def evict(self) -> int:
+    """Removes the least recently used origins until at most max_pairs costs are stored"""
+
+    cursor = self.connection.cursor()
+    stored = cursor.execute('SELECT COALESCE(SUM(pairs), 0) FROM origins').fetchone()[0]
+    if stored <= self.max_pairs:
+      return 0
+
+    evicted = []
+    for origin, pairs in cursor.execute('SELECT id, pairs FROM origins ORDER BY used').fetchall():
+      if stored <= self.max_pairs:
+        break
+      evicted.append((origin,))
+      stored -= pairs
+    cursor.executemany('DELETE FROM costs WHERE origin = ?', evicted)
+    cursor.executemany('DELETE FROM origins WHERE id = ?', evicted)
+    self.connection.commit()
+    return len(evicted)
+
+  def hit_rate(self) -> float:
+    lookups = self.hits + self.misses
+    return self.hits / lookups if lookups > 0 else 0.0
+
+  def report(self, log) -> None:
+    log.info(f'Kostnadscache: {self.hits} treff og {self.misses} bom ({round(self.hit_rate() * 100, 1)} % treff)')
+
+def open_cost_cache(path: str, max_pairs: int = MAX_PAIRS) -> CostCache:
+  """Opens a cost cache once pr path and process. There is no default store, caching is
+     opt-in by passing the cache (or its path) to solve_cost_matrices."""
+
+  if path not in _caches:
+    _caches[path] = CostCache(path, max_pairs)
+  return _caches[path]
+
+def cached_cost_matrices(cache: CostCache, context: str, origin_xy: np.ndarray, destinations: DestinationSet, solve) -> tuple:
+  """Returns the time and distance matrices from each origin to the destinations. Only the
+     distinct origin locations missing from the cache, or with changed destinations within
+     reach, are solved.
+
+  Args:
+    cache (CostCache): The cost cache
+    context (str): Cache context of the solver settings (see cost_context)
+    origin_xy (np.ndarray): Origin coordinates as a (n, 2) array
+    destinations (DestinationSet): The destinations, in load order
+    solve (function): Called with the rows (in origin_xy) of the missing origins, returns sparse
+      time and distance matrices (or None if solving failed)
+
+  Returns:
+    tuple: Sparse origin by destination time and distance matrices, or None
+  """
+  keys = [tuple(key) for key in quantize(origin_xy, cache.quantum).tolist()]
+  first = {}
+  for i, key in enumerate(keys):
+    first.setdefault(key, i)
+  neighborhood = dict(zip(first, destinations.neighborhoods(origin_xy[np.fromiter(first.values(), dtype=np.int64, count=len(first))])))
+  found = cache.get(context, list(first), list(neighborhood.values()), destinations)
+
+  missing = {key: i for key, i in first.items() if key not in found}
+  if missing:
+    rows = np.fromiter(missing.values(), dtype=np.int64, count=len(missing))
+    solved = solve(rows)
+    if solved is None:
+      return None
+    cache.put(context, list(missing), [neighborhood[key] for key in missing], *solved, destinations)
+    for n, key in enumerate(missing):
+      start, end = solved[0].indptr[n], solved[0].indptr[n + 1]
+      found[key] = (solved[0].indices[start:end], solved[0].data[start:end], solved[1].data[start:end])
+
+  entries = [found[key] for key in keys]
+  indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+  np.cumsum([len(entry[0]) for entry in entries], out=indptr[1:])
+  shape = (len(keys), len(destinations))
+  if not entries or indptr[-1] == 0:
+    return csr_matrix(shape), csr_matrix(shape)
+  indices = np.concatenate([entry[0] for entry in entries])
+  return (
+    csr_matrix((np.concatenate([entry[1] for entry in entries]), indices, indptr), shape=shape),
+    csr_matrix((np.concatenate([entry[2] for entry in entries]), indices, indptr), shape=shape)
+  )
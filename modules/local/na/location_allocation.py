@@ -0,0 +1,101 @@
+import numpy as np
+from modules.local.dataset import read_dataset, get_oids, add_column
+from modules.object import set_attributes
+from modules.local.solvers.pmedian import solve_pmedian
+from modules.log import Log
+from .network_dataset import create_network_dataset, NetworkDataset
+from .odmatrix import cost_matrix
+from .result import SolverResult, MessageSeverity
+log = Log()
+
+class LocationAllocationInputDataType:
+  Facilities = 'Facilities'
+  DemandPoints = 'DemandPoints'
+
+class LocationAllocationOutputDataType:
+  Facilities = 'Facilities'
+  DemandPoints = 'DemandPoints'
+
+class LocationAllocationProblemType:
+  MinimizeImpedance = 'MinimizeImpedance'
+  MaximizeCapacitatedCoverage = 'MaximizeCapacitatedCoverage'
+
+defaults = {
+  'travelMode': 'Gange',
+  'defaultImpedanceCutoff':15,
+  'problemType': LocationAllocationProblemType.MinimizeImpedance,
+  'facilityCount': 1,
+  'defaultCapacity': 1,
+  'maxIterations': 20,
+  'timeLimit': None
+}
+
+class LocationAllocation:
+  """Location-allocation solved on a local network dataset"""
+  def __init__(self, network: NetworkDataset) -> None:
+    self.network = network
+    self.inputs = {}
+
+  def load(self, input_type, features, field_mappings = None, append: bool = False) -> None:
+    self.inputs[input_type] = read_dataset(features)
+
+  def solve(self) -> SolverResult:
+    facilities = self.inputs[LocationAllocationInputDataType.Facilities]
+    demand_points = self.inputs[LocationAllocationInputDataType.DemandPoints]
+    costs = cost_matrix(self.network, facilities, demand_points, self.defaultImpedanceCutoff)
+    weights = demand_points['Weight'] if 'Weight' in demand_points.dtype.names else None
+    solution = solve_pmedian(costs, self.facilityCount, get_capacity(self), weights, self.maxIterations, self.timeLimit)
+
+    facility_oids = get_oids(facilities)
+    allocation = solution.allocation
+    facility_ids = np.where(allocation >= 0, facility_oids[np.maximum(allocation, 0)], -1)
+    status = np.zeros(len(facilities), dtype=np.int64)
+    status[solution.facilities] = 3 # Chosen, same as esriNAFacilityTypeChosen
+
+    return SolverResult({
+      LocationAllocationOutputDataType.DemandPoints: add_column(demand_points, 'FacilityOID', facility_ids),
+      LocationAllocationOutputDataType.Facilities: add_column(facilities, 'FacilityType', status)
+    }, [(MessageSeverity.Informative, f'{len(solution.facilities)} facilities chosen, {(allocation < 0).sum()} demand points not allocated')])
+
+def get_capacity(la) -> float:
+  """Returns the facility capacity for capacitated problem types, else None"""
+
+  problem_type = getattr(la.problemType, 'name', str(la.problemType)).split('.')[-1]
+  if problem_type == LocationAllocationProblemType.MaximizeCapacitatedCoverage:
+    return la.defaultCapacity
+  return None
+
+def create_location_allocation_analysis(options: dict, network = None) -> LocationAllocation:
+  """Creates and configures a local location-allocation analysis
+     using ELVEG as default network"""
+
+  nd = create_network_dataset(network)
+  la = LocationAllocation(nd)
+  set_attributes(la, options, defaults)
+  return la
+
+@log.timed()
+def load_and_solve_location_allocation(la: LocationAllocation, facilities, demand_points):
+  la.load(LocationAllocationInputDataType.Facilities, facilities)
+  log.info(f'Loaded {len(la.inputs[LocationAllocationInputDataType.Facilities])} facilities...')
+
+  la.load(LocationAllocationInputDataType.DemandPoints, demand_points)
+  log.info(f'Loaded {len(la.inputs[LocationAllocationInputDataType.DemandPoints])} demand points...')
+
+  log.info(f'Solving location-allocation for {la.facilityCount} facilities...')
+  return la.solve()
+
+def get_la_facilities(result, output):
+  log.info(f'Exporting facilities with status...')
+  get_result_points(result, output, LocationAllocationOutputDataType.Facilities)
+
+def get_la_demand_points(result, output):
+  log.info(f'Exporting demand points with facility ids...')
+  get_result_points(result, output, LocationAllocationOutputDataType.DemandPoints)
+
+def get_result_points(result, output, result_type):
+  if result.solveSucceeded:
+    result.export(result_type, output)
+  else:
+    log.error('Solving the location-allocation analysis failed! Message:')
+    log.error(result.solverMessages(MessageSeverity.All))
@@ -0,0 +1,363 @@
+import os
+from heapq import heappush, heappop
+import numpy as np
+from scipy.spatial import cKDTree
+from modules.local.dataset import add_column, get_xy
+from modules.log import Log
+log = Log()
+
+ELVEG_EDGES = r'D:\Data\Geodata Online\ELVEG_Nettverk_kanter.npz'
+
+# Column names in ELVEG-style edge lists (csv with header or npz archive)
+EDGE_COLUMNS = ['from_node', 'to_node', 'length', 'minutes', 'from_x', 'from_y', 'to_x', 'to_y']
+
+# Network location fields of the na inputs and the fields the calculated locations are
+# stored in (see calculate_locations). The stored names do not collide with the SourceOID
+# that deduplicate_points adds. Point, edge and position are enough to place a point.
+LOCATION_FIELDS = {
+  'SourceID': 'NetSourceID',
+  'SourceOID': 'NetSourceOID',
+  'PosAlong': 'NetPosAlong',
+  'SideOfEdge': 'NetSideOfEdge',
+  'SnapX': 'NetSnapX',
+  'SnapY': 'NetSnapY',
+  'DistanceToNetworkInMeters': 'SnapDistance'
+}
+LOCATED_FIELDS = ['SourceID', 'SourceOID', 'PosAlong', 'SideOfEdge']
+SIDE_RIGHT = 1 # esriNAEdgeSideRight
+SIDE_LEFT = 2 # esriNAEdgeSideLeft
+
+_networks = {}
+
+class NetworkDataset:
+  """Walking network stored as a compact CSR adjacency list on NumPy arrays.
+
+  Edges are undirected and carry a length in meters and a cost in minutes.
+
+  Args:
+    edges (dict): Arrays for each of the EDGE_COLUMNS
+    name (str): Optional; Name of the network
+    snap_spacing (float): Optional; Spacing in meters of the sample points used to find snapping candidates
+
+  Attributes:
+    node_count (int): Number of nodes in the network
+    edge_count (int): Number of edges in the network
+    indptr, neighbors, edge_ids (np.ndarray): CSR adjacency, one entry pr edge direction
+  """
+  def __init__(self, edges: dict, name: str = None, snap_spacing: float = 25) -> None:
+    self.name = name if name is not None else 'Vegnettverk (ELVEG)'
+
+    node_ids, inverse = np.unique(np.concatenate([edges['from_node'], edges['to_node']]), return_inverse=True)
+    self.edge_count = len(edges['from_node'])
+    self.node_count = len(node_ids)
+    self.node_ids = node_ids
+    self.edge_from = inverse[:self.edge_count].astype(np.int64)
+    self.edge_to = inverse[self.edge_count:].astype(np.int64)
+    self.edge_length = np.asarray(edges['length'], dtype=np.float64)
+    self.edge_minutes = np.asarray(edges['minutes'], dtype=np.float64)
+
+    self.node_xy = np.zeros((self.node_count, 2))
+    self.node_xy[self.edge_from] = np.column_stack([edges['from_x'], edges['from_y']])
+    self.node_xy[self.edge_to] = np.column_stack([edges['to_x'], edges['to_y']])
+
+    self._build_adjacency()
+    self._build_snap_index(snap_spacing)
+
+  def _build_adjacency(self) -> None:
+    edge_index = np.arange(self.edge_count)
+    tails = np.concatenate([self.edge_from, self.edge_to])
+    heads = np.concatenate([self.edge_to, self.edge_from])
+    order = np.argsort(tails, kind='stable')
+
+    self.indptr = np.zeros(self.node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tails, minlength=self.node_count), out=self.indptr[1:])
+    self.neighbors = heads[order]
+    self.edge_ids = np.concatenate([edge_index, edge_index])[order]
+
+    # Plain lists are a lot faster than NumPy scalars in the Dijkstra inner loop
+    self._indptr = self.indptr.tolist()
+    self._neighbors = self.neighbors.tolist()
+    self._edge_ids = self.edge_ids.tolist()
+    self._minutes = self.edge_minutes.tolist()
+    self._length = self.edge_length.tolist()
+    self._edge_from = self.edge_from.tolist()
+    self._edge_to = self.edge_to.tolist()
+
+  def _build_snap_index(self, spacing: float) -> None:
+    start = self.node_xy[self.edge_from]
+    end = self.node_xy[self.edge_to]
+    samples = np.maximum(np.ceil(np.hypot(*(end - start).T) / spacing).astype(np.int64), 1) + 1
+    edges = np.repeat(np.arange(self.edge_count), samples)
+    offsets = np.arange(len(edges)) - np.repeat(np.cumsum(samples) - samples, samples)
+    fractions = offsets / np.repeat(samples - 1, samples)
+
+    self._sample_edges = edges
+    self._snap_tree = cKDTree(start[edges] + (end[edges] - start[edges]) * fractions[:, None])
+
+  def snap(self, xy: np.ndarray, candidates: int = 8) -> tuple:
+    """Snaps points to the nearest edge in the network
+
+    Args:
+      xy (np.ndarray): Point coordinates as a (n, 2) array
+      candidates (int): Optional; Number of nearby edge samples to test for each point
+
+    Returns:
+      tuple: Arrays with the edge index, position along the edge (0-1) and the snap distance in meters
+    """
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    k = min(candidates, self._snap_tree.n)
+    _, idx = self._snap_tree.query(xy, k=k)
+    idx = idx.reshape(len(xy), k)
+    edges = self._sample_edges[idx]
+
+    start = self.node_xy[self.edge_from[edges]]
+    vector = self.node_xy[self.edge_to[edges]] - start
+    squared = np.maximum((vector ** 2).sum(axis=2), 1e-12)
+    position = np.clip(((xy[:, None, :] - start) * vector).sum(axis=2) / squared, 0, 1)
+    distance = np.hypot(*(start + vector * position[..., None] - xy[:, None, :]).transpose(2, 0, 1))
+
+    best = np.argmin(distance, axis=1)
+    rows = np.arange(len(xy))
+    return edges[rows, best], position[rows, best], distance[rows, best]
+
+  def calculate_locations(self, xy: np.ndarray) -> np.ndarray:
+    """Returns the network location of each point as a structured array with the stored
+       LOCATION_FIELDS. The source OID is the edge index and the position is along the edge
+       from its from node (0-1)."""
+
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    edges, positions, distances = self.snap(xy)
+    start = self.node_xy[self.edge_from[edges]]
+    vector = self.node_xy[self.edge_to[edges]] - start
+    snapped = start + vector * positions[:, None]
+    cross = vector[:, 0] * (xy[:, 1] - start[:, 1]) - vector[:, 1] * (xy[:, 0] - start[:, 0])
+
+    locations = np.empty(len(xy), dtype=[(LOCATION_FIELDS[name], dtype) for name, dtype in (
+      ('SourceID', np.int64), ('SourceOID', np.int64), ('PosAlong', np.float64), ('SideOfEdge', np.int64),
+      ('SnapX', np.float64), ('SnapY', np.float64), ('DistanceToNetworkInMeters', np.float64))])
+    locations[LOCATION_FIELDS['SourceID']] = 1
+    locations[LOCATION_FIELDS['SourceOID']] = edges
+    locations[LOCATION_FIELDS['PosAlong']] = positions
+    locations[LOCATION_FIELDS['SideOfEdge']] = np.where(cross > 0, SIDE_LEFT, SIDE_RIGHT)
+    locations[LOCATION_FIELDS['SnapX']], locations[LOCATION_FIELDS['SnapY']] = snapped.T
+    locations[LOCATION_FIELDS['DistanceToNetworkInMeters']] = distances
+    return locations
+
+  def locate_points(self, data: np.ndarray) -> list:
+    """Locates a point dataset or (n, 2) coordinates on the network (see locate). Points with
+       stored network locations (see calculate_locations) are not snapped again."""
+
+    edge_field, position_field = LOCATION_FIELDS['SourceOID'], LOCATION_FIELDS['PosAlong']
+    if data.dtype.names is None:
+      return self.locate(*self.snap(data)[:2])
+    if edge_field in data.dtype.names and position_field in data.dtype.names:
+      return self.locate(data[edge_field].astype(np.int64), data[position_field].astype(np.float64))
+    return self.locate(*self.snap(get_xy(data))[:2])
+
+  def locate(self, edges: np.ndarray, positions: np.ndarray) -> list:
+    """Returns located points as (edge, minutes along edge, meters along edge) tuples"""
+
+    return [(e, p * self._minutes[e], p * self._length[e]) for e, p in zip(edges.tolist(), positions.tolist())]
+
+  def sources(self, located: tuple) -> list:
+    """Returns the search sources (node, minutes, meters) for a located point"""
+
+    edge, minutes, meters = located
+    return [
+      (self._edge_from[edge], minutes, meters),
+      (self._edge_to[edge], self._minutes[edge] - minutes, self._length[edge] - meters)
+    ]
+
+  def shortest_paths(self, sources: list, cutoff: float = None, targets: set = None) -> dict:
+    """Heap based Dijkstra search from one or more source nodes
+
+    Args:
+      sources (list): List of (node, minutes, meters) to start the search from
+      cutoff (float): Optional; Stop searching when the cost exceeds the cutoff (minutes)
+      targets (set): Optional; Stop searching when all these nodes are reached
+
+    Returns:
+      dict: Settled nodes with a (minutes, meters) tuple
+    """
+    cutoff = float('inf') if cutoff is None else cutoff
+    remaining = set(targets) if targets is not None else None
+    settled = {}
+    heap = [(minutes, meters, node) for node, minutes, meters in sources if minutes <= cutoff]
+    heap.sort()
+
+    indptr, neighbors, edge_ids = self._indptr, self._neighbors, self._edge_ids
+    costs, lengths = self._minutes, self._length
+
+    while heap:
+      minutes, meters, node = heappop(heap)
+      if node in settled:
+        continue
+      settled[node] = (minutes, meters)
+      if remaining is not None:
+        remaining.discard(node)
+        if not remaining:
+          break
+
+      for i in range(indptr[node], indptr[node + 1]):
+        neighbor = neighbors[i]
+        if neighbor not in settled:
+          edge = edge_ids[i]
+          cost = minutes + costs[edge]
+          if cost <= cutoff:
+            heappush(heap, (cost, meters + lengths[edge], neighbor))
+
+    return settled
+
+  def path_costs(self, origin: tuple, destinations: list, cutoff: float = None) -> tuple:
+    """Returns the network cost from one located point to a list of located points
+
+    Args:
+      origin (tuple): Located origin (from locate)
+      destinations (list): Located destinations (from locate)
+      cutoff (float): Optional; Maximum cost in minutes
+
+    Returns:
+      tuple: Arrays with minutes and meters for each destination, inf when not reachable
+    """
+    targets = {node for destination in destinations for node, _, _ in self.sources(destination)}
+    settled = self.shortest_paths(self.sources(origin), cutoff, targets)
+    minutes = np.full(len(destinations), np.inf)
+    meters = np.full(len(destinations), np.inf)
+
+    for i, destination in enumerate(destinations):
+      for node, extra_minutes, extra_meters in self.sources(destination):
+        if node in settled and settled[node][0] + extra_minutes < minutes[i]:
+          minutes[i] = settled[node][0] + extra_minutes
+          meters[i] = settled[node][1] + extra_meters
+
+      if destination[0] == origin[0] and abs(origin[1] - destination[1]) < minutes[i]:
+        minutes[i] = abs(origin[1] - destination[1])
+        meters[i] = abs(origin[2] - destination[2])
+
+    if cutoff is not None:
+      meters[minutes > cutoff] = np.inf
+      minutes[minutes > cutoff] = np.inf
+    return minutes, meters
+
+  def index_destinations(self, located: list) -> dict:
+    """Groups located destinations by edge for use in nearest searches"""
+
+    index = {}
+    for i, (edge, minutes, meters) in enumerate(located):
+      index.setdefault(edge, []).append((i, minutes, meters))
+    return index
+
+  def nearest(self, origin: tuple, destination_index: dict, k: int = None, cutoff: float = None) -> list:
+    """Finds the k nearest destinations from a located origin
+
+    Args:
+      origin (tuple): Located origin (from locate)
+      destination_index (dict): Destinations by edge, see index_destinations
+      k (int): Optional; Number of destinations to find. Default is all within the cutoff
+      cutoff (float): Optional; Maximum cost in minutes
+
+    Returns:
+      list: (minutes, meters, destination) tuples sorted by cost
+    """
+    cutoff = float('inf') if cutoff is None else cutoff
+    best = {}
+    candidates = []
+    found = []
+    done = set()
+    settled = set()
+    heap = [(minutes, meters, node) for node, minutes, meters in self.sources(origin) if minutes <= cutoff]
+    heap.sort()
+
+    # Destinations on the same edge as the origin can be reached directly
+    for destination, minutes, meters in destination_index.get(origin[0], ()):
+      if abs(origin[1] - minutes) <= cutoff:
+        best[destination] = (abs(origin[1] - minutes), abs(origin[2] - meters))
+        heappush(candidates, (best[destination][0], destination))
+
+    def finalize(limit):
+      # Candidates cheaper than the current search radius can not improve any further
+      while candidates and candidates[0][0] <= limit:
+        minutes, destination = heappop(candidates)
+        if destination not in done and best[destination][0] == minutes:
+          done.add(destination)
+          found.append((minutes, best[destination][1], destination))
+
+    indptr, neighbors, edge_ids = self._indptr, self._neighbors, self._edge_ids
+    costs, lengths, edge_from = self._minutes, self._length, self._edge_from
+
+    while heap:
+      minutes, meters, node = heappop(heap)
+      if node in settled:
+        continue
+      settled.add(node)
+      finalize(minutes)
+      if k is not None and len(found) >= k:
+        break
+
+      for i in range(indptr[node], indptr[node + 1]):
+        edge = edge_ids[i]
+        for destination, position_minutes, position_meters in destination_index.get(edge, ()):
+          if node == edge_from[edge]:
+            cost, length = minutes + position_minutes, meters + position_meters
+          else:
+            cost, length = minutes + costs[edge] - position_minutes, meters + lengths[edge] - position_meters
+          if cost <= cutoff and (destination not in best or cost < best[destination][0]):
+            best[destination] = (cost, length)
+            heappush(candidates, (cost, destination))
+
+        neighbor = neighbors[i]
+        if neighbor not in settled:
+          cost = minutes + costs[edge]
+          if cost <= cutoff:
+            heappush(heap, (cost, meters + lengths[edge], neighbor))
+
+    finalize(cutoff)
+    return found[:k] if k is not None else found
+
+def calculate_locations(data: np.ndarray, network = None) -> np.ndarray:
+  """Returns a copy of a point dataset with its network locations in the LOCATION_FIELDS,
+     so later loads on the same network reuse them instead of snapping the points again"""
+
+  nd = create_network_dataset(network) if not isinstance(network, NetworkDataset) else network
+  locations = nd.calculate_locations(get_xy(data))
+  for name in locations.dtype.names:
+    data = add_column(data, name, locations[name])
+  distances = locations[LOCATION_FIELDS['DistanceToNetworkInMeters']]
+  if len(distances):
+    log.info(f'Nettverksplassering for {len(data)} punkter, avstand til nettverket median {np.median(distances):.0f} m, maks {distances.max():.0f} m')
+  return data
+
+def read_edges(path: str) -> dict:
+  """Reads an ELVEG-style edge list from a .npz archive or a .csv file with a header row"""
+
+  if os.path.splitext(path)[1].lower() == '.npz':
+    with np.load(path) as archive:
+      return {column: archive[column] for column in EDGE_COLUMNS}
+
+  with open(path, encoding='utf-8') as f:
+    header = [name.strip() for name in f.readline().split(',')]
+  data = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+  return {column: data[:, header.index(column)] for column in EDGE_COLUMNS}
+
+def save_edges(network: NetworkDataset, path: str) -> None:
+  """Saves the network edges as a compressed .npz archive for faster loading"""
+
+  np.savez_compressed(path,
+    from_node=network.node_ids[network.edge_from], to_node=network.node_ids[network.edge_to],
+    length=network.edge_length, minutes=network.edge_minutes,
+    from_x=network.node_xy[network.edge_from, 0], from_y=network.node_xy[network.edge_from, 1],
+    to_x=network.node_xy[network.edge_to, 0], to_y=network.node_xy[network.edge_to, 1])
+
+def create_network_dataset(path = None, name: str = None) -> NetworkDataset:
+  """Create a local network dataset for analysis that defaults to ELVEG.
+     Networks are loaded once pr process and reused."""
+
+  if isinstance(path, NetworkDataset):
+    return path
+
+  path = path if path is not None else ELVEG_EDGES
+  if path not in _networks:
+    log.info(f'Loading network edges from {path}...')
+    _networks[path] = NetworkDataset(read_edges(path), name)
+    log.info(f'Loaded network with {_networks[path].node_count} nodes and {_networks[path].edge_count} edges')
+  return _networks[path]
@@ -0,0 +1,123 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from modules.local.dataset import read_dataset, get_oids, get_xy
+from modules.object import set_attributes
+from modules.log import Log
+from .network_dataset import create_network_dataset, NetworkDataset
+from .result import SolverResult, MessageSeverity
+log = Log()
+
+class OriginDestinationCostMatrixInputDataType:
+  Origins = 'Origins'
+  Destinations = 'Destinations'
+
+class OriginDestinationCostMatrixOutputDataType:
+  Lines = 'Lines'
+
+defaults = {
+  'travelMode': 'Gange',
+  'defaultImpedanceCutoff':15,
+  'defaultDestinationCount': None
+}
+
+class OriginDestinationCostMatrix:
+  """Origin destination cost matrix solved on a local network dataset"""
+  def __init__(self, network: NetworkDataset) -> None:
+    self.network = network
+    self.inputs = {}
+
+  def load(self, input_type, features, field_mappings = None, append: bool = False) -> None:
+    self.inputs[input_type] = read_dataset(features)
+
+  def solve(self) -> SolverResult:
+    origins = self.inputs[OriginDestinationCostMatrixInputDataType.Origins]
+    destinations = self.inputs[OriginDestinationCostMatrixInputDataType.Destinations]
+    return SolverResult({
+      OriginDestinationCostMatrixOutputDataType.Lines: solve_od_lines(
+        self.network, origins, destinations, self.defaultImpedanceCutoff, self.defaultDestinationCount)
+    })
+
+def solve_od_lines(network: NetworkDataset, origins: np.ndarray, destinations: np.ndarray, cutoff: float = None, k: int = None) -> np.ndarray:
+  """Finds the cost from each origin to the nearest destinations
+
+  Args:
+    network (NetworkDataset): The network to solve on
+    origins, destinations (np.ndarray): Point datasets
+    cutoff (float): Optional; Maximum cost in minutes
+    k (int): Optional; Number of destinations to find for each origin
+
+  Returns:
+    np.ndarray: OD lines with OriginOID, DestinationOID, DestinationRank, Total_Time (minutes),
+                Total_Distance (kilometers) and SHAPE@LENGTH (straight line meters)
+  """
+  origin_xy = get_xy(origins)
+  destination_xy = get_xy(destinations)
+  origin_located = network.locate_points(origins)
+  destination_index = network.index_destinations(network.locate_points(destinations))
+
+  rows = []
+  for i, origin in enumerate(origin_located):
+    for rank, (minutes, meters, destination) in enumerate(network.nearest(origin, destination_index, k, cutoff), 1):
+      rows.append((i, destination, rank, minutes, meters))
+
+  lines = np.array(rows, dtype=[('o', np.int64), ('d', np.int64), ('rank', np.int64), ('minutes', np.float64), ('meters', np.float64)])
+  result = np.empty(len(lines), dtype=[
+    ('OriginOID', np.int64), ('DestinationOID', np.int64), ('DestinationRank', np.int64),
+    ('Total_Time', np.float64), ('Total_Distance', np.float64), ('SHAPE@LENGTH', np.float64)
+  ])
+  result['OriginOID'] = get_oids(origins)[lines['o']]
+  result['DestinationOID'] = get_oids(destinations)[lines['d']]
+  result['DestinationRank'] = lines['rank']
+  result['Total_Time'] = lines['minutes']
+  result['Total_Distance'] = lines['meters'] / 1000
+  result['SHAPE@LENGTH'] = np.hypot(*(origin_xy[lines['o']] - destination_xy[lines['d']]).T)
+  return result
+
+def cost_matrix(network: NetworkDataset, origins: np.ndarray, destinations: np.ndarray, cutoff: float = None) -> csr_matrix:
+  """Returns a sparse origin by destination matrix with the walking cost in minutes for all
+     pairs within the cutoff. Origins and destinations are point datasets or (n, 2) coordinates.
+     Pairs with zero cost are stored as explicit zeros."""
+
+  origin_located = network.locate_points(origins)
+  destination_index = network.index_destinations(network.locate_points(destinations))
+
+  indptr = [0]
+  indices = []
+  data = []
+  for origin in origin_located:
+    for minutes, _, destination in network.nearest(origin, destination_index, None, cutoff):
+      indices.append(destination)
+      data.append(minutes)
+    indptr.append(len(indices))
+
+  return csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+                    shape=(len(origins), len(destinations)))
+
+def create_origin_destination_analysis(options: dict, network = None) -> OriginDestinationCostMatrix:
+  """Creates and configures a local origin destination matrix analysis
+     using ELVEG as default network"""
+
+  log.info('Creating and configuring local OD Matrix analysis...')
+  nd = create_network_dataset(network)
+  od_matrix = OriginDestinationCostMatrix(nd)
+  set_attributes(od_matrix, options, defaults)
+  return od_matrix
+
+@log.timed()
+def load_and_solve_od_matrix(od_matrix, origins, destinations):
+  od_matrix.load(OriginDestinationCostMatrixInputDataType.Origins, origins)
+  log.info(f'Loaded {len(od_matrix.inputs[OriginDestinationCostMatrixInputDataType.Origins])} origins...')
+
+  od_matrix.load(OriginDestinationCostMatrixInputDataType.Destinations, destinations)
+  log.info(f'Loaded {len(od_matrix.inputs[OriginDestinationCostMatrixInputDataType.Destinations])} destinations...')
+
+  log.info(f'Solving OD Matrix finding {od_matrix.defaultDestinationCount} destinations for each origin...')
+  return od_matrix.solve()
+
+def get_od_lines(result, output: str) -> None:
+  if result.solveSucceeded:
+    log.info(f'Exporting resulting OD matrix lines...')
+    result.export(OriginDestinationCostMatrixOutputDataType.Lines, output)
+  else:
+    log.error('Solving the od matrix failed! Message: ')
+    log.error(result.solverMessages(MessageSeverity.All))
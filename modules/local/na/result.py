@@ -0,0 +1,45 @@
+import numpy as np
+from modules.local.dataset import write_dataset
+
+class MessageSeverity:
+  All = 'All'
+  Error = 'Error'
+  Warning = 'Warning'
+  Informative = 'Informative'
+
+class SolverResult:
+  """Result of a local network analysis, mimics the arcpy.nax result objects
+
+  Args:
+    tables (dict): Structured arrays with the output of the solve by output data type
+    messages (list): Optional; List of (severity, message) tuples from the solver
+
+  Attributes:
+    solveSucceeded (bool): True if the solve produced a result
+  """
+  def __init__(self, tables: dict, messages: list = None, succeeded: bool = True) -> None:
+    self.tables = tables
+    self.messages = messages if messages is not None else []
+    self.solveSucceeded = succeeded
+
+  def table(self, output_type) -> np.ndarray:
+    """Returns the output as a NumPy structured array"""
+    return self.tables[output_type]
+
+  def count(self, output_type) -> int:
+    return len(self.tables[output_type])
+
+  def export(self, output_type, output_dataset: str) -> str:
+    """Writes the output to a .npy or .csv file"""
+    return write_dataset(self.tables[output_type], output_dataset)
+
+  def searchCursor(self, output_type, field_names: list):
+    """Returns an iterator over the output rows with the requested fields"""
+    data = self.tables[output_type]
+    return iter(list(zip(*[data[field].tolist() for field in field_names])))
+
+  def solverMessages(self, severity = MessageSeverity.All) -> str:
+    return '\n'.join(
+      f'{s}: {m}' for s, m in self.messages
+      if severity == MessageSeverity.All or s == severity
+    )
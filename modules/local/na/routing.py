@@ -0,0 +1,84 @@
+import numpy as np
+from modules.local.dataset import read_dataset, get_oids
+from modules.object import set_attributes
+from modules.local.solvers.tour import solve_tour
+from modules.log import Log
+from .network_dataset import create_network_dataset, NetworkDataset
+from .result import SolverResult, MessageSeverity
+log = Log()
+
+class RouteInputDataType:
+  Stops = 'Stops'
+
+class RouteOutputDataType:
+  Routes = 'Routes'
+  Stops = 'Stops'
+
+defaults = {
+  'travelMode': 'Gange',
+  'findBestSequence': True,
+  'timeLimit': None
+}
+
+class Route:
+  """Route through a set of stops solved on a local network dataset"""
+  def __init__(self, network: NetworkDataset) -> None:
+    self.network = network
+    self.inputs = {}
+
+  def load(self, input_type, features, field_mappings = None, append: bool = False) -> None:
+    self.inputs[input_type] = read_dataset(features)
+
+  def solve(self) -> SolverResult:
+    stops = self.inputs[RouteInputDataType.Stops]
+    if len(stops) < 2:
+      return SolverResult({}, [(MessageSeverity.Error, f'Need at least 2 stops to solve a route, got {len(stops)}')], False)
+
+    minutes, meters = stop_cost_matrix(self.network, stops)
+    if not np.isfinite(minutes).all():
+      return SolverResult({}, [(MessageSeverity.Error, 'Some stops are not reachable from each other')], False)
+
+    if self.findBestSequence:
+      sequence = solve_tour(minutes, time_limit=self.timeLimit).sequence
+    else:
+      sequence = np.arange(len(stops))
+    legs = (sequence[:-1], sequence[1:])
+    routes = np.array([('Route', minutes[legs].sum(), meters[legs].sum() / 1000)],
+                      dtype=[('Name', 'U16'), ('Total_Minutes', np.float64), ('Total_Kilometers', np.float64)])
+
+    stops_out = np.empty(len(stops), dtype=[('ObjectID', np.int64), ('Sequence', np.int64)])
+    stops_out['ObjectID'] = get_oids(stops)[sequence]
+    stops_out['Sequence'] = np.arange(1, len(stops) + 1)
+    return SolverResult({RouteOutputDataType.Routes: routes, RouteOutputDataType.Stops: stops_out})
+
+def stop_cost_matrix(network: NetworkDataset, stops: np.ndarray) -> tuple:
+  """Returns the stop to stop walking cost matrices (minutes, meters) of a point dataset or (n, 2) coordinates"""
+
+  located = network.locate_points(stops)
+  minutes = np.empty((len(located), len(located)))
+  meters = np.empty((len(located), len(located)))
+  for i, stop in enumerate(located):
+    minutes[i], meters[i] = network.path_costs(stop, located)
+  return minutes, meters
+
+def create_route_analysis(options: dict, network = None) -> Route:
+  """Creates and configures a local route analysis
+     using ELVEG as default network"""
+
+  nd = create_network_dataset(network)
+  route = Route(nd)
+  set_attributes(route, options, defaults)
+  return route
+
+@log.timed()
+def load_and_solve_route(route: Route, stops):
+  route.load(RouteInputDataType.Stops, stops)
+  log.info(f'Solving route with {len(route.inputs[RouteInputDataType.Stops])} stops...')
+  return route.solve()
+
+def get_routes_cursor(result):
+  if result.solveSucceeded:
+    return result.searchCursor(RouteOutputDataType.Routes, ['Total_Minutes', 'Total_Kilometers'])
+  else:
+    log.warning(f'Not able to find a route for the provided stops')
+    log.error(result.solverMessages(MessageSeverity.All))
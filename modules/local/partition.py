@@ -0,0 +1,94 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+class Partition:
+  """Rectangular tiles from a balanced recursive bisection of a set of points: a tile with
+     more than max_points points is split at the median of its longest side.
+
+  Args:
+    xy (np.ndarray): Point coordinates as a (n, 2) array
+    max_points (int): Max number of points in a tile
+
+  Attributes:
+    bounds (np.ndarray): (xmin, ymin, xmax, ymax) of each tile, outer tiles are unbounded
+    tile_of_point (np.ndarray): Tile index of each of the points
+  """
+  def __init__(self, xy: np.ndarray, max_points: int) -> None:
+    tiles = []
+    stack = [(np.arange(len(xy)), np.array([-np.inf, -np.inf, np.inf, np.inf]))]
+    while stack:
+      indexes, bounds = stack.pop()
+      if len(indexes) <= max_points:
+        tiles.append(bounds)
+        continue
+
+      extent = xy[indexes].max(axis=0) - xy[indexes].min(axis=0)
+      axis = int(np.argmax(extent))
+      threshold = float(np.median(xy[indexes, axis]))
+      lower = xy[indexes, axis] < threshold
+      if lower.all() or not lower.any(): # All points on the same coordinate, can not be split
+        tiles.append(bounds)
+        continue
+
+      upper_bounds, lower_bounds = bounds.copy(), bounds.copy()
+      lower_bounds[axis + 2] = threshold
+      upper_bounds[axis] = threshold
+      stack.append((indexes[~lower], upper_bounds))
+      stack.append((indexes[lower], lower_bounds))
+
+    self.bounds = np.array(tiles)
+    self.tile_of_point = self.tile_of(xy)
+
+  def tile_of(self, xy: np.ndarray) -> np.ndarray:
+    """Returns the tile index of each point, tiles include their lower bounds"""
+
+    tile = np.full(len(xy), -1, dtype=np.int64)
+    for i, (xmin, ymin, xmax, ymax) in enumerate(self.bounds.tolist()):
+      tile[(xy[:, 0] >= xmin) & (xy[:, 0] < xmax) & (xy[:, 1] >= ymin) & (xy[:, 1] < ymax)] = i
+    return tile
+
+  def groups(self, tile_of_point: np.ndarray = None) -> list:
+    """Returns the point indexes in each tile"""
+
+    tile_of_point = tile_of_point if tile_of_point is not None else self.tile_of_point
+    order = np.argsort(tile_of_point, kind='stable')
+    starts = np.searchsorted(tile_of_point[order], np.arange(len(self.bounds) + 1))
+    return [order[starts[i]:starts[i + 1]] for i in range(len(self.bounds))]
+
+def share_facilities(tile_weights: np.ndarray, facility_count: int, tile_capacity: np.ndarray = None) -> np.ndarray:
+  """Shares the facilities between the tiles in proportion to their demand weight (largest
+     remainder). Tiles with demand get at least one facility when there are enough, and no
+     tile gets more than its capacity (e.g. its number of candidate facilities).
+
+  Returns:
+    np.ndarray: Number of facilities pr tile
+  """
+  tile_weights = np.asarray(tile_weights, dtype=np.float64)
+  tile_capacity = np.asarray(tile_capacity) if tile_capacity is not None else np.full(len(tile_weights), facility_count)
+  exact = tile_weights / tile_weights.sum() * facility_count
+  shares = np.minimum(np.floor(exact).astype(np.int64), tile_capacity)
+  if facility_count >= (tile_weights > 0).sum():
+    shares = np.maximum(shares, np.minimum((tile_weights > 0).astype(np.int64), tile_capacity))
+
+  remainders = exact - shares
+  while shares.sum() < facility_count:
+    open_tiles = shares < tile_capacity
+    if not open_tiles.any():
+      break
+    i = int(np.argmax(np.where(open_tiles, remainders, -np.inf)))
+    shares[i] += 1
+    remainders[i] -= 1
+  while shares.sum() > facility_count:
+    i = int(np.argmin(np.where(shares > 1, remainders, np.inf)))
+    shares[i] -= 1
+    remainders[i] += 1
+  return shares
+
+def seam_candidates(xy: np.ndarray, tile_of_point: np.ndarray, facility_xy: np.ndarray, facility_tile: np.ndarray) -> np.ndarray:
+  """Returns the indexes of the points whose nearest (Euclidean) chosen facility is in
+     another tile. These are the points near tile seams that may be better served across it."""
+
+  if len(facility_xy) == 0:
+    return np.empty(0, dtype=np.int64)
+  _, nearest = cKDTree(facility_xy).query(xy)
+  return np.flatnonzero(facility_tile[nearest] != tile_of_point)
@@ -0,0 +1,231 @@
+"""
+Local search that balances the walk time of areas by moving boundary stops between adjacent
+areas, e.g. after split_areas and merge_areas.
+
+Each area keeps a cached open tour through its stops (see modules.local.solvers.tour). The
+walk time change of a move is estimated from the tours without solving them again: the
+removal gain of the stop from its position in the source tour and the cheapest insertion of
+the stop between two consecutive stops (or at an end) of the target tour. A move is made if
+it lowers the variance of the area walk times plus a weight on the squared mean (so moves do
+not just add walk time), and keeps the unit count of both areas within [min_count, max_count].
+Only stops with a nearest neighbour in another area are moved, so the areas stay contiguous
+in practice. The tours of the changed areas are solved again after the moves, and the
+original areas are kept if the objective of the solved walk times is worse than before.
+"""
+
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from modules.local.solvers.tour import solve_tour, submatrix, WALK_SPEED, DETOUR_FACTOR
+
+NEIGHBORS = 8 # Nearest stops checked for a stop in another area
+TOTAL_WEIGHT = 0.5 # Weight of the squared mean walk time against the variance in the objective
+MIN_IMPROVEMENT = 1e-6 # Smallest objective decrease counted as an improvement
+
+class PairCosts:
+  """Vectorized lookup of the symmetric cost between pairs of stops in a sparse cost matrix.
+     The cost is the mean of the two directions, or the one direction found. Pairs missing
+     in both directions are estimated from the straight line distance like tour.submatrix.
+
+  Args:
+    matrix (csr_matrix): Stop to stop cost matrix (e.g. walk minutes)
+    xy (np.ndarray): Stop coordinates as a (n, 2) array
+    fallback_speed (float): Optional; Meters pr cost unit for pairs missing in the matrix
+  """
+  def __init__(self, matrix: csr_matrix, xy: np.ndarray, fallback_speed: float = WALK_SPEED) -> None:
+    matrix = csr_matrix(matrix)
+    self.n = matrix.shape[1]
+    rows = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr))
+    columns = matrix.indices.astype(np.int64)
+    keys = np.concatenate([rows * self.n + columns, columns * self.n + rows])
+    self.keys, pair = np.unique(keys, return_inverse=True)
+    self.values = np.bincount(pair, np.tile(matrix.data.astype(np.float64), 2)) / np.bincount(pair)
+    self.xy = xy
+    self.fallback_speed = fallback_speed
+
+  def __call__(self, a, b) -> np.ndarray:
+    a, b = np.broadcast_arrays(np.atleast_1d(np.asarray(a, dtype=np.int64)), np.atleast_1d(np.asarray(b, dtype=np.int64)))
+    keys = a * self.n + b
+    position = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+    found = self.keys[position] == keys if len(self.keys) > 0 else np.zeros(keys.shape, dtype=bool)
+    cost = np.where(found, self.values[position] if len(self.keys) > 0 else 0, 0.0)
+    missing = ~found & (a != b)
+    if missing.any():
+      distance = np.hypot(*(self.xy[a[missing]] - self.xy[b[missing]]).T)
+      cost[missing] = distance * DETOUR_FACTOR / self.fallback_speed
+    return cost
+
+def removal_gains(costs: PairCosts, tour: np.ndarray, edges: np.ndarray) -> np.ndarray:
+  """Returns the decrease of the cost of an open tour when each of its stops is removed
+
+  Args:
+    costs (PairCosts): Cost between stops
+    tour (np.ndarray): Stops in visiting order
+    edges (np.ndarray): Cost of each edge of the tour (len(tour) - 1)
+  """
+  if len(tour) < 2:
+    return np.zeros(len(tour))
+  gains = np.zeros(len(tour))
+  gains[:-1] += edges
+  gains[1:] += edges
+  gains[1:-1] -= costs(tour[:-2], tour[2:]) # The edge joining the neighbours of a removed stop
+  return gains
+
+def cheapest_insertion(costs: PairCosts, tour: np.ndarray, edges: np.ndarray, stop: int) -> tuple:
+  """Returns the increase of the cost of an open tour by the cheapest insertion of the stop,
+     and the position to insert it at"""
+
+  if len(tour) == 0:
+    return 0.0, 0
+  to_stop = costs(tour, stop)
+  options = np.concatenate([to_stop[:1], to_stop[:-1] + to_stop[1:] - edges, to_stop[-1:]]) # Before the first, between, after the last
+  position = int(np.argmin(options))
+  return float(options[position]), position
+
+def balance_metrics(times: np.ndarray) -> dict:
+  """Returns the mean, standard deviation, coefficient of variation, min, max and range of the area walk times"""
+
+  times = np.asarray(times, dtype=np.float64)
+  if len(times) == 0:
+    return {'areas': 0, 'mean': 0.0, 'std': 0.0, 'cv': 0.0, 'min': 0.0, 'max': 0.0, 'range': 0.0}
+  mean = float(times.mean())
+  std = float(times.std())
+  return {
+    'areas': len(times), 'mean': mean, 'std': std, 'cv': std / mean if mean > 0 else 0.0,
+    'min': float(times.min()), 'max': float(times.max()), 'range': float(times.max() - times.min())
+  }
+
+def boundary_neighbors(xy: np.ndarray, area: np.ndarray, k: int = NEIGHBORS) -> list:
+  """Returns the nearest stops of each stop (up to k), for finding the areas it borders"""
+
+  tree = cKDTree(xy)
+  _, neighbors = tree.query(xy, k=min(k + 1, len(xy)))
+  neighbors = neighbors.reshape(len(xy), -1)
+  return [row[(row != i) & (row < len(xy))] for i, row in enumerate(neighbors)]
+
+class RebalanceResult:
+  """Result from rebalance_areas
+
+  Attributes:
+    area (np.ndarray): Area index of each stop after the moves
+    times_before, times_after (np.ndarray): Walk time of each area before and after, from the tours
+    before, after (dict): Balance metrics of the walk times before and after (see balance_metrics)
+    moves (int): Number of stops moved, 0 if the original areas were kept
+    passes (int): Number of passes over the areas
+    elapsed (float): Seconds used
+  """
+  def __init__(self, area, times_before, times_after, moves, passes, elapsed) -> None:
+    self.area = area
+    self.times_before = times_before
+    self.times_after = times_after
+    self.before = balance_metrics(times_before)
+    self.after = balance_metrics(times_after)
+    self.moves = moves
+    self.passes = passes
+    self.elapsed = elapsed
+
+def rebalance_areas(cost: csr_matrix, xy: np.ndarray, area: np.ndarray, weights: np.ndarray = None,
+                    min_count: int = 0, max_count: int = None, total_weight: float = TOTAL_WEIGHT, time_limit: float = 60,
+                    tour_time_limit: float = 0.5, log = None) -> RebalanceResult:
+  """Moves boundary stops between adjacent areas to lower the variance of the area walk times
+
+  Args:
+    cost (csr_matrix): Stop to stop cost matrix (e.g. walk minutes), missing pairs are estimated
+    xy (np.ndarray): Stop coordinates as a (n, 2) array
+    area (np.ndarray): Area index (0 to areas - 1) of each stop
+    weights (np.ndarray): Optional; Number of units at each stop, default is one
+    min_count, max_count (int): Optional; Bounds on the number of units pr area for a move to be made
+    total_weight (float): Optional; Weight of the squared mean walk time in the objective, 0 minimizes the variance
+      only even if the total walk time grows
+    time_limit (float): Optional; Time budget in seconds for the moves, the tours are solved before and after
+    tour_time_limit (float): Optional; Time budget in seconds for solving the tour of an area
+    log (Log): Optional; Log for progress messages
+
+  Returns:
+    RebalanceResult: The new area of each stop with the walk times and balance metrics before and after
+  """
+  start = time.perf_counter()
+  original = np.asarray(area, dtype=np.int64)
+  area = original.copy()
+  weights = np.ones(len(xy), dtype=np.int64) if weights is None else np.asarray(weights)
+  max_count = max_count if max_count is not None else int(weights.sum())
+  areas = int(area.max()) + 1 if len(area) > 0 else 0
+  costs = PairCosts(cost, xy)
+
+  def solve(stops):
+    if len(stops) < 2:
+      return stops, 0.0
+    result = solve_tour(submatrix(cost, stops, xy), time_limit=tour_time_limit)
+    return stops[result.sequence], result.total_cost
+
+  tours, times = [], np.zeros(areas)
+  for a in range(areas):
+    tour, times[a] = solve(np.flatnonzero(area == a))
+    tours.append(tour)
+  edges = [costs(tour[:-1], tour[1:]) for tour in tours]
+  times_before = times.copy()
+  counts = np.bincount(area, weights=weights, minlength=areas)
+  if log is not None:
+    log.info(f'Tur for {areas} roder løst på {round(time.perf_counter() - start, 1)} s, standardavvik {round(float(times.std()), 1)} min')
+
+  neighbors = boundary_neighbors(xy, area) if len(xy) > 1 else [np.zeros(0, dtype=np.int64)] * len(xy)
+  deadline = time.perf_counter() + time_limit
+  objective = lambda total, squares: squares / areas - (1 - total_weight) * (total / areas) ** 2 # Variance + total_weight * mean²
+  total, squares = times.sum(), (times ** 2).sum()
+  moves, passes, improved = 0, 0, True
+  changed = np.zeros(areas, dtype=bool)
+
+  while improved and time.perf_counter() < deadline:
+    improved = False
+    passes += 1
+    for a in np.argsort(-times).tolist(): # Longest walk time first
+      if time.perf_counter() > deadline:
+        break
+      best = None
+      gains = None
+      for position, stop in enumerate(tours[a].tolist()):
+        if counts[a] - weights[stop] < max(min_count, 1):
+          continue
+        targets = {b for b in area[neighbors[stop]].tolist() if b != a and times[b] < times[a] and counts[b] + weights[stop] <= max_count}
+        if not targets:
+          continue
+        gains = removal_gains(costs, tours[a], edges[a]) if gains is None else gains
+        gain = gains[position]
+        for b in targets:
+          increase, insert_at = cheapest_insertion(costs, tours[b], edges[b], stop)
+          time_a, time_b = times[a] - gain, times[b] + increase
+          new_total = total - gain + increase
+          new_squares = squares - times[a] ** 2 - times[b] ** 2 + time_a ** 2 + time_b ** 2
+          delta = objective(new_total, new_squares) - objective(total, squares)
+          if delta < -MIN_IMPROVEMENT and (best is None or delta < best[0]):
+            best = (delta, position, stop, b, gain, increase, insert_at)
+
+      if best is None:
+        continue
+      _, position, stop, b, gain, increase, insert_at = best
+      total += increase - gain
+      squares += (times[a] - gain) ** 2 + (times[b] + increase) ** 2 - times[a] ** 2 - times[b] ** 2
+      times[a] -= gain
+      times[b] += increase
+      counts[a] -= weights[stop]
+      counts[b] += weights[stop]
+      tours[a] = np.delete(tours[a], position)
+      tours[b] = np.insert(tours[b], insert_at, stop)
+      edges[a] = costs(tours[a][:-1], tours[a][1:])
+      edges[b] = costs(tours[b][:-1], tours[b][1:])
+      area[stop] = b
+      changed[[a, b]] = True
+      moves += 1
+      improved = True
+
+  # The tours of the changed areas are solved again for the walk times after
+  for a in np.flatnonzero(changed).tolist():
+    tours[a], times[a] = solve(tours[a])
+  if moves > 0 and objective(times.sum(), (times ** 2).sum()) > objective(times_before.sum(), (times_before ** 2).sum()):
+    if log is not None:
+      log.info(f'Gangtiden etter {moves} flyttinger er dårligere enn før (standardavvik {round(float(times.std()), 1)} min), beholder de opprinnelige rodene')
+    return RebalanceResult(original.copy(), times_before, times_before.copy(), 0, passes, time.perf_counter() - start)
+  if log is not None:
+    log.info(f'{moves} stopp flyttet mellom {int(changed.sum())} roder i {passes} runder, standardavvik {round(float(times_before.std()), 1)} -> {round(float(times.std()), 1)} min')
+  return RebalanceResult(area, times_before, times, moves, passes, time.perf_counter() - start)
@@ -0,0 +1,181 @@
+"""
+Capacitated p-median location-allocation on a sparse, cutoff limited cost matrix.
+
+Facilities are seeded with greedy-add and improved with vertex substitution
+(Teitz-Bart), evaluating each swap with the best and second best open facility
+of every demand point. With a capacity the allocation is done greedily by
+increasing cost, and a swap is only kept if it improves the capacitated objective.
+"""
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+from modules.log import Log
+log = Log()
+
+class PMedianResult:
+  """Result from the p-median solver
+
+  Attributes:
+    facilities (np.ndarray): Index of the chosen facilities
+    allocation (np.ndarray): Chosen facility index for each demand point, -1 if not allocated
+    objective (float): Weighted cost of the allocation (unallocated demand at the penalty cost)
+    iterations (int): Number of vertex substitution passes
+    elapsed (float): Solve time in seconds
+  """
+  def __init__(self, facilities, allocation, objective, iterations, elapsed) -> None:
+    self.facilities = facilities
+    self.allocation = allocation
+    self.objective = objective
+    self.iterations = iterations
+    self.elapsed = elapsed
+
+def solve_pmedian(costs: csr_matrix, facility_count: int, capacity: float = None, weights: np.ndarray = None,
+                  max_iterations: int = 20, time_limit: float = None) -> PMedianResult:
+  """Chooses facilities and allocates demand to minimize the total weighted cost
+
+  Args:
+    costs (csr_matrix): Facility by demand point cost matrix, only pairs within the impedance cutoff are stored
+    facility_count (int): Number of facilities to choose
+    capacity (float): Optional; Maximum weighted demand allocated to each facility
+    weights (np.ndarray): Optional; Weight of each demand point, default is 1
+    max_iterations (int): Optional; Maximum number of vertex substitution passes over the candidates
+    time_limit (float): Optional; Time budget in seconds for the improvement phase
+
+  Returns:
+    PMedianResult: The chosen facilities and the allocation
+  """
+  start = time.perf_counter()
+  costs = csr_matrix(costs)
+  weights = np.ones(costs.shape[1]) if weights is None else np.asarray(weights, dtype=np.float64)
+  penalty = (costs.data.max() if costs.nnz > 0 else 1) * 10 # Cost of unallocated demand
+  matrix = _Matrix(costs, weights, penalty)
+
+  open_facilities = matrix.greedy_add(min(facility_count, costs.shape[0]))
+  objective, allocation = matrix.evaluate(open_facilities, capacity)
+  log.info(f'Greedy seeding chose {len(open_facilities)} facilities with objective {round(objective, 1)}')
+
+  iterations = 0
+  deadline = start + time_limit if time_limit is not None else None
+  improved = True
+  while improved and iterations < max_iterations:
+    iterations += 1
+    improved = False
+    for candidate in np.random.default_rng(iterations).permutation(costs.shape[0]).tolist():
+      if deadline is not None and time.perf_counter() > deadline:
+        log.info(f'Time budget of {time_limit} s used, stopping improvement')
+        improved = False
+        break
+      if candidate in open_facilities:
+        continue
+
+      removed, delta = matrix.best_swap(open_facilities, candidate)
+      if removed is None or delta >= -1e-9:
+        continue
+
+      swapped = open_facilities - {removed} | {candidate}
+      swapped_objective, swapped_allocation = matrix.evaluate(swapped, capacity)
+      if swapped_objective < objective - 1e-9:
+        open_facilities, objective, allocation = swapped, swapped_objective, swapped_allocation
+        improved = True
+
+  log.info(f'Vertex substitution finished after {iterations} passes with objective {round(objective, 1)}')
+  return PMedianResult(np.array(sorted(open_facilities), dtype=np.int64), allocation, objective,
+                       iterations, time.perf_counter() - start)
+
+class _Matrix:
+  """Cost matrix with the bookkeeping needed for fast swap evaluation"""
+  def __init__(self, costs: csr_matrix, weights: np.ndarray, penalty: float) -> None:
+    self.costs = costs
+    self.weights = weights
+    self.penalty = penalty
+    self.rows = np.repeat(np.arange(costs.shape[0]), np.diff(costs.indptr))
+    self.order = np.lexsort((costs.data, costs.indices)) # Entries sorted by demand point, then cost
+    self.best = None
+
+  def row(self, facility: int) -> tuple:
+    s = slice(self.costs.indptr[facility], self.costs.indptr[facility + 1])
+    return self.costs.indices[s], self.costs.data[s]
+
+  def greedy_add(self, count: int) -> set:
+    """Repeatedly adds the facility that reduces the total weighted cost the most"""
+
+    current = np.full(self.costs.shape[1], self.penalty)
+    chosen = set()
+    for _ in range(count):
+      savings = np.bincount(self.rows, self.weights[self.costs.indices] * np.maximum(current[self.costs.indices] - self.costs.data, 0),
+                            minlength=self.costs.shape[0])
+      savings[list(chosen)] = -1
+      best = int(np.argmax(savings))
+      if savings[best] < 0:
+        break
+      chosen.add(best)
+      demand, cost = self.row(best)
+      current[demand] = np.minimum(current[demand], cost)
+    return chosen
+
+  def nearest_two(self, facilities: set) -> None:
+    """Finds the best and second best open facility for each demand point"""
+
+    n = self.costs.shape[1]
+    is_open = np.zeros(self.costs.shape[0], dtype=bool)
+    is_open[list(facilities)] = True
+    entries = self.order[is_open[self.rows[self.order]]]
+    demand = self.costs.indices[entries]
+    first = np.ones(len(entries), dtype=bool)
+    first[1:] = demand[1:] != demand[:-1]
+    second = np.zeros(len(entries), dtype=bool)
+    second[1:] = ~first[1:] & first[:-1]
+
+    self.d1 = np.full(n, self.penalty)
+    self.d2 = np.full(n, self.penalty)
+    self.a1 = np.full(n, -1, dtype=np.int64)
+    self.d1[demand[first]] = self.costs.data[entries[first]]
+    self.a1[demand[first]] = self.rows[entries[first]]
+    self.d2[demand[second]] = self.costs.data[entries[second]]
+    self.open_list = np.array(sorted(facilities), dtype=np.int64)
+    self.loss = np.bincount(self.a1[self.a1 >= 0], (self.weights * (self.d2 - self.d1))[self.a1 >= 0], minlength=self.costs.shape[0])
+    self.best = facilities
+
+  def best_swap(self, facilities: set, candidate: int) -> tuple:
+    """Returns the open facility to swap out for the candidate and the (uncapacitated) cost change"""
+
+    if self.best is not facilities:
+      self.nearest_two(facilities)
+
+    demand, cost = self.row(candidate)
+    w, d1, d2, a1 = self.weights[demand], self.d1[demand], self.d2[demand], self.a1[demand]
+    gain = (w * np.maximum(d1 - cost, 0)).sum()
+
+    # Demand on the removed facility moves to the candidate or its second best facility
+    corrections = w * (np.where(cost < d1, 0, np.minimum(cost, d2) - d1) - (d2 - d1))
+    if len(self.open_list) == 0:
+      return None, 0
+    loss = self.loss[self.open_list] + np.bincount(np.searchsorted(self.open_list, a1[a1 >= 0]), corrections[a1 >= 0],
+                                                   minlength=len(self.open_list))
+    i = int(np.argmin(loss))
+    return int(self.open_list[i]), loss[i] - gain
+
+  def evaluate(self, facilities: set, capacity: float = None) -> tuple:
+    """Allocates demand to the open facilities and returns the objective and allocation"""
+
+    if capacity is None:
+      self.nearest_two(facilities)
+      objective = (self.weights * self.d1).sum()
+      return objective, self.a1.copy()
+
+    is_open = np.zeros(self.costs.shape[0], dtype=bool)
+    is_open[list(facilities)] = True
+    entries = np.flatnonzero(is_open[self.rows])
+    entries = entries[np.argsort(self.costs.data[entries], kind='stable')]
+
+    allocation = [-1] * self.costs.shape[1]
+    cost = [self.penalty] * self.costs.shape[1]
+    remaining = [float(capacity)] * self.costs.shape[0]
+    weights = self.weights.tolist()
+    for facility, demand, c in zip(self.rows[entries].tolist(), self.costs.indices[entries].tolist(), self.costs.data[entries].tolist()):
+      if allocation[demand] < 0 and remaining[facility] >= weights[demand]:
+        allocation[demand] = facility
+        cost[demand] = c
+        remaining[facility] -= weights[demand]
+
+    return (self.weights * np.array(cost)).sum(), np.array(allocation, dtype=np.int64)
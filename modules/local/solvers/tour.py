@@ -0,0 +1,163 @@
+"""
+Heuristic sequencing of stops for estimating the walk time of an area.
+
+A nearest neighbour tour is improved with 2-opt and Or-opt moves where the cost
+change of every move from a position is evaluated at once with NumPy. Open paths
+(free start and end stop) are solved as a closed tour through a dummy stop with
+zero cost to every other stop.
+"""
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+
+WALK_SPEED = 5000 / 60 # Meters pr minute, used for pairs missing in the cost matrix
+DETOUR_FACTOR = 1.3 # Ratio between network and straight line distance for missing pairs
+
+class TourResult:
+  """Result from the tour solver
+
+  Attributes:
+    sequence (np.ndarray): Stop indexes in visiting order
+    total_cost (float): Cost of the tour (e.g. minutes)
+    total_length (float): Length of the tour, if a length matrix was given
+    iterations (int): Number of improving moves
+    elapsed (float): Solve time in seconds
+  """
+  def __init__(self, sequence, total_cost, total_length, iterations, elapsed) -> None:
+    self.sequence = sequence
+    self.total_cost = total_cost
+    self.total_length = total_length
+    self.iterations = iterations
+    self.elapsed = elapsed
+
+def solve_tour(cost: np.ndarray, length: np.ndarray = None, closed: bool = False,
+               max_iterations: int = 10000, time_limit: float = None) -> TourResult:
+  """Finds a short sequence visiting all stops
+
+  Args:
+    cost (np.ndarray): Stop to stop cost matrix (e.g. walk minutes)
+    length (np.ndarray): Optional; Stop to stop length matrix, summed along the final sequence
+    closed (bool): Optional; Return to the first stop. Default is an open path with free end points
+    max_iterations (int): Optional; Maximum number of improving moves
+    time_limit (float): Optional; Time budget in seconds for the improvement phase
+
+  Returns:
+    TourResult: The sequence with total cost and length
+  """
+  start = time.perf_counter()
+  cost = np.asarray(cost, dtype=np.float64)
+  n = len(cost)
+  if n < 2:
+    return TourResult(np.arange(n), 0.0, 0.0 if length is not None else None, 0, 0.0)
+
+  # Symmetric costs for the moves, the tour direction is chosen at the end
+  matrix = (cost + cost.T) / 2
+  if not closed:
+    matrix = np.pad(matrix, ((0, 1), (0, 1)))
+
+  tour = nearest_neighbor_tour(matrix)
+  deadline = start + time_limit if time_limit is not None else None
+  iterations = 0
+  improved = True
+  while improved and iterations < max_iterations:
+    if deadline is not None and time.perf_counter() > deadline:
+      break
+    improved = two_opt_move(matrix, tour) or or_opt_move(matrix, tour)
+    iterations += improved
+
+  if not closed:
+    dummy = int(np.flatnonzero(tour == n)[0])
+    tour = np.concatenate([tour[dummy + 1:], tour[:dummy]])
+
+  sequence = tour
+  if cost_along(cost, tour[::-1], closed) < cost_along(cost, tour, closed):
+    sequence = tour[::-1].copy()
+
+  return TourResult(sequence, cost_along(cost, sequence, closed),
+                    cost_along(length, sequence, closed) if length is not None else None,
+                    iterations, time.perf_counter() - start)
+
+def cost_along(matrix: np.ndarray, sequence: np.ndarray, closed: bool = False) -> float:
+  """Returns the sum of the matrix values along the sequence"""
+
+  if closed:
+    return float(matrix[sequence, np.roll(sequence, -1)].sum())
+  return float(matrix[sequence[:-1], sequence[1:]].sum())
+
+def nearest_neighbor_tour(matrix: np.ndarray, start: int = 0) -> np.ndarray:
+  """Returns a tour built by always going to the nearest unvisited stop"""
+
+  visited = np.zeros(len(matrix), dtype=bool)
+  tour = [start]
+  visited[start] = True
+  for _ in range(len(matrix) - 1):
+    row = np.where(visited, np.inf, matrix[tour[-1]])
+    tour.append(int(np.argmin(row)))
+    visited[tour[-1]] = True
+  return np.array(tour)
+
+def two_opt_move(matrix: np.ndarray, tour: np.ndarray) -> bool:
+  """Applies the best 2-opt move (reversing a part of the tour) in place if it shortens the tour"""
+
+  n = len(tour)
+  if n < 4:
+    return False
+  a = tour
+  b = np.roll(tour, -1)
+  delta = matrix[a[:, None], a[None, :]] + matrix[b[:, None], b[None, :]] - matrix[a, b][:, None] - matrix[a, b][None, :]
+  delta[np.tril_indices(n, 1)] = 0 # Only j > i + 1
+  delta[0, n - 1] = 0 # Same edge pair
+  i, j = np.unravel_index(np.argmin(delta), delta.shape)
+  if delta[i, j] >= -1e-9:
+    return False
+  tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1].copy()
+  return True
+
+def or_opt_move(matrix: np.ndarray, tour: np.ndarray, max_segment: int = 3) -> bool:
+  """Applies the first Or-opt move (moving a segment of 1-3 stops, optionally reversed,
+     to another position) in place that shortens the tour"""
+
+  n = len(tour)
+  for segment_length in range(1, min(max_segment, n - 3) + 1):
+    for i in range(n):
+      positions = (np.arange(segment_length) + i) % n
+      segment = tour[positions]
+      before = tour[(i - 1) % n]
+      after = tour[(i + segment_length) % n]
+      first, last = segment[0], segment[-1]
+      removal = matrix[before, first] + matrix[last, after] - matrix[before, after]
+
+      # Candidate edges (u, v) in the tour with the segment removed
+      rest = np.roll(tour, -(i + segment_length))[:n - segment_length]
+      u = rest[:-1]
+      v = rest[1:]
+      forward = matrix[u, first] + matrix[last, v] - matrix[u, v]
+      backward = matrix[u, last] + matrix[first, v] - matrix[u, v]
+      insertion = np.minimum(forward, backward)
+      k = int(np.argmin(insertion))
+      if insertion[k] - removal < -1e-9:
+        moved = segment if forward[k] <= backward[k] else segment[::-1]
+        tour[:] = np.concatenate([rest[:k + 1], moved, rest[k + 1:]])
+        return True
+  return False
+
+def submatrix(matrix: csr_matrix, rows: np.ndarray, xy: np.ndarray = None, fallback_speed: float = WALK_SPEED) -> np.ndarray:
+  """Returns a dense matrix for a subset of the rows/columns in a sparse cost matrix. Explicit
+     zeros are kept as zero cost. Missing pairs are estimated from the straight line distance
+     (meters) divided by the fallback speed when coordinates are given, else infinite."""
+
+  rows = np.asarray(rows, dtype=np.int64)
+  position = np.full(matrix.shape[1], -1, dtype=np.int64)
+  position[rows] = np.arange(len(rows))
+  dense = np.full((len(rows), len(rows)), np.inf)
+  for i, row in enumerate(rows.tolist()):
+    s = slice(matrix.indptr[row], matrix.indptr[row + 1])
+    columns = position[matrix.indices[s]]
+    dense[i, columns[columns >= 0]] = matrix.data[s][columns >= 0]
+
+  np.fill_diagonal(dense, 0)
+  if xy is not None:
+    missing = np.isinf(dense)
+    distance = np.hypot(*(xy[rows][:, None, :] - xy[rows][None, :, :]).transpose(2, 0, 1))
+    dense[missing] = distance[missing] * DETOUR_FACTOR / fallback_speed
+  return dense
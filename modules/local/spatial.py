@@ -0,0 +1,172 @@
+import math
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
+from shapely import STRtree
+
+class PointAssignment:
+  """Points grouped by the polygon (area) they are within
+
+  Args:
+    area_ids (np.ndarray): Id of each polygon
+    point_area (np.ndarray): Index of the polygon each point is within, -1 if outside all polygons
+
+  Attributes:
+    area_ids (np.ndarray): Id of each polygon
+    point_area (np.ndarray): Index of the polygon each point is within, -1 if outside all polygons
+    counts (np.ndarray): Number of points within each polygon
+    order (np.ndarray): Point indexes sorted by polygon, the points of polygon i are order[starts[i]:starts[i] + counts[i]]
+    starts (np.ndarray): Start of each polygon in order
+  """
+  def __init__(self, area_ids: np.ndarray, point_area: np.ndarray) -> None:
+    self.area_ids = np.asarray(area_ids)
+    self.point_area = point_area
+    inside = np.flatnonzero(point_area >= 0)
+    self.order = inside[np.argsort(point_area[inside], kind='stable')]
+    self.counts = np.bincount(point_area[inside], minlength=len(area_ids))
+    self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.int64)
+
+  def points(self, area_index: int) -> np.ndarray:
+    """Returns the indexes of the points within a polygon"""
+    return self.order[self.starts[area_index]:self.starts[area_index] + self.counts[area_index]]
+
+  def groups(self):
+    """Yields (area id, point indexes) for each polygon"""
+    for i, area_id in enumerate(self.area_ids.tolist()):
+      yield area_id, self.points(i)
+
+  def count_by_id(self) -> dict:
+    return dict(zip(self.area_ids.tolist(), self.counts.tolist()))
+
+def assign_points_to_polygons(xy: np.ndarray, polygons: np.ndarray, area_ids: np.ndarray = None) -> PointAssignment:
+  """Assigns each point to the polygon it is within in one vectorized STRtree query.
+     Points on a shared boundary are assigned to the first polygon, so each point is counted
+     in one area only (the SpatialJoin this replaced counted it in every area it touched).
+
+  Args:
+    xy (np.ndarray): Point coordinates as a (n, 2) array
+    polygons (np.ndarray): Array of shapely polygons
+    area_ids (np.ndarray): Optional; Id of each polygon, default is the polygon index
+
+  Returns:
+    PointAssignment: The points grouped by polygon
+  """
+  area_ids = np.arange(len(polygons)) if area_ids is None else np.asarray(area_ids)
+  tree = STRtree(polygons)
+  point_index, polygon_index = tree.query(shapely.points(xy), predicate='intersects')
+
+  order = np.lexsort((polygon_index, point_index))
+  points, first = np.unique(point_index[order], return_index=True)
+  point_area = np.full(len(xy), -1, dtype=np.int64)
+  point_area[points] = polygon_index[order][first]
+  return PointAssignment(area_ids, point_area)
+
+def unique_points(xy: np.ndarray, indexes: np.ndarray, decimals: int = 3) -> np.ndarray:
+  """Returns the indexes of the first point at each distinct location"""
+
+  if len(indexes) == 0:
+    return indexes
+  _, first = np.unique(np.round(xy[indexes], decimals), axis=0, return_index=True)
+  return indexes[np.sort(first)]
+
+class PointClusters:
+  """Points collapsed to one representative point pr cluster
+
+  Args:
+    representatives (np.ndarray): Index of the representative point of each cluster
+    cluster_of_point (np.ndarray): Cluster index of each point
+    weights (np.ndarray): Optional; Weight of each point, default is 1
+
+  Attributes:
+    representatives (np.ndarray): Index of the representative point of each cluster
+    cluster_of_point (np.ndarray): Cluster index of each point
+    counts (np.ndarray): Number of points in each cluster
+    weights (np.ndarray): Sum of the point weights in each cluster
+  """
+  def __init__(self, representatives: np.ndarray, cluster_of_point: np.ndarray, weights: np.ndarray = None) -> None:
+    self.representatives = representatives
+    self.cluster_of_point = cluster_of_point
+    self.counts = np.bincount(cluster_of_point, minlength=len(representatives))
+    self.weights = self.counts.astype(np.float64) if weights is None else np.bincount(cluster_of_point, weights, len(representatives))
+
+  def representative_of_point(self) -> np.ndarray:
+    """Returns the index of the representative of each point"""
+    return self.representatives[self.cluster_of_point]
+
+  def is_representative(self) -> np.ndarray:
+    mask = np.zeros(len(self.cluster_of_point), dtype=bool)
+    mask[self.representatives] = True
+    return mask
+
+def cluster_points(xy: np.ndarray, tolerance: float, weights: np.ndarray = None) -> PointClusters:
+  """Collapses points within the tolerance of each other with leader clustering: in input
+     order, each point not yet in a cluster becomes the representative of a new cluster with
+     all the unclustered points within the tolerance of it.
+
+  Args:
+    xy (np.ndarray): Point coordinates as a (n, 2) array
+    tolerance (float): Max distance from a point to its representative
+    weights (np.ndarray): Optional; Weight of each point (e.g. households), default is 1
+
+  Returns:
+    PointClusters: The clusters
+  """
+  tree = cKDTree(xy)
+  cluster_of_point = np.full(len(xy), -1, dtype=np.int64)
+  representatives = []
+  for i in range(len(xy)):
+    if cluster_of_point[i] >= 0:
+      continue
+    neighbors = np.asarray(tree.query_ball_point(xy[i], tolerance), dtype=np.int64)
+    cluster_of_point[neighbors[cluster_of_point[neighbors] < 0]] = len(representatives)
+    representatives.append(i)
+
+  return PointClusters(np.array(representatives, dtype=np.int64), cluster_of_point, weights)
+
+class NearestNeighborStatistics:
+  """Average nearest neighbour statistics of a point pattern, as arcpy.stats.AverageNearestNeighbor
+
+  Attributes:
+    ratio (float): Observed mean distance / expected mean distance, less than 1 means clustered
+    z_score (float): Standard deviations from the expected mean distance of a random pattern
+    p_value (float): Two sided p-value of the z-score
+    observed (float): Observed mean distance to the nearest neighbour
+    expected (float): Expected mean distance in a random pattern
+    area (float): Area of the study area
+    distances (np.ndarray): Distances from each point to its k nearest neighbours as a (n, k) array
+  """
+  def __init__(self, distances: np.ndarray, area: float) -> None:
+    n = len(distances)
+    self.distances = distances
+    self.area = area
+    self.observed = float(distances[:, 0].mean())
+    self.expected = 0.5 / np.sqrt(n / area)
+    self.ratio = self.observed / self.expected
+    standard_error = 0.26136 / np.sqrt(n * n / area)
+    self.z_score = (self.observed - self.expected) / standard_error
+    self.p_value = math.erfc(abs(self.z_score) / math.sqrt(2)) # Two-sided normal p-value, without importing scipy.stats
+
+def average_nearest_neighbor(xy: np.ndarray, area = None, k: int = 1) -> NearestNeighborStatistics:
+  """Finds the distances to the k nearest neighbours of each point in one KD-tree query and
+     the average nearest neighbour statistics. Points at the same location have distance 0.
+
+  Args:
+    xy (np.ndarray): Point coordinates as a (n, 2) array
+    area (float|shapely.Geometry|str): Optional; The study area, a polygon (e.g. the AOI) or
+      'convex_hull'. Default is the area of the rectangle enclosing the points, like arcpy
+    k (int): Optional; Number of neighbours to find distances to
+
+  Returns:
+    NearestNeighborStatistics: The statistics and distances
+  """
+  distances, _ = cKDTree(xy).query(xy, k + 1) # The nearest point is the point itself
+  distances = distances[:, 1:]
+
+  if area is None:
+    extent = xy.max(axis=0) - xy.min(axis=0)
+    area = float(extent[0] * extent[1])
+  elif isinstance(area, str) and area == 'convex_hull':
+    area = shapely.area(shapely.convex_hull(shapely.multipoints(xy)))
+  elif not isinstance(area, (int, float)):
+    area = shapely.area(area)
+  return NearestNeighborStatistics(distances, float(area))
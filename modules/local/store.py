@@ -0,0 +1,248 @@
+"""
+Partitioned columnar store of points, for reading the units of one municipality without
+scanning the national dataset. The points are ingested once, partitioned by the values of
+a few fields (e.g. kommunenavn and bruksenhetstype), and each partition is written as one
+.npy file pr column. The rows of a partition are sorted by the cell of a regular grid, so
+the rows in a bounding box are a few contiguous slices of the memory-mapped columns.
+A json catalogue holds the row count and bounding box of each partition.
+
+Layout:
+  {root}/catalogue.json
+  {root}/{partition}/{column}.npy
+  {root}/{partition}/cells.npy  Start row of each grid cell (row major), and the row count last
+
+Usage:
+  store = PointStore.create(root, data, ['kommunenavn', 'bruksenhetstype'])
+  store = PointStore(root)
+  store.count(kommunenavn='Sandnes', bruksenhetstype='Bolig')
+  store.read(['OID@', 'SHAPE@X', 'SHAPE@Y'], bbox=(xmin, ymin, xmax, ymax), kommunenavn='Sandnes')
+"""
+
+import json
+import os
+import re
+import shutil
+import numpy as np
+from modules.local.dataset import get_xy
+
+CATALOGUE = 'catalogue.json'
+CELL_SIZE = 1000 # Meters
+VERSION = 1
+
+def grid_cells(xy: np.ndarray, origin: np.ndarray, shape: tuple, cell_size: float) -> np.ndarray:
+  """Returns the row major grid cell of each point"""
+
+  column = np.clip(((xy[:, 0] - origin[0]) // cell_size).astype(np.int64), 0, shape[0] - 1)
+  row = np.clip(((xy[:, 1] - origin[1]) // cell_size).astype(np.int64), 0, shape[1] - 1)
+  return row * shape[0] + column
+
+def partition_name(index: int, key: list) -> str:
+  return f'{index:05d}_' + re.sub(r'\W', '_', '_'.join(str(value) for value in key))[:60]
+
+def matches(value, condition) -> bool:
+  """Condition is a value or a list, tuple or set of values"""
+  return value in condition if isinstance(condition, (list, tuple, set)) else value == condition
+
+class PointStore:
+  """A store created with PointStore.create
+
+  Args:
+    root (str): Folder of the store
+
+  Attributes:
+    catalogue (dict): Partition fields, columns, cell size and the partitions with key, rows and bbox
+  """
+  def __init__(self, root: str) -> None:
+    self.root = root
+    self.catalogue_path = os.path.join(root, CATALOGUE)
+    with open(self.catalogue_path, encoding='utf-8') as f:
+      self.catalogue = json.load(f)
+    if self.catalogue.get('version') != VERSION:
+      raise ValueError(f'Unsupported store version in {self.catalogue_path}: {self.catalogue.get("version")}')
+
+  @staticmethod
+  def exists(root: str) -> bool:
+    return os.path.exists(os.path.join(root, CATALOGUE))
+
+  @classmethod
+  def create(cls, root: str, data: np.ndarray, partition_fields: list, cell_size: float = CELL_SIZE,
+             source: str = None, wkid: int = None, source_state: str = None) -> 'PointStore':
+    """Writes the points to a new store, replacing an existing store in the folder
+
+    Args:
+      root (str): Folder of the store
+      data (np.ndarray): Structured array of points (see modules.local.dataset.get_xy)
+      partition_fields (list): Fields partitioning the points, the values are kept in the catalogue only
+      cell_size (float): Optional; Size in meters of the grid cells in the spatial index
+      source (str): Optional; The dataset the points were read from
+      wkid (int): Optional; Well known ID of the spatial reference of the points
+      source_state (str): Optional; State of the source when it was read, for finding a stale store
+
+    Returns:
+      PointStore: The new store
+    """
+    if os.path.exists(root):
+      shutil.rmtree(root)
+    os.makedirs(root)
+
+    xy = get_xy(data)
+    columns = [name for name in data.dtype.names if name not in partition_fields]
+    keys = np.rec.fromarrays([data[field] for field in partition_fields]) if partition_fields else np.zeros(len(data), dtype=[('all', np.int8)])
+    unique_keys, partition_of_row = np.unique(keys, return_inverse=True)
+    order = np.argsort(partition_of_row, kind='stable')
+    starts = np.searchsorted(partition_of_row[order], np.arange(len(unique_keys) + 1))
+
+    partitions = []
+    for i, key in enumerate(unique_keys.tolist()):
+      key = list(key) if partition_fields else []
+      rows = order[starts[i]:starts[i + 1]]
+      part_xy = xy[rows]
+      low, high = part_xy.min(axis=0), part_xy.max(axis=0)
+      origin = np.floor(low / cell_size) * cell_size
+      shape = tuple(int(v) for v in np.floor((high - origin) / cell_size).astype(np.int64) + 1)
+      cells = grid_cells(part_xy, origin, shape, cell_size)
+      cell_order = np.argsort(cells, kind='stable')
+      rows = rows[cell_order]
+
+      name = partition_name(i, key)
+      os.makedirs(os.path.join(root, name))
+      for column in columns:
+        np.save(os.path.join(root, name, f'{column}.npy'), np.ascontiguousarray(data[column][rows]), allow_pickle=False)
+      np.save(os.path.join(root, name, 'cells.npy'), np.searchsorted(cells[cell_order], np.arange(shape[0] * shape[1] + 1)), allow_pickle=False)
+      partitions.append({
+        'path': name, 'key': [value.item() if hasattr(value, 'item') else value for value in key], 'rows': len(rows),
+        'bbox': [*low.tolist(), *high.tolist()], 'origin': origin.tolist(), 'shape': list(shape)
+      })
+
+    catalogue = {
+      'version': VERSION, 'source': source, 'source_state': source_state, 'wkid': wkid, 'rows': len(data), 'cell_size': cell_size,
+      'partition_fields': list(partition_fields), 'columns': {column: data.dtype[column].str for column in columns},
+      'partitions': partitions
+    }
+    with open(os.path.join(root, CATALOGUE), 'w', encoding='utf-8') as f:
+      json.dump(catalogue, f, ensure_ascii=False, indent=1)
+    return cls(root)
+
+  @property
+  def partition_fields(self) -> list:
+    return self.catalogue['partition_fields']
+
+  @property
+  def columns(self) -> list:
+    return list(self.catalogue['columns'])
+
+  @property
+  def wkid(self) -> int:
+    return self.catalogue['wkid']
+
+  def partitions(self, **where) -> list:
+    """Returns the catalogue entries of the partitions matching the conditions on partition fields"""
+
+    conditions = [(self.partition_fields.index(field), condition) for field, condition in where.items() if field in self.partition_fields]
+    return [p for p in self.catalogue['partitions'] if all(matches(p['key'][i], condition) for i, condition in conditions)]
+
+  def values(self, field: str) -> dict:
+    """Returns the row count of each value of a partition field"""
+
+    index = self.partition_fields.index(field)
+    counts = {}
+    for partition in self.catalogue['partitions']:
+      counts[partition['key'][index]] = counts.get(partition['key'][index], 0) + partition['rows']
+    return counts
+
+  def key_dtype(self, field: str) -> np.dtype:
+    """Returns the type of a partition field, from the values in the catalogue"""
+
+    index = self.partition_fields.index(field)
+    return np.array([partition['key'][index] for partition in self.catalogue['partitions']]).dtype
+
+  def count(self, **where) -> int:
+    """Returns the number of rows matching conditions on partition fields, from the catalogue"""
+
+    unknown = [field for field in where if field not in self.partition_fields]
+    if unknown:
+      raise ValueError(f'Rows can only be counted by partition fields, not {unknown}')
+    return sum(partition['rows'] for partition in self.partitions(**where))
+
+  def column(self, partition: dict, column: str) -> np.ndarray:
+    """Returns a memory-mapped column of a partition"""
+    return np.load(os.path.join(self.root, partition['path'], f'{column}.npy'), mmap_mode='r', allow_pickle=False)
+
+  def slices(self, partition: dict, bbox: tuple) -> list:
+    """Returns the (start, stop) row ranges of the grid cells intersecting the bbox"""
+
+    xmin, ymin, xmax, ymax = partition['bbox']
+    if bbox is None:
+      return [(0, partition['rows'])]
+    if bbox[0] > xmax or bbox[2] < xmin or bbox[1] > ymax or bbox[3] < ymin:
+      return []
+
+    cell_size, origin, (width, height) = self.catalogue['cell_size'], partition['origin'], partition['shape']
+    first_column, last_column = (np.clip((np.array([bbox[0], bbox[2]]) - origin[0]) // cell_size, 0, width - 1)).astype(int).tolist()
+    first_row, last_row = (np.clip((np.array([bbox[1], bbox[3]]) - origin[1]) // cell_size, 0, height - 1)).astype(int).tolist()
+    cells = np.load(os.path.join(self.root, partition['path'], 'cells.npy'), mmap_mode='r')
+    slices = []
+    for row in range(first_row, last_row + 1):
+      start, stop = int(cells[row * width + first_column]), int(cells[row * width + last_column + 1])
+      if start == stop:
+        continue
+      if slices and slices[-1][1] == start:
+        slices[-1] = (slices[-1][0], stop)
+      else:
+        slices.append((start, stop))
+    return slices
+
+  def read(self, fields: list = None, bbox: tuple = None, **where) -> np.ndarray:
+    """Reads the matching rows to a structured array. Conditions on partition fields select
+       partitions from the catalogue, the bbox selects grid cells of the spatial index and only
+       the requested columns of those rows are read from the memory-mapped files. Conditions
+       on other columns and the exact bbox are then applied to the rows read.
+
+    Args:
+      fields (list): Optional; Columns to read, default is all columns and the partition fields
+      bbox (tuple): Optional; (xmin, ymin, xmax, ymax) the points must be within
+      where: Column conditions, a value or a list of values, e.g. kommunenavn='Sandnes'
+
+    Returns:
+      np.ndarray: Structured array with one record pr row
+    """
+    fields = fields if fields is not None else self.columns + self.partition_fields
+    unknown = [field for field in list(fields) + list(where) if field not in self.columns and field not in self.partition_fields]
+    if unknown:
+      raise ValueError(f'Unknown fields: {unknown}')
+
+    filter_fields = [field for field in where if field not in self.partition_fields]
+    coordinate_fields = ['SHAPE@X', 'SHAPE@Y'] if bbox is not None else []
+    read_fields = list(dict.fromkeys([field for field in fields if field in self.columns] + filter_fields + coordinate_fields))
+
+    parts = []
+    for partition in self.partitions(**where):
+      ranges = self.slices(partition, bbox)
+      if not ranges:
+        continue
+
+      columns = {}
+      for field in read_fields:
+        values = self.column(partition, field)
+        columns[field] = np.concatenate([values[start:stop] for start, stop in ranges])
+      keep = np.ones(sum(stop - start for start, stop in ranges), dtype=bool)
+      for field in filter_fields:
+        condition = where[field]
+        keep &= np.isin(columns[field], list(condition)) if isinstance(condition, (list, tuple, set)) else columns[field] == condition
+      if bbox is not None:
+        x, y = columns['SHAPE@X'], columns['SHAPE@Y']
+        keep &= (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+
+      for field, value in zip(self.partition_fields, partition['key']):
+        columns[field] = np.full(len(keep), value)
+      parts.append({field: columns[field][keep] for field in fields})
+
+    dtype = [(field, self.catalogue['columns'][field] if field in self.columns else self.key_dtype(field)) for field in fields]
+    result = np.empty(sum(len(part[fields[0]]) for part in parts) if parts and fields else 0, dtype=dtype)
+    start = 0
+    for part in parts:
+      stop = start + len(part[fields[0]])
+      for field in fields:
+        result[field][start:stop] = part[field]
+      start = stop
+    return result
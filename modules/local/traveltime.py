@@ -0,0 +1,20 @@
+import numpy as np
+
+MIN_TRAVEL_LENGTH = 10 # Used as travel length for overlapping points e.g. apartments in same building.
+
+def get_travel_lengths(total_distance: np.ndarray, shape_length: np.ndarray) -> np.ndarray:
+  """Returns the travel length used for each OD line. Zero distances (stacked points)
+     get the minimum travel length, and the shape length is used if it is longer than
+     the travel length"""
+
+  travel_length = np.where(total_distance > 0, total_distance, MIN_TRAVEL_LENGTH) # If points are stacked and have zero in walking distance
+  return np.where(travel_length < (shape_length / 1000), shape_length, travel_length) # Use shape length if longer than travel length
+
+def group_mean_by_origin(origin_oids: np.ndarray, values: np.ndarray):
+  """Groups the values by origin with a single sort and returns the unique origins
+     with the mean value and count for each origin"""
+
+  order = np.argsort(origin_oids, kind='stable')
+  origins, starts, counts = np.unique(origin_oids[order], return_index=True, return_counts=True)
+  sums = np.add.reduceat(values[order], starts) if len(starts) > 0 else np.zeros(0)
+  return origins, sums / counts, counts
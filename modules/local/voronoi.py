@@ -0,0 +1,156 @@
+import numpy as np
+import shapely
+from scipy.spatial import Voronoi
+from shapely import STRtree
+
+BATCH_SIZE = 50000 # Voronoi cells made into polygons at a time
+
+class VoronoiCells:
+  """Bounded Voronoi (Thiessen) cells of a set of points. Points at the same location
+     share one cell. Cells are made into shapely polygons on demand, so only the cells
+     being processed are held in memory as geometries.
+
+  Args:
+    xy (np.ndarray): Point coordinates as a (n, 2) array
+    bounds (tuple): Optional; (xmin, ymin, xmax, ymax) the cells are clipped to,
+      default is the extent of the points expanded by 10%
+
+  Attributes:
+    sites (np.ndarray): The distinct point locations
+    site_of_point (np.ndarray): Index of the site (cell) of each point
+    first_point (np.ndarray): Index of the first point at each site
+    bounds (tuple): The extent the cells are clipped to
+  """
+  def __init__(self, xy: np.ndarray, bounds: tuple = None) -> None:
+    self.sites, first, self.site_of_point = np.unique(np.round(xy, 3), axis=0, return_index=True, return_inverse=True)
+    self.site_of_point = self.site_of_point.reshape(-1)
+    self.first_point = first
+
+    if bounds is None:
+      xmin, ymin = xy.min(axis=0)
+      xmax, ymax = xy.max(axis=0)
+      dx, dy = max(xmax - xmin, 1) * 0.1, max(ymax - ymin, 1) * 0.1
+      bounds = (xmin - dx, ymin - dy, xmax + dx, ymax + dy)
+    self.bounds = bounds
+
+    # Four far away points make every cell of the real sites finite
+    xmin, ymin, xmax, ymax = bounds
+    size = max(xmax - xmin, ymax - ymin) * 10
+    cx, cy = (xmin + xmax) / 2, (ymin + ymax) / 2
+    frame = np.array([[cx - size, cy - size], [cx + size, cy - size], [cx + size, cy + size], [cx - size, cy + size]])
+    self.voronoi = Voronoi(np.vstack([self.sites, frame]))
+
+    # Vertex indexes of each cell as a flat array with offsets
+    regions = [self.voronoi.regions[r] for r in self.voronoi.point_region[:len(self.sites)].tolist()]
+    self.counts = np.fromiter((len(r) for r in regions), dtype=np.int64, count=len(regions))
+    self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+    self.vertex_index = np.fromiter((v for r in regions for v in r), dtype=np.int64, count=int(self.offsets[-1]))
+
+  def polygons(self, sites: np.ndarray) -> np.ndarray:
+    """Returns the cells of the sites as shapely polygons clipped to the bounds"""
+
+    counts = self.counts[sites]
+    starts = np.repeat(self.offsets[sites] - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+    vertex = self.vertex_index[starts + np.arange(int(counts.sum()))]
+    rings = shapely.linearrings(self.voronoi.vertices[vertex], indices=np.repeat(np.arange(len(sites)), counts))
+    return shapely.clip_by_rect(shapely.polygons(rings), *self.bounds)
+
+def union_cells(polygons: np.ndarray):
+  """Unions adjacent cells with the fast coverage union. Cells whose shared edges are not
+     noded exactly alike (rounding in the Voronoi vertices and clipping) make the coverage
+     union fail, and are unioned with the slower overlay union instead."""
+
+  try:
+    return shapely.coverage_union_all(polygons)
+  except shapely.errors.GEOSException:
+    return shapely.union_all(polygons)
+
+def dissolve_cells(cells: VoronoiCells, ids: np.ndarray, batch_size: int = BATCH_SIZE) -> tuple:
+  """Unions the Voronoi cells of the points by id, in batches of whole id groups.
+     The cell of a location shared by several points gets the id of the first point.
+
+  Args:
+    cells (VoronoiCells): The Voronoi cells of the points
+    ids (np.ndarray): Id (e.g. AreaID) of each point
+    batch_size (int): Optional; Max number of cells made into polygons at a time
+
+  Returns:
+    tuple: Array of ids and array of the dissolved shapely (multi)polygons
+  """
+  site_ids = np.asarray(ids)[cells.first_point]
+  order = np.argsort(site_ids, kind='stable')
+  group_ids, starts, counts = np.unique(site_ids[order], return_index=True, return_counts=True)
+
+  geometries = []
+  batch_start = 0
+  while batch_start < len(group_ids):
+    # Whole groups up to the batch size (at least one group)
+    batch_end = batch_start + max(1, int(np.searchsorted(np.cumsum(counts[batch_start:]), batch_size, side='right')))
+    sites = order[starts[batch_start]:starts[batch_end - 1] + counts[batch_end - 1]]
+    polygons = cells.polygons(sites)
+    offset = starts[batch_start]
+    for start, count in zip(starts[batch_start:batch_end].tolist(), counts[batch_start:batch_end].tolist()):
+      geometries.append(union_cells(polygons[start - offset:start - offset + count]))
+    batch_start = batch_end
+
+  return group_ids, np.array(geometries, dtype=object)
+
+def explode(ids: np.ndarray, geometries: np.ndarray) -> tuple:
+  """Splits multipart geometries into single parts (like Dissolve with SINGLE_PART)"""
+
+  parts, index = shapely.get_parts(geometries, return_index=True)
+  return ids[index], parts
+
+def clip_to_polygons(ids: np.ndarray, geometries: np.ndarray, clip_polygons: np.ndarray) -> tuple:
+  """Clips the geometries to the union of the clip polygons. An STRtree over the clip
+     polygons finds the geometries completely within one clip polygon, which are kept as
+     they are, and the clip polygons each of the other geometries intersects.
+
+  Returns:
+    tuple: Array of ids and array of the clipped geometries, empty results are dropped
+  """
+  clip_parts = shapely.get_parts(clip_polygons)
+  tree = STRtree(clip_parts)
+  within = np.zeros(len(geometries), dtype=bool)
+  within[tree.query(geometries, predicate='within')[0]] = True
+
+  candidates = np.flatnonzero(~within)
+  geometry_index, part_index = tree.query(geometries[candidates], predicate='intersects')
+  clipped = shapely.intersection(geometries[candidates][geometry_index], clip_parts[part_index])
+
+  # Union the pieces of a geometry clipped by several clip polygons
+  geometry_index = candidates[geometry_index]
+  result = geometries.copy()
+  result[candidates] = None
+  order = np.argsort(geometry_index, kind='stable')
+  unique, starts, counts = np.unique(geometry_index[order], return_index=True, return_counts=True)
+  for i, start, count in zip(unique.tolist(), starts.tolist(), counts.tolist()):
+    pieces = clipped[order[start:start + count]]
+    result[i] = pieces[0] if count == 1 else shapely.union_all(pieces)
+
+  keep = ~(shapely.is_missing(result) | shapely.is_empty(result))
+  return ids[keep], result[keep]
+
+def area_polygons(xy: np.ndarray, ids: np.ndarray, clip_polygons: np.ndarray = None, batch_size: int = BATCH_SIZE) -> tuple:
+  """Creates single part polygons of the area of each id from Thiessen polygons of the
+     points, like CreateThiessenPolygons, Dissolve (SINGLE_PART) and Clip.
+
+  Args:
+    xy (np.ndarray): Point coordinates as a (n, 2) array
+    ids (np.ndarray): Area id (e.g. AreaID) of each point
+    clip_polygons (np.ndarray): Optional; Shapely polygons (e.g. the AOI) the areas are clipped to
+    batch_size (int): Optional; Max number of Voronoi cells made into polygons at a time
+
+  Returns:
+    tuple: Array of ids and array of shapely polygons
+  """
+  bounds = None
+  if clip_polygons is not None:
+    xmin, ymin, xmax, ymax = shapely.total_bounds(clip_polygons)
+    bounds = (min(xmin, xy[:, 0].min()), min(ymin, xy[:, 1].min()), max(xmax, xy[:, 0].max()), max(ymax, xy[:, 1].max()))
+
+  cells = VoronoiCells(xy, bounds)
+  ids, geometries = explode(*dissolve_cells(cells, ids, batch_size))
+  if clip_polygons is not None:
+    ids, geometries = clip_to_polygons(ids, geometries, clip_polygons)
+  return ids, geometries
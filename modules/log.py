@@ -1,19 +1,174 @@
+import functools
+import json
+import os
+import time
+import tracemalloc
 from datetime import datetime
+from modules.backend import arcpy
+
+try:
+  import resource # Not on Windows
+except ImportError:
+  resource = None
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+def peak_rss() -> int:
+  """Returns the peak resident memory of the process in bytes, or None if unknown"""
+
+  if resource is not None:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Kilobytes on Linux
+  if psutil is not None:
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss)
+  return None
+
+class Span:
+  """A timed stage of a run. Set rows to record the number of rows (features) processed.
+
+  Attributes:
+    name (str): Name of the stage
+    parent (Span): The enclosing span, or None
+    rows (int): Number of rows processed, or None
+    wall (float): Elapsed wall clock seconds
+    cpu (float): Elapsed CPU seconds of the process
+    traced_peak (int): Peak memory traced by tracemalloc during the span in bytes, or None
+    process_rss_peak (int): Peak resident memory of the process since it started, read at the end of
+      the span in bytes, or None. It is not the peak of the span, earlier stages may have set it
+    rss_growth (int): Increase of the process peak during the span in bytes (0 if the span stayed below
+      the earlier peak), or None
+  """
+  def __init__(self, tracer, name: str, rows: int = None) -> None:
+    self.tracer = tracer
+    self.name = name
+    self.rows = rows
+    self.parent = None
+    self.depth = 0
+    self.wall = None
+    self.cpu = None
+    self.traced_peak = None
+    self.process_rss_peak = None
+    self.rss_growth = None
+
+  def __enter__(self):
+    self.parent = self.tracer.current
+    self.depth = self.parent.depth + 1 if self.parent is not None else 0
+    self.tracer.current = self
+    if self.tracer.memory:
+      # The peak so far belongs to the parent, the peak is reset for this span
+      if self.parent is not None:
+        self.parent.traced_peak = max(self.parent.traced_peak or 0, tracemalloc.get_traced_memory()[1])
+      tracemalloc.reset_peak()
+      self.traced_peak = 0
+    self.start_rss_peak = peak_rss()
+    self.started = time.time()
+    self.start_wall = time.perf_counter()
+    self.start_cpu = time.process_time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback) -> None:
+    self.wall = time.perf_counter() - self.start_wall
+    self.cpu = time.process_time() - self.start_cpu
+    if self.tracer.memory:
+      self.traced_peak = max(self.traced_peak, tracemalloc.get_traced_memory()[1])
+      if self.parent is not None:
+        self.parent.traced_peak = max(self.parent.traced_peak or 0, self.traced_peak)
+    self.process_rss_peak = peak_rss()
+    if self.process_rss_peak is not None and self.start_rss_peak is not None:
+      self.rss_growth = self.process_rss_peak - self.start_rss_peak
+    self.tracer.current = self.parent
+    self.tracer.finish(self, exc_type is not None)
+
+  def path(self) -> str:
+    return f'{self.parent.path()}/{self.name}' if self.parent is not None else self.name
+
+class _NoSpan:
+  """Span used when tracing is disabled"""
+  rows = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback) -> None:
+    pass
+
+_no_span = _NoSpan()
+
+class Tracer:
+  """Collects the spans of a process and writes each finished span as a json line
+
+  Attributes:
+    enabled (bool): Spans are only recorded when enabled
+    memory (bool): Trace memory allocations with tracemalloc (slows down the run)
+    path (str): The json lines trace file, or None
+    spans (list): The finished spans
+  """
+  def __init__(self) -> None:
+    self.enabled = False
+    self.memory = False
+    self.path = None
+    self.spans = []
+    self.current = None
+
+  def enable(self, path: str = None, memory: bool = False) -> None:
+    """Starts a new trace, the spans of an earlier trace in the process are cleared"""
+    self.enabled = True
+    self.spans = []
+    self.current = None
+    self.path = path
+    self.memory = memory
+    if memory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def disable(self) -> None:
+    self.enabled = False
+    if self.memory and tracemalloc.is_tracing():
+      tracemalloc.stop()
+    self.memory = False
+
+  def finish(self, span: Span, failed: bool) -> None:
+    self.spans.append(span)
+    if self.path is None:
+      return
+    record = {
+      'name': span.name, 'path': span.path(), 'depth': span.depth, 'start': span.started,
+      'wall': span.wall, 'cpu': span.cpu, 'rows': span.rows,
+      'traced_peak': span.traced_peak, 'process_rss_peak': span.process_rss_peak, 'rss_growth': span.rss_growth, 'failed': failed, 'pid': os.getpid()
+    }
+    with open(self.path, 'a', encoding='utf-8') as f:
+      f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+  def summary(self) -> list:
+    """Returns [path, count, wall, cpu, rows, traced peak] for each span path in order of first start"""
+
+    rows = {}
+    for span in sorted(self.spans, key=lambda s: s.started):
+      row = rows.setdefault(span.path(), [span.path(), 0, 0.0, 0.0, None, None])
+      row[1] += 1
+      row[2] += span.wall
+      row[3] += span.cpu
+      if span.rows is not None:
+        row[4] = (row[4] or 0) + span.rows
+      if span.traced_peak is not None:
+        row[5] = max(row[5] or 0, span.traced_peak)
+    return list(rows.values())
+
+tracer = Tracer()
 
 class Log:
   def __init__(self, **options) -> None:
     self.timeformat = options['timeformat'] if 'timeformat' in options  else '%H:%M:%S'
     self.debugging = options['debug'] if 'debug' in options else False
     self.arcgis = options['arcgis'] if 'arcgis' in options else False
-    if self.arcgis:
-      import arcpy
-      self.arcpy = arcpy
 
   def msg(self, level:str , message: str):
     if level != 'Debug' or self.debugging == True:
       timestamp = datetime.strftime(datetime.now(), self.timeformat)
-      if self.arcgis:
-        self.arcpy.AddMessage(f'{timestamp} {level}: {message}')
+      if self.arcgis and arcpy.available(): # Prints when run without ArcGIS
+        arcpy.AddMessage(f'{timestamp} {level}: {message}')
       else:
         print(f'{timestamp} {level}: {message}')
 
@@ -22,9 +177,61 @@ class Log:
 
   def info(self, message:str):
     self.msg('Info', message)
-  
+
   def warning(self, message:str):
     self.msg('Warning', message)
 
   def error(self, message:str):
     self.msg('Error', message)
+
+  def span(self, name: str, rows: int = None):
+    """Times a stage of the run when tracing is enabled (see start_trace).
+
+    Usage:
+      with log.span('Eksport', rows=count) as span:
+        ...
+        span.rows = count_rows(output)
+    """
+    return Span(tracer, name, rows) if tracer.enabled else _no_span
+
+  def timed(self, name: str = None, rows = None):
+    """Decorator that runs the function in a span named after the function.
+
+    Args:
+      name (str): Optional; Name of the span, default is the function name
+      rows (function): Optional; Returns the number of rows from the result of the function
+    """
+    def decorator(function):
+      span_name = name if name is not None else function.__name__
+
+      @functools.wraps(function)
+      def wrapper(*args, **kwargs):
+        if not tracer.enabled:
+          return function(*args, **kwargs)
+        with Span(tracer, span_name) as span:
+          result = function(*args, **kwargs)
+          if rows is not None:
+            span.rows = rows(result)
+          return result
+      return wrapper
+    return decorator
+
+  def start_trace(self, path: str = None, memory: bool = False) -> None:
+    """Starts recording spans, written as json lines to the path if given"""
+    tracer.enable(path, memory)
+    self.info(f'Sporer tidsbruk{f" til {path}" if path else ""}')
+
+  def stop_trace(self) -> None:
+    tracer.disable()
+
+  def summary(self) -> None:
+    """Logs a table of the wall time, CPU time, rows and memory of each traced stage"""
+
+    summary = tracer.summary()
+    if not summary:
+      return
+    self.info(f'{"Steg":<50} {"Antall":>6} {"Tid (s)":>9} {"CPU (s)":>9} {"Rader":>9} {"Minne (MB)":>10}')
+    for path, count, wall, cpu, rows, peak in summary:
+      rows = '' if rows is None else rows
+      peak = '' if peak is None else round(peak / 2**20, 1)
+      self.info(f'{path[-50:]:<50} {count:>6} {wall:>9.2f} {cpu:>9.2f} {rows:>9} {peak:>10}')
@@ -0,0 +1,42 @@
+"""
+Chooses the network analysis backend. Both backends have the same create_*, load_and_solve_*
+and get_* functions:
+
+  arcgis: modules.arcgis.na, arcpy.nax on a network dataset (ArcGIS Pro with Network Analyst)
+  local: modules.local.na, NumPy on an edge list (.npz or .csv), needs no ArcGIS licence
+
+The default is arcgis when arcpy is installed, else local. Set the NA_BACKEND environment
+variable, or pass the backend, to choose.
+
+Usage:
+  from modules import na
+  od_matrix = na.create_origin_destination_analysis({'defaultImpedanceCutoff': 15}, backend='local')
+  result = na.module('odmatrix', 'local').load_and_solve_od_matrix(od_matrix, origins, destinations)
+"""
+
+import importlib
+import os
+from modules.backend import arcpy
+
+BACKENDS = ['arcgis', 'local']
+
+def backend_name(backend: str = None) -> str:
+  """Returns the backend to use: the one given, NA_BACKEND or arcgis if arcpy is installed, else local"""
+
+  backend = backend or os.environ.get('NA_BACKEND') or ('arcgis' if arcpy.available() else 'local')
+  if backend not in BACKENDS:
+    raise ValueError(f'Ukjent nettverksanalyse {backend!r}, velg en av {", ".join(BACKENDS)}')
+  return backend
+
+def module(name: str, backend: str = None):
+  """Returns a module (network_dataset, odmatrix, routing or location_allocation) of the backend"""
+  return importlib.import_module(f'modules.{backend_name(backend)}.na.{name}')
+
+def create_origin_destination_analysis(options: dict, network = None, backend: str = None):
+  return module('odmatrix', backend).create_origin_destination_analysis(options, network)
+
+def create_route_analysis(options: dict, network = None, backend: str = None):
+  return module('routing', backend).create_route_analysis(options, network)
+
+def create_location_allocation_analysis(options: dict, network = None, backend: str = None):
+  return module('location_allocation', backend).create_location_allocation_analysis(options, network)
@@ -0,0 +1,27 @@
+import os
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+def create_process_pool(workers: int = None, initializer = None, initargs: tuple = ()) -> ProcessPoolExecutor:
+  """Creates a process pool that also works when started from ArcGIS Pro
+
+  Args:
+    workers (int): Optional; Number of worker processes. Default is the number of cpus - 1
+    initializer (function): Optional; Function run once in each worker, e.g. to create analysis objects
+    initargs (tuple): Optional; Arguments to the initializer
+
+  Returns:
+    ProcessPoolExecutor: The process pool
+  """
+  workers = workers if workers is not None else max(os.cpu_count() - 1, 1)
+
+  # Inside ArcGIS Pro sys.executable is ArcGISPro.exe, the workers must use the python interpreter
+  if os.path.basename(sys.executable).lower().startswith('arcgispro'):
+    multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+
+  return ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+
+def chunks(items: list, size: int) -> list:
+  """Splits a list into chunks of the given size"""
+  return [items[i:i + size] for i in range(0, len(items), size)]
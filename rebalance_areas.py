@@ -0,0 +1,125 @@
+"""
+Balances the walk time of the areas (roder) after split_areas and merge_areas, by moving
+units at the boundary of an area to an adjacent area with a shorter walk time
+(see modules.local.rebalance). Units at the same location are moved together. The walk time
+of each move is estimated from a tour through the stops of each area on one OD matrix, so no
+routes are solved during the search. The unit counts are kept within
+[merge_areas.MIN_COUNT, split_areas.MAX_COUNT].
+
+Writes the units with their new AreaID, the areas made again from the units and the balance
+metrics (walk time mean, standard deviation, min and max) before and after to
+{output name}_balance.json next to the output geodatabase.
+"""
+
+import json
+import os
+from modules.backend import arcpy
+import numpy as np
+import shapely
+from modules.filepaths import Path
+from modules.log import Log
+from modules.arcgis.dataset import export_dataset, update_table
+from modules.arcgis.spatial import read_points, read_polygons, write_polygons
+from modules.arcgis.na.odmatrix import create_origin_destination_analysis, solve_cost_matrices
+from modules.arcgis.na.network_dataset import read_locations, feature_spatial_reference
+from modules.arcgis.na.pool import pool
+from modules.local import rebalance
+from modules.local.voronoi import area_polygons
+from traveltime_pr_area import get_tour_options, tour_time_limit
+import split_areas as split
+import merge_areas as merge
+
+log = Log(arcgis=True)
+
+TIME_LIMIT = 300 # Seconds for moving units
+
+def get_stops(points: np.ndarray, id_field: str = 'AreaID') -> tuple:
+  """Returns the unique locations of each area as stops
+
+  Returns:
+    tuple: Stop coordinates, area index and unit count of each stop, the area ids and the stop of each unit
+  """
+  ids, area = np.unique(points[id_field].astype(str), return_inverse=True)
+  keys = np.column_stack([np.round(points['SHAPE@X'], 3), np.round(points['SHAPE@Y'], 3), area])
+  unique, unit_stop, weights = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+  return unique[:, :2], unique[:, 2].astype(np.int64), weights, ids, unit_stop.reshape(-1)
+
+def balance_path(output_fc: str) -> str:
+  """Returns the path of the balance metrics of an output feature class"""
+  return os.path.join(os.path.dirname(Path(str(output_fc)).path), f'{Path(str(output_fc)).filename}_balance.json')
+
+def rebalance_areas(points_fc: str, areas_fc: str, result_polys: str, result_points: str = None, travel_mode: str = 'Gange',
+                    time_limit: float = TIME_LIMIT, cost_cache: str = None) -> dict:
+  """Moves boundary units between adjacent areas to balance the walk time of the areas
+
+  Args:
+    points_fc (str): Units with the AreaID of their area, see AreaJob.result_points
+    areas_fc (str): The areas, the new areas are clipped to them
+    result_polys (str): Output feature class for the new areas
+    result_points (str): Optional; Output feature class for the units with the new AreaID, default is {result_polys}_punkter
+    travel_mode (str): Optional; Travel mode of the walk times
+    time_limit (float): Optional; Seconds for moving units
+    cost_cache (str): Optional; Path of a cost cache for the walk times between the stops (see modules.local.na.cost_cache), default is no cache
+
+  Returns:
+    dict: The balance metrics before and after, and the number of units moved, or None if
+      solving the OD matrix failed
+  """
+  pool.clear() # No analysis is reused from an earlier run in the process
+  result_points = result_points if result_points is not None else f'{result_polys}_punkter'
+  export_dataset(points_fc, result_points) # The units are read from the copy, so the new AreaIDs are written to the rows they were read from
+  points = read_points(result_points, ['AreaID'])
+  previous_ids = points['AreaID'].astype(str)
+  assigned = (previous_ids != '') & (previous_ids != 'None') # Units outside the areas are not moved
+  stop_xy, stop_area, weights, ids, unit_stop = get_stops(points[assigned])
+  log.info(f'{int(assigned.sum())} bruksenheter på {len(stop_xy)} stopp i {len(ids)} roder')
+
+  locations = read_locations(result_points) # Same order as the points, see calculate_locations
+  stop_locations = None
+  if locations is not None:
+    first = np.empty(len(stop_xy), dtype=np.int64) # First unit of each stop
+    first[unit_stop[::-1]] = np.arange(len(unit_stop))[::-1]
+    stop_locations = locations[assigned][first]
+
+  od_matrix = create_origin_destination_analysis(get_tour_options(travel_mode), stage='rebalance')
+  matrices = solve_cost_matrices(od_matrix, stop_xy, stop_xy, cost_cache, origin_locations=stop_locations, destination_locations=stop_locations,
+                                 spatial_reference=feature_spatial_reference(result_points))
+  if matrices is None:
+    log.error('Løsning av OD-matrisen mellom stoppene feilet, rodene er ikke endret')
+    arcpy.management.Delete(result_points)
+    return None
+  minutes, _ = matrices
+  result = rebalance.rebalance_areas(minutes, stop_xy, stop_area, weights, merge.MIN_COUNT, split.MAX_COUNT,
+                                     time_limit=time_limit, tour_time_limit=tour_time_limit, log=log)
+
+  area_ids = previous_ids.copy()
+  area_ids[assigned] = ids[result.area[unit_stop]]
+  moved = int((area_ids != previous_ids).sum())
+  table = np.empty(len(points), dtype=[('OID@', np.int64), ('AreaID', 'U64')])
+  table['OID@'], table['AreaID'] = points['OID@'], area_ids
+  update_table(result_points, table)
+
+  _, polygons, _ = read_polygons(areas_fc)
+  xy = np.column_stack([points['SHAPE@X'], points['SHAPE@Y']])
+  polygon_ids, new_polygons = area_polygons(xy[assigned], area_ids[assigned], np.array([shapely.union_all(polygons)]))
+  write_polygons(result_polys, polygon_ids, new_polygons, 'AreaID', points_fc)
+
+  metrics = {'before': result.before, 'after': result.after, 'units_moved': moved, 'stops_moved': result.moves,
+             'passes': result.passes, 'elapsed': result.elapsed}
+  for name in ['before', 'after']:
+    m = metrics[name]
+    log.info(f'Gangtid {"før" if name == "before" else "etter"}: snitt {round(m["mean"], 1)} min, standardavvik {round(m["std"], 1)} min, min {round(m["min"], 1)} min, maks {round(m["max"], 1)} min')
+  with open(balance_path(result_polys), 'w', encoding='utf-8') as f:
+    json.dump(metrics, f, indent=1)
+  log.info(f'{moved} bruksenheter flyttet, roder lagret i {result_polys}')
+  return metrics
+
+###############################################################################
+if __name__ == '__main__':
+  # Script inputs
+  rebalance_areas(
+    arcpy.GetParameterAsText(0), # Units with AreaID
+    arcpy.GetParameterAsText(1), # Areas
+    arcpy.GetParameterAsText(2), # Rebalanced areas
+    arcpy.GetParameterAsText(3) or None # Rebalanced units
+  )
@@ -1,21 +1,33 @@
-import arcpy
+from concurrent.futures import as_completed
+from modules.backend import arcpy
+import numpy as np
 from modules.log import Log
 from modules.utils import create_uuid
-from modules.arcgis.dataset import export_dataset, add_field
-from modules.arcgis.na.location_allocation import create_location_allocation_analysis, load_and_solve_location_allocation, get_la_demand_points
+from modules.arcgis.dataset import export_dataset, add_field, update_table
+from modules.arcgis.spatial import read_points
+from modules.arcgis.na.location_allocation import create_location_allocation_analysis, create_native_location_allocation_analysis, load_and_solve_location_allocation, load_and_solve_location_allocation_xy, get_la_demand_points
+from modules.arcgis.na.network_dataset import read_locations, feature_spatial_reference, project_to_network
+from modules.local.spatial import unique_points
+from modules.parallel import create_process_pool, chunks
 
 log = Log(arcgis=True)
-arcpy.env.overwriteOutput = True
 
 MAX_COUNT = 70
 TARGET_COUNT = 40
+USE_NATIVE_SOLVER = False # Solve location-allocation in-process (p-median on a cutoff limited cost matrix)
+BATCH_SPLIT = False # Split all oversized areas from coordinates and update the points in one pass
+WORKERS = 1 # Number of processes splitting areas in batch mode, None uses all but one cpu
+CHUNK_SIZE = 10 # Areas pr process pool task
 
-LA_OPTIONS = {
-  'travelMode': 'Gange',
-  'defaultImpedanceCutoff': 15,
-  'problemType': arcpy.nax.LocationAllocationProblemType.MinimizeImpedance,
-  'timeUnits': arcpy.nax.TimeUnits.Minutes
-}
+def get_la_options() -> dict:
+  return {
+    'travelMode': 'Gange',
+    'defaultImpedanceCutoff': 15,
+    'problemType': arcpy.nax.LocationAllocationProblemType.MinimizeImpedance,
+    'timeUnits': arcpy.nax.TimeUnits.Minutes
+  }
+
+_la_analysis = None # Location-allocation analysis in each worker process
 
 def summarize_by_area(areas, id_field):
   log.info(f'Teller opp antall bruksenheter i hver rode...')
@@ -58,9 +70,107 @@ def add_area_id(dataset, add_uid = False):
                                 expression, "PYTHON3")
 
 
-def split_areas(points_fc):
+def create_split_analysis():
+  if USE_NATIVE_SOLVER:
+    return create_native_location_allocation_analysis(get_la_options(), stage='split')
+  else:
+    return create_location_allocation_analysis(get_la_options(), stage='split')
+
+def split_area_xy(la_analysis, xy, locations = None, spatial_reference = None):
+  """Splits the points of one area with location-allocation, using the unique
+     locations as facilities. Returns the FacilityOID of each point (None if not allocated).
+     Pass the network locations of the points to not locate them again, and the spatial
+     reference of the coordinates if it can differ from the network."""
+
+  areas_to_find = round(len(xy)/TARGET_COUNT)
+  facilities = unique_points(xy, np.arange(len(xy)))
+
+  la_analysis.facilityCount = areas_to_find
+  result = load_and_solve_location_allocation_xy(la_analysis, xy[facilities], xy, None,
+                                                 locations[facilities] if locations is not None else None, locations, spatial_reference)
+
+  facility_ids = [None] * len(xy)
+  if result.solveSucceeded:
+    for name, facility_id in result.searchCursor(arcpy.nax.LocationAllocationOutputDataType.DemandPoints, ['Name', 'FacilityOID']):
+      facility_ids[int(name) - 1] = facility_id
+  else:
+    log.error(result.solverMessages(arcpy.nax.MessageSeverity.All))
+  return facility_ids
+
+def init_split_worker():
+  """Creates the location-allocation analysis once in each worker process"""
+  global _la_analysis
+  _la_analysis = create_split_analysis()
+
+def split_areas_chunk(areas):
+  """Splits a chunk of (AreaID, point coordinates, point network locations or None). Runs in a worker process.
+
+  Returns:
+    list: (AreaID, FacilityOID of each point) for the areas that were split
+  """
+  results = []
+  for area_id, xy, locations in areas:
+    try:
+      log.info(f'Splitter rode {area_id} med {len(xy)} bruksenheter...')
+      results.append((area_id, split_area_xy(_la_analysis, xy, locations)))
+    except Exception as e:
+      log.error(f'Splitting av rode {area_id} feilet: {e}')
+  return results
+
+def split_areas_batch(points_fc, workers = 1):
+  """Splits all areas with more than MAX_COUNT points. The oversized areas are partitioned
+     up front and solved independently (optionally in a process pool), and the new AreaIDs
+     are written to the points in one UpdateCursor pass. Points the location-allocation does
+     not allocate get an empty AreaID instead of the id of the area that was split."""
+
+  log.info(f'Splitter roder med mer enn {MAX_COUNT} bruksenheter...')
+  add_area_id(points_fc)
+
+  points = read_points(points_fc, ['AreaID'])
+  xy = project_to_network(np.column_stack([points['SHAPE@X'], points['SHAPE@Y']]), feature_spatial_reference(points_fc)) # Only used in the solves
+  order = np.argsort(points['AreaID'], kind='stable')
+  area_ids, starts, counts = np.unique(points['AreaID'][order], return_index=True, return_counts=True)
+  oversized = [(str(area_ids[i]), order[starts[i]:starts[i] + counts[i]]) for i in np.flatnonzero(counts > MAX_COUNT)]
+  log.info(f'{len(oversized)} av {len(area_ids)} roder har mer enn {MAX_COUNT} bruksenheter')
+
+  locations = read_locations(points_fc) # Stored network locations are reused, see calculate_locations
+  rows_by_area = dict(oversized)
+  jobs = [(area_id, xy[rows], locations[rows] if locations is not None else None) for area_id, rows in oversized]
+  if workers != 1 and len(jobs) > 1:
+    results = []
+    with create_process_pool(workers, init_split_worker) as pool:
+      futures = [pool.submit(split_areas_chunk, chunk) for chunk in chunks(jobs, CHUNK_SIZE)]
+      for future in as_completed(futures):
+        try:
+          results.extend(future.result())
+        except Exception as e:
+          log.error(f'Splitting av roder feilet: {e}')
+  else:
+    init_split_worker()
+    results = split_areas_chunk(jobs)
+
+  new_area_ids = {}
+  unallocated = 0
+  for area_id, facility_ids in results:
+    uid = create_uuid()
+    for oid, facility_id in zip(points['OID@'][rows_by_area[area_id]].tolist(), facility_ids):
+      new_area_ids[oid] = f'{facility_id}_{uid}' if facility_id is not None else '' # Not left in the area that was split
+      unallocated += facility_id is None
+  if unallocated:
+    log.warning(f'{unallocated} bruksenheter ble ikke tildelt en ny rode og har tom AreaID')
+
+  log.info(f'Oppdaterer AreaID for {len(new_area_ids)} bruksenheter...')
+  table = np.array(list(new_area_ids.items()), dtype=[('OID@', np.int64), ('AreaID', 'U64')])
+  update_table(points_fc, table)
+
+  return points_fc
+
+def split_areas(points_fc, batch = BATCH_SPLIT, workers = WORKERS):
+  if batch:
+    return split_areas_batch(points_fc, workers)
+
   log.info(f'Splitter roder med mer enn {MAX_COUNT} bruksenheter...')
-  la_analysis = create_location_allocation_analysis(LA_OPTIONS)
+  la_analysis = create_split_analysis()
 
   add_area_id(points_fc)
 
@@ -0,0 +1,22 @@
+import numpy as np
+import shapely
+from modules.local.areas import polygon_adjacency
+from modules.local.spatial import assign_points_to_polygons
+
+def test_polygon_adjacency_with_extra_vertex_on_shared_edge():
+  left = shapely.Polygon([(0, 0), (10, 0), (10, 5), (10, 10), (0, 10)]) # Extra vertex at (10, 5)
+  right = shapely.Polygon([(10, 0), (20, 0), (20, 10), (10, 10)])
+  assert polygon_adjacency([left, right]) == [{1}, {0}]
+
+def test_polygon_adjacency_ignores_corner_contact():
+  square = shapely.Polygon([(0, 0), (10, 0), (10, 10), (0, 10)])
+  diagonal = shapely.Polygon([(10, 10), (20, 10), (20, 20), (10, 20)])
+  apart = shapely.Polygon([(30, 0), (40, 0), (40, 10), (30, 10)])
+  assert polygon_adjacency([square, diagonal, apart]) == [set(), set(), set()]
+
+def test_boundary_point_is_counted_in_one_area():
+  left = shapely.Polygon([(0, 0), (10, 0), (10, 10), (0, 10)])
+  right = shapely.Polygon([(10, 0), (20, 0), (20, 10), (10, 10)])
+  empty = shapely.Polygon([(30, 0), (40, 0), (40, 10), (30, 10)])
+  assignment = assign_points_to_polygons(np.array([[10.0, 5.0], [5.0, 5.0]]), np.array([left, right, empty]))
+  assert assignment.counts.tolist() == [2, 0, 0]
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+from modules.local.na.network_dataset import NetworkDataset, save_edges, read_edges, EDGE_COLUMNS
+from modules.local.na.odmatrix import cost_matrix
+from modules import na
+from modules.backend import arcpy
+
+def grid_network(size: int = 6, spacing: float = 100.0, seed: int = 0) -> NetworkDataset:
+  """A grid of streets with random walk minutes on each edge, and some edges removed"""
+
+  rng = np.random.default_rng(seed)
+  node = lambda i, j: i * size + j
+  pairs = [(node(i, j), node(i, j + 1)) for i in range(size) for j in range(size - 1)]
+  pairs += [(node(i, j), node(i + 1, j)) for i in range(size - 1) for j in range(size)]
+  pairs = [pair for pair in pairs if rng.random() > 0.15]
+  xy = np.array([(j * spacing, i * spacing) for i in range(size) for j in range(size)])
+  edges = np.array(pairs)
+  return NetworkDataset({
+    'from_node': edges[:, 0], 'to_node': edges[:, 1],
+    'length': np.full(len(edges), spacing), 'minutes': rng.uniform(0.5, 3, len(edges)),
+    'from_x': xy[edges[:, 0], 0], 'from_y': xy[edges[:, 0], 1], 'to_x': xy[edges[:, 1], 0], 'to_y': xy[edges[:, 1], 1]
+  })
+
+def reference_costs(network: NetworkDataset, origins: np.ndarray, destinations: np.ndarray) -> np.ndarray:
+  graph = coo_matrix((network.edge_minutes, (network.edge_from, network.edge_to)), shape=(network.node_count, network.node_count))
+  return dijkstra(graph.tocsr(), directed=False, indices=origins)[:, destinations]
+
+def node_index(network: NetworkDataset, xy: np.ndarray) -> np.ndarray:
+  return np.array([int(np.flatnonzero((network.node_xy == point).all(axis=1))[0]) for point in xy])
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('cutoff', [None, 6.0])
+def test_cost_matrix_against_scipy_dijkstra(seed, cutoff):
+  network = grid_network(seed=seed)
+  rng = np.random.default_rng(seed + 10)
+  connected = np.unique(np.concatenate([network.edge_from, network.edge_to]))
+  origin_xy = network.node_xy[rng.choice(connected, 8, replace=False)]
+  destination_xy = network.node_xy[rng.choice(connected, 10, replace=False)]
+
+  costs = cost_matrix(network, origin_xy, destination_xy, cutoff)
+  expected = reference_costs(network, node_index(network, origin_xy), node_index(network, destination_xy))
+  reachable = np.isfinite(expected) & (expected <= (cutoff if cutoff is not None else np.inf))
+
+  dense = np.full(costs.shape, np.inf)
+  coo = costs.tocoo()
+  dense[coo.row, coo.col] = coo.data
+  assert np.array_equal(np.isfinite(dense), reachable)
+  assert np.allclose(dense[reachable], expected[reachable])
+
+def test_cost_matrix_stores_zero_cost_pairs():
+  network = grid_network()
+  xy = network.node_xy[network.edge_from[:1]]
+  costs = cost_matrix(network, xy, xy)
+  assert costs.nnz == 1 and costs.data[0] == 0
+
+def test_saved_edges_are_read_back(tmp_path):
+  network = grid_network()
+  path = str(tmp_path / 'edges.npz')
+  save_edges(network, path)
+  edges = read_edges(path)
+  assert sorted(edges) == sorted(EDGE_COLUMNS)
+  assert np.allclose(edges['minutes'], network.edge_minutes)
+  assert np.array_equal(NetworkDataset(edges).edge_from, network.edge_from)
+
+def test_backend_switch(monkeypatch):
+  monkeypatch.delenv('NA_BACKEND', raising=False)
+  assert na.module('odmatrix', 'local').cost_matrix is cost_matrix
+  assert na.backend_name() == ('arcgis' if arcpy.available() else 'local')
+  with pytest.raises(ValueError):
+    na.backend_name('qgis')
@@ -0,0 +1,64 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from modules.arcgis.na.odmatrix import load_od_input
+from modules.local.na.cost_cache import CostCache, DestinationSet, cached_cost_matrices
+
+LOCATIONS = [('SourceID', np.int64), ('SourceOID', np.int64), ('PosAlong', np.float64), ('SideOfEdge', np.int64)]
+
+class InsertCursor:
+  def __init__(self, fields):
+    self.fields, self.rows = fields, []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+  def insertRow(self, row):
+    self.rows.append(row)
+
+class Analysis:
+  """Records the rows inserted into each input of an analysis"""
+
+  def __init__(self):
+    self.cursors = {}
+
+  def insertCursor(self, input_type, fields, append=True):
+    self.cursors[input_type] = InsertCursor(fields)
+    return self.cursors[input_type]
+
+def test_load_od_input_inserts_stored_locations():
+  xy = np.array([[10.0, 20.0], [30.0, 40.0]])
+  locations = np.array([(1, 101, 0.25, 1), (1, 102, 0.75, 2)], dtype=LOCATIONS)
+  analysis = Analysis()
+  load_od_input(analysis, 'Origins', xy, locations)
+
+  cursor = analysis.cursors['Origins']
+  assert cursor.fields == ['Name', 'SHAPE@XY', 'SourceID', 'SourceOID', 'PosAlong', 'SideOfEdge']
+  assert cursor.rows == [['1', (10.0, 20.0), 1, 101, 0.25, 1], ['2', (30.0, 40.0), 1, 102, 0.75, 2]]
+
+def test_load_od_input_without_locations():
+  analysis = Analysis()
+  load_od_input(analysis, 'Destinations', np.array([[1.0, 2.0]]))
+  assert analysis.cursors['Destinations'].fields == ['Name', 'SHAPE@XY']
+  assert analysis.cursors['Destinations'].rows == [['1', (1.0, 2.0)]]
+
+def test_cache_misses_are_solved_with_their_rows(tmp_path):
+  origin_xy = np.array([[0.0, 0.0], [500.0, 0.0], [0.0, 0.0], [900.0, 0.0]]) # The third origin shares the first location
+  destination_xy = np.array([[100.0, 0.0], [800.0, 0.0]])
+  solved = []
+
+  def solve(rows):
+    solved.append(rows.tolist())
+    meters = np.abs(origin_xy[rows, :1] - destination_xy[:, 0])
+    return csr_matrix(meters / 80), csr_matrix(meters)
+
+  cache = CostCache(str(tmp_path / 'costs.sqlite'))
+  destinations = DestinationSet(destination_xy, 1500, cache.quantum)
+  minutes, _ = cached_cost_matrices(cache, 'context', origin_xy, destinations, solve)
+  assert solved == [[0, 1, 3]] # Rows of origin_xy, so the stored locations of the same rows are loaded
+  assert np.allclose(minutes.toarray()[2], minutes.toarray()[0])
+
+  cached_cost_matrices(cache, 'context', origin_xy[[3, 1]], destinations, solve)
+  assert len(solved) == 1
@@ -0,0 +1,42 @@
+import itertools
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from modules.local.solvers.pmedian import solve_pmedian
+
+def instance(seed: int, facilities: int = 7, demand: int = 15) -> tuple:
+  rng = np.random.default_rng(seed)
+  facility_xy, demand_xy = rng.uniform(0, 100, (facilities, 2)), rng.uniform(0, 100, (demand, 2))
+  weights = rng.integers(1, 4, demand).astype(np.float64)
+  return np.linalg.norm(facility_xy[:, None] - demand_xy[None], axis=2), weights
+
+def objective(costs: np.ndarray, weights: np.ndarray, chosen) -> float:
+  return float(np.sum(weights * costs[list(chosen)].min(axis=0)))
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('facility_count', [1, 2, 3])
+def test_pmedian_against_brute_force(seed, facility_count):
+  costs, weights = instance(seed)
+  result = solve_pmedian(csr_matrix(costs), facility_count, weights=weights)
+  chosen = set(result.facilities.tolist())
+  optimum = min(objective(costs, weights, s) for s in itertools.combinations(range(len(costs)), facility_count))
+
+  assert len(chosen) == facility_count
+  assert result.objective == pytest.approx(objective(costs, weights, chosen)) # Each point is allocated to its closest chosen facility
+  assert np.array_equal(result.allocation, np.array(sorted(chosen))[np.argmin(costs[sorted(chosen)], axis=0)])
+  assert result.objective >= optimum - 1e-9
+  if facility_count == 1:
+    assert result.objective == pytest.approx(optimum)
+  for removed, added in itertools.product(chosen, set(range(len(costs))) - chosen): # Vertex substitution ends in a local optimum
+    assert objective(costs, weights, chosen - {removed} | {added}) >= result.objective - 1e-9
+
+def test_pmedian_finds_the_optimum_of_separated_clusters():
+  rng = np.random.default_rng(1)
+  centers = np.array([[0, 0], [1000, 0], [0, 1000]])
+  demand_xy = np.concatenate([center + rng.uniform(-20, 20, (5, 2)) for center in centers])
+  facility_xy = np.concatenate([centers, centers + 300])
+  costs = np.linalg.norm(facility_xy[:, None] - demand_xy[None], axis=2)
+  result = solve_pmedian(csr_matrix(costs), 3)
+  optimum = min(objective(costs, np.ones(len(demand_xy)), s) for s in itertools.combinations(range(len(costs)), 3))
+  assert set(result.facilities.tolist()) == {0, 1, 2}
+  assert result.objective == pytest.approx(optimum)
@@ -0,0 +1,40 @@
+from modules.arcgis.na.pool import AnalysisPool
+
+class Analysis:
+  """Stands in for a nax solver class"""
+
+  def __init__(self, layer):
+    self.layer = layer
+    self._facility_count = 1
+
+  @property
+  def facilityCount(self):
+    return self._facility_count
+
+  @facilityCount.setter
+  def facilityCount(self, value):
+    self._facility_count = value
+
+def create_pool() -> AnalysisPool:
+  pool = AnalysisPool()
+  pool.layers['network'] = 'layer'
+  return pool
+
+def test_stages_get_their_own_analysis():
+  pool = create_pool()
+  split = pool.analysis('network', Analysis, {'travelMode': None}, {}, 'split')
+  split.facilityCount = 7
+  areas = pool.analysis('network', Analysis, {'travelMode': None}, {}, 'areas')
+  assert areas is not split
+  assert split.facilityCount == 7 # Not reset by the other stage
+
+  again = pool.analysis('network', Analysis, {'travelMode': None}, {}, 'split')
+  assert again is split
+  assert again.facilityCount == 1 # Properties set by the previous user are restored
+
+def test_clear_drops_the_analyses():
+  pool = create_pool()
+  analysis = pool.analysis('network', Analysis, {}, {}, 'split')
+  pool.clear()
+  pool.layers['network'] = 'layer'
+  assert pool.analysis('network', Analysis, {}, {}, 'split') is not analysis
@@ -0,0 +1,43 @@
+import itertools
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from modules.local.solvers.tour import solve_tour, cost_along, submatrix
+
+def distances(seed: int, n: int) -> np.ndarray:
+  xy = np.random.default_rng(seed).uniform(0, 1000, (n, 2))
+  return np.linalg.norm(xy[:, None] - xy[None], axis=2)
+
+def brute_force(cost: np.ndarray, closed: bool) -> float:
+  return min(cost_along(cost, np.array(sequence), closed) for sequence in itertools.permutations(range(len(cost))))
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('n', range(2, 9))
+@pytest.mark.parametrize('closed', [False, True])
+def test_tour_against_brute_force(seed, n, closed):
+  cost = distances(seed, n)
+  length = cost / 1000
+  result = solve_tour(cost, length, closed=closed)
+  optimum = brute_force(cost, closed)
+
+  assert sorted(result.sequence.tolist()) == list(range(n))
+  assert result.total_cost == pytest.approx(cost_along(cost, result.sequence, closed))
+  assert result.total_length == pytest.approx(cost_along(length, result.sequence, closed))
+  assert result.total_cost >= optimum - 1e-9
+  assert result.total_cost <= optimum * 1.1
+  if n <= 5: # 2-opt and Or-opt are a heuristic, exact on the smallest instances
+    assert result.total_cost == pytest.approx(optimum)
+
+def test_tour_of_points_on_a_line():
+  x = np.array([0.0, 300.0, 100.0, 400.0, 200.0])
+  result = solve_tour(np.abs(x[:, None] - x[None]))
+  assert result.total_cost == pytest.approx(400)
+  assert x[result.sequence].tolist() in ([0, 100, 200, 300, 400], [400, 300, 200, 100, 0])
+
+def test_submatrix_keeps_zeros_and_estimates_missing_pairs():
+  costs = csr_matrix((np.array([0.0, 2.0, 2.0]), np.array([1, 2, 0]), np.array([0, 2, 3, 3])), shape=(3, 3))
+  xy = np.array([[0.0, 0.0], [0.0, 0.0], [130.0, 0.0]])
+  dense = submatrix(costs, np.array([0, 1, 2]), xy, fallback_speed=1.3)
+  assert dense[0, 1] == 0 # Explicit zero, same location
+  assert dense[0, 2] == 2
+  assert dense[1, 2] == pytest.approx(130) # Missing, straight line distance with detour at the fallback speed
@@ -0,0 +1,15 @@
+import numpy as np
+import shapely
+from benchmarks.generators import matrikkel_points, area_ids
+from modules.local.voronoi import area_polygons
+
+def test_area_polygons_with_incorrectly_noded_cells():
+  # Cells of this case make shapely.coverage_union_all fail with "incorrectly noded inputs"
+  points = matrikkel_points(20000, 'clustered', 1)
+  xy = np.column_stack([points['SHAPE@X'], points['SHAPE@Y']])
+  ids = area_ids(xy, 40, 1)
+
+  area, polygons = area_polygons(xy, ids)
+  assert shapely.is_valid(polygons).all()
+  assert set(area.tolist()) == set(ids.tolist())
+  assert np.isclose(shapely.union_all(polygons).area, sum(shapely.area(polygons)))
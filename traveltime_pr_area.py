@@ -1,14 +1,22 @@
 """
 For a set of areas (e.g. sales districts) calculate the total walk time to visit
-a set of destinations (e.g. boenheter) within each area. 
+a set of destinations (e.g. boenheter) within each area.
 
 The goal is to evaluate if the walktime for each area is balanced (approximately)
-the same. 
+the same.
 """
 
-import arcpy
-from modules.arcgis.dataset import add_fields, count_rows
-from modules.arcgis.na.routing import create_route_analysis, load_and_solve_route, get_routes_cursor
+from concurrent.futures import as_completed
+from modules.backend import arcpy
+import numpy as np
+from modules.arcgis.dataset import add_fields, update_table
+from modules.arcgis.spatial import assign_points_to_areas
+from modules.arcgis.na.routing import create_route_analysis, load_and_solve_route_xy, get_routes_cursor
+from modules.arcgis.na.odmatrix import create_origin_destination_analysis, solve_cost_matrices
+from modules.arcgis.na.network_dataset import read_locations, feature_spatial_reference, project_to_network
+from modules.local.spatial import unique_points
+from modules.local.solvers.tour import solve_tour, submatrix
+from modules.parallel import create_process_pool, chunks
 from modules.log import Log
 
 log = Log()
@@ -19,22 +27,26 @@ result_fields = [
   ['Total_travellength', 'DOUBLE']
 ]
 
-def get_stops(area, areas_fc, destinations_fc):
-  selected_area_layer = arcpy.management.SelectLayerByAttribute(
-    areas_fc, 
-    "NEW_SELECTION", 
-    f"OBJECTID = {area[0]}"
-  )
-    
-  result = arcpy.management.SelectLayerByLocation(
-    destinations_fc, 
-    "INTERSECT", 
-    selected_area_layer, 
-    None, "NEW_SELECTION"
-  )
-  count = count_rows(result[0])
-  log.info(f'OBJECTID: {area[0]} has {count} stops')
-  return [result[0], count]
+def get_tour_options(travel_mode) -> dict:
+  """Options for the OD matrix used when sequencing stops locally instead of solving a route pr area"""
+  return {
+    'travelMode': travel_mode,
+    'defaultImpedanceCutoff': 30,
+    'defaultDestinationCount': 150,
+    'timeUnits': arcpy.nax.TimeUnits.Minutes,
+    'distanceUnits': arcpy.nax.DistanceUnits.Kilometers
+  }
+tour_time_limit = 0.5 # Seconds pr area
+
+_routing = None # Route analysis in each worker process
+
+def get_stops_by_area(points, assignment) -> dict:
+  """Returns the indexes of the unique stop locations within each area by area OBJECTID"""
+
+  xy = np.column_stack([points['SHAPE@X'], points['SHAPE@Y']])
+  stops = {oid: unique_points(xy, indexes) for oid, indexes in assignment.groups()}
+  log.info(f'Fant stopp for {len(stops)} områder i én gjennomgang')
+  return stops
 
 def get_results(result):
   wt = 0
@@ -44,38 +56,137 @@ def get_results(result):
     for route in routes:
       wt += route[0]
       wl += route[1]
- 
+
   log.info(f'Route has a total walktime of {wt} mins ({wl} km)')
   return [wt,wl]
 
-def calculate_traveltime_pr_area(points_fc, areas_fc, travel_mode):
-  add_fields(areas_fc, result_fields)
-
-  # Instantiate a Route analysis object.
-  options = {
+def create_tour_estimator(travel_mode, xy: np.ndarray, locations: np.ndarray = None, cost_cache = None):
+  """Solves one OD matrix between the distinct locations of the points and returns a function
+     that finds the walk time and length of a short sequence through a set of the points (rows
+     in xy), or None if solving the OD matrix failed. Points at the same location share a row
+     of the matrix and are loaded once, with the network location of the first of them.
+
+  Args:
+    travel_mode: Travel mode of the walk times
+    xy (np.ndarray): Coordinates of the points as a (n, 2) array
+    locations (np.ndarray): Optional; Network locations of the points, see read_locations
+    cost_cache: Optional; Cost cache, or its path, see solve_cost_matrices
+  """
+  unique_xy, first, inverse = np.unique(xy, axis=0, return_index=True, return_inverse=True)
+  inverse = inverse.reshape(-1)
+  log.info(f'Løser OD-matrise mellom {len(unique_xy)} unike plasseringer av {len(xy)} punkter')
+  unique_locations = locations[first] if locations is not None else None
+
+  od_matrix = create_origin_destination_analysis(get_tour_options(travel_mode), stage='tour')
+  matrices = solve_cost_matrices(od_matrix, unique_xy, unique_xy, cost_cache,
+                                 origin_locations=unique_locations, destination_locations=unique_locations)
+  if matrices is None:
+    return None
+  minutes, kilometers = matrices
+
+  def estimate(rows):
+    stops = np.unique(inverse[np.asarray(rows, dtype=np.int64)])
+    if len(stops) < 2:
+      return [0, 0]
+
+    tour = solve_tour(submatrix(minutes, stops, unique_xy), submatrix(kilometers, stops, unique_xy, 1000), time_limit=tour_time_limit)
+    log.info(f'Sequence has a total walktime of {tour.total_cost} mins ({tour.total_length} km)')
+    return [tour.total_cost, tour.total_length]
+
+  return estimate
+
+def init_route_worker(travel_mode):
+  """Creates the route analysis once in each worker process"""
+  global _routing
+  _routing = create_route_analysis({
     'travelMode': travel_mode,
     'findBestSequence': True
-  }
-  routing = create_route_analysis(options) # Defaults to using ELVEG
-
-  fields = ["OBJECTID"] + [field[0] for field in result_fields]
- 
-  with arcpy.da.UpdateCursor(areas_fc, fields) as areas_cursor:
-    for area in areas_cursor:  
-      stops = get_stops(area, areas_fc, points_fc)
-    
-      result = load_and_solve_route(routing, stops[0])
-      r = get_results(result)
-      area[1] = stops[1]
-      area[2] = r[0]
-      area[3] = r[1]
-      areas_cursor.updateRow(area)
-
-
-   
-
-
-
-
-
+  }, stage='traveltime')
+
+def solve_areas_chunk(areas):
+  """Solves the route for each area in a chunk of (OBJECTID, stop coordinates, stop network
+     locations or None). Runs in a worker process.
+
+  Returns:
+    list: (OBJECTID, Stops_count, Total_traveltime, Total_travellength) tuples for the solved areas
+  """
+  results = []
+  for oid, stops_xy, locations in areas:
+    try:
+      r = get_results(load_and_solve_route_xy(_routing, stops_xy, locations))
+      results.append((oid, len(stops_xy), r[0], r[1]))
+    except Exception as e:
+      log.error(f'Solving route for OBJECTID {oid} failed: {e}')
+
+  return results
+
+def solve_areas_parallel(areas, travel_mode, workers = None, chunk_size = 50) -> dict:
+  """Splits the areas into chunks and solves the routes in a process pool
+
+  Args:
+    areas (list): (OBJECTID, stop coordinates, stop network locations or None) for each area
+
+  Returns:
+    dict: (Stops_count, Total_traveltime, Total_travellength) by OBJECTID
+  """
+  area_chunks = chunks(areas, chunk_size)
+  log.info(f'Solving routes for {len(areas)} areas in {len(area_chunks)} chunks...')
+
+  results = {}
+  with create_process_pool(workers, init_route_worker, (travel_mode,)) as pool:
+    futures = {pool.submit(solve_areas_chunk, chunk): i for i, chunk in enumerate(area_chunks)}
+    for future in as_completed(futures):
+      try:
+        for r in future.result():
+          results[r[0]] = r[1:]
+      except Exception as e:
+        log.error(f'Chunk {futures[future]} failed: {e}')
+
+  log.info(f'Solved routes for {len(results)} of {len(areas)} areas')
+  return results
+
+def calculate_traveltime_pr_area(points_fc, areas_fc, travel_mode, use_tour_solver = False, workers = 1, chunk_size = 50, assignment = None, cost_cache = None):
+  """Adds the number of unique stops and the walk time and length of a route visiting
+     them to each area. The points are assigned to the areas in one pass, pass in an
+     existing (points, assignment) from assign_points_to_areas to reuse it. A point on the
+     boundary of two areas is counted in one of them, areas without points get zero stops
+     and walk time. The tour solver can look up the walk times in a cost cache (see
+     solve_cost_matrices), default is none."""
 
+  add_fields(areas_fc, result_fields)
+  points, assignment = assignment if assignment is not None else assign_points_to_areas(points_fc, areas_fc)
+  stops = get_stops_by_area(points, assignment)
+  xy = project_to_network(np.column_stack([points['SHAPE@X'], points['SHAPE@Y']]), feature_spatial_reference(points_fc)) # Only used in the solves
+  locations = read_locations(points_fc) # Stored network locations are reused for the stops, see calculate_locations
+  stop_locations = lambda rows: locations[rows] if locations is not None else None
+
+  estimate = None
+  if use_tour_solver:
+    # One OD matrix for all points and a local sequencing pr area
+    estimate = create_tour_estimator(travel_mode, xy, locations, cost_cache)
+    if estimate is None:
+      log.error('Solving the OD matrix for the tour solver failed, solving a route for each area instead')
+
+  if estimate is not None:
+    results = {oid: (len(rows), *estimate(rows)) for oid, rows in stops.items()}
+  elif workers != 1:
+    results = solve_areas_parallel([(oid, xy[rows], stop_locations(rows)) for oid, rows in stops.items()], travel_mode, workers, chunk_size)
+  else:
+    # Instantiate a Route analysis object.
+    options = {
+      'travelMode': travel_mode,
+      'findBestSequence': True
+    }
+    routing = create_route_analysis(options, stage='traveltime') # Defaults to using ELVEG
+    results = {}
+    for oid, rows in stops.items():
+      log.info(f'OBJECTID: {oid} has {len(rows)} stops')
+      results[oid] = (len(rows), *get_results(load_and_solve_route_xy(routing, xy[rows], stop_locations(rows))))
+
+  for oid in assignment.area_ids[assignment.counts == 0].tolist(): # Areas without points have no stops and no walk
+    results.setdefault(oid, (0, 0, 0))
+
+  table = np.empty(len(results), dtype=[('OID@', np.int64), ('Stops_count', np.int64), ('Total_traveltime', np.float64), ('Total_travellength', np.float64)])
+  for i, (oid, values) in enumerate(results.items()):
+    table[i] = (oid, *values)
+  update_table(areas_fc, table)
@@ -1,14 +1,15 @@
 """
-Calculate a travel time index for each point in a feature class. 
+Calculate a travel time index for each point in a feature class.
 
 The travel time index is the mean travel time to the x closest
 neighbors (using the road network) for each point. A high index indicates a point which is
-off the beaten path e.g. far from its neigbors.  
+off the beaten path e.g. far from its neigbors.
 """
-import arcpy
+import numpy as np
 from modules.log import Log
-from modules.arcgis.na.odmatrix import create_origin_destination_analysis, load_and_solve_od_matrix, get_od_lines 
-from modules.arcgis.dataset import featureclass_to_dict, add_fields
+from modules.arcgis.na.odmatrix import create_origin_destination_analysis, load_and_solve_od_matrix, get_od_lines
+from modules.arcgis.dataset import add_fields, count_rows, read_table, update_table
+from modules.local.traveltime import get_travel_lengths, group_mean_by_origin
 log = Log()
 
 # Input parameters
@@ -22,36 +23,23 @@ result_fields = [
   ['WeightCount','LONG']
 ]
 
-min_travel_length = 10 # Used as travel length for overlapping points e.g. apartments in same building.
-
 def calculate_traveltime_weight(points_fc: str, number_of_neighbors) -> None:
   add_fields(points_fc, result_fields)
-  od_matrix = create_origin_destination_analysis(options)
+  od_matrix = create_origin_destination_analysis(options, stage='traveltime_weight')
   od_matrix.defaultDestinationCount = number_of_neighbors
   result = load_and_solve_od_matrix(od_matrix, points_fc, points_fc)
   get_od_lines(result, r'memory\ODLines')
 
-  fields = arcpy.ListFields(r'memory\ODLines')
-  
-  log.info(f'Converting OD matrix to lookup dictionary...')
-  od_matrix_dict = featureclass_to_dict(r'memory\ODLines', ["OID@", "OriginOID","Total_Distance", "SHAPE@LENGTH"])
+  log.info(f'Converting OD matrix to columnar arrays...')
+  od_lines = read_table(r'memory\ODLines', ["OriginOID", "Total_Distance", "SHAPE@LENGTH"])
+  travel_lengths = get_travel_lengths(od_lines["Total_Distance"], od_lines["SHAPE@LENGTH"])
+  origins, weights, counts = group_mean_by_origin(od_lines["OriginOID"], travel_lengths)
 
   log.info(f'Starting to update {points_fc}...')
-  with arcpy.da.UpdateCursor(points_fc, ["OBJECTID", "Weight", "WeightCount"]) as update_cursor:
-    for feature in update_cursor:
-      feature_traveltimes = {k: v for k, v in od_matrix_dict.items() if v[0] == feature[0]} # Get walk times for the current feature
-      travel_weight_count = 0
-      travel_weight = 0
-      
-      for row in feature_traveltimes.items():
-        travel_weight_count += 1
-        travel_length = row[1][1] if row[1][1] > 0 else min_travel_length # If points are stacked and have zero in walking distance
-        travel_length = row[1][2] if travel_length < (row[1][2]/1000) else travel_length # Use shape length if longer than travel length
-        travel_weight += travel_length
-
-      travel_weight = travel_weight / travel_weight_count
-      feature[1] = travel_weight
-      feature[2] = travel_weight_count
-      update_cursor.updateRow(feature)
+  table = np.empty(len(origins), dtype=[('OID@', np.int64), ('Weight', np.float64), ('WeightCount', np.int64)])
+  table['OID@'], table['Weight'], table['WeightCount'] = origins, weights, counts
+  missing = count_rows(points_fc) - update_table(points_fc, table)
+  if missing > 0:
+    log.warning(f'No neighbours found within the cutoff for {missing} points')
 
-  log.info(f'Finished adding travel weights to {points_fc}!')
\ No newline at end of file
+  log.info(f'Finished adding travel weights to {points_fc}!')
@@ -0,0 +1,207 @@
+"""
+Updates the areas (roder) of a municipality from a new matrikkel extract, instead of creating
+them again from scratch with create_areas. The areas volunteers already know are kept:
+
+ 1. The new units are matched to the units of the previous run by id (see modules.local.incremental).
+ 2. Added and moved units join the area they are within, or the area of the nearest kept unit.
+ 3. Changed areas with more than split_areas.MAX_COUNT units are split like split_areas, and
+    changed areas with fewer than merge_areas.MIN_COUNT units are merged with a neighbour like merge_areas.
+ 4. Only the polygons (and statistics) of the changed areas are made again, within the region
+    the changed areas covered. The other areas are copied as they are.
+"""
+
+from modules.backend import arcpy
+import numpy as np
+from modules.log import Log
+from modules.utils import create_uuid
+from modules.arcgis.dataset import export_dataset, export_from_store, update_table, field_exists
+from modules.arcgis.spatial import read_points, read_polygons, write_polygons
+from modules.arcgis.na.network_dataset import feature_spatial_reference
+from modules.arcgis.na.pool import pool
+from modules.local.areas import AreaGroups, plan_merges
+from modules.local.incremental import UnitDiff, assign_units, changed_areas, area_adjacency, split_adjacency, redraw_region
+from modules.local.spatial import assign_points_to_polygons
+from modules.local.voronoi import area_polygons
+from create_areas import matrikkel_units, open_matrikkel_store, aoi_name_field, unit_type, unit_type_field, aoi_buffer_size
+from create_areas_statistics import enrich_areas
+import split_areas as split
+import merge_areas as merge
+
+log = Log(arcgis=True)
+
+unit_id_field = 'lokalid' # Id of a unit (bruksenhet) that is kept between matrikkel extracts
+move_tolerance = 1 # Meters, units moved less than this keep their area
+statistics_fields = ['Join_Count', 'Total_traveltime', 'Total_travellength']
+
+def extract_units(municipality: str, output_fc: str, units: str = None) -> None:
+  """Copies the units of the municipality from the matrikkel store (or matrikkel), or the given units"""
+
+  if units is not None:
+    export_dataset(units, output_fc)
+    return
+
+  store = open_matrikkel_store()
+  if store is not None:
+    export_from_store(store, output_fc, **{aoi_name_field: municipality, unit_type_field: unit_type})
+  else:
+    export_dataset(matrikkel_units, output_fc, f"{aoi_name_field} = '{municipality}' AND {unit_type_field} = '{unit_type}'")
+
+def containing_areas(xy: np.ndarray, polygons: np.ndarray, polygon_area: np.ndarray) -> np.ndarray:
+  """Returns the area id of the polygon each point is within, None for points outside all polygons"""
+
+  point_polygon = assign_points_to_polygons(xy, polygons).point_area
+  return np.where(point_polygon >= 0, polygon_area[np.maximum(point_polygon, 0)], None)
+
+def split_oversized(xy: np.ndarray, area: np.ndarray, candidates: set, spatial_reference = None) -> dict:
+  """Splits the candidate areas with more than split_areas.MAX_COUNT units with a
+     location-allocation pr area (see split_areas.split_area_xy), with the coordinates in the
+     spatial reference given (projected to the network if it differs). Updates the area of the units.
+
+  Returns:
+    dict: The ids of the parts of each split area
+  """
+  ids, counts = np.unique(area, return_counts=True)
+  oversized = [area_id for area_id, count in zip(ids.tolist(), counts.tolist()) if count > split.MAX_COUNT and area_id in candidates]
+  log.info(f'{len(oversized)} endrede roder har mer enn {split.MAX_COUNT} bruksenheter')
+  if not oversized:
+    return {}
+
+  la_analysis = split.create_split_analysis()
+  children = {}
+  for area_id in oversized:
+    rows = np.flatnonzero(area == area_id)
+    log.info(f'Splitter rode {area_id} med {len(rows)} bruksenheter...')
+    uid = create_uuid()
+    parts = [f'{facility_id}_{uid}' if facility_id is not None else area_id for facility_id in split.split_area_xy(la_analysis, xy[rows], spatial_reference=spatial_reference)]
+    area[rows] = parts
+    children[area_id] = sorted(set(parts))
+  return children
+
+def merge_undersized(area: np.ndarray, adjacency: dict, time_pr_unit: dict, candidates: set) -> dict:
+  """Merges the candidate areas with fewer than merge_areas.MIN_COUNT units with a neighbour
+     (see modules.local.areas.plan_merges). The walk time of an area is estimated from the
+     walk time pr unit of the previous area. Updates the area of the units.
+
+  Returns:
+    dict: The area each merged area was merged into
+  """
+  ids, area_index, counts = np.unique(area, return_inverse=True, return_counts=True)
+  index = {area_id: i for i, area_id in enumerate(ids.tolist())}
+  times = counts * np.array([time_pr_unit.get(area_id, 0) for area_id in ids.tolist()])
+  neighbors = [{index[n] for n in adjacency.get(area_id, ()) if n in index} for area_id in ids.tolist()]
+
+  groups = AreaGroups(counts, times, np.zeros(len(ids)), neighbors)
+  merges = plan_merges(groups, merge.MIN_COUNT, merge.MAX_COUNT, merge.MAX_TIME, merge.ABS_MIN_COUNT, ids.tolist(), log,
+                       [index[area_id] for area_id in candidates if area_id in index])
+  roots = groups.roots()
+  area[:] = ids[roots[area_index]]
+  log.info(f'{len(merges)} endrede roder slått sammen med en naborode')
+  return {ids[i]: ids[root] for i, root in enumerate(roots.tolist()) if i != root}
+
+def update_areas(municipality: str, previous_points: str, previous_areas: str, result_polys: str, result_points: str = None,
+                 units: str = None, travel_mode: str = 'Gange') -> bool:
+  """Updates the areas of a municipality from a new extract of its units
+
+  Args:
+    municipality (str): Name of the municipality (kommunenavn)
+    previous_points (str): Units of the previous run with the unit id and AreaID (see AreaJob.result_points)
+    previous_areas (str): Areas of the previous run, with statistics if they are to be updated
+    result_polys (str): Output feature class for the updated areas
+    result_points (str): Optional; Output feature class for the units with the updated AreaID
+    units (str): Optional; The new units, default is the units of the municipality in the matrikkel
+    travel_mode (str): Optional; Travel mode of the statistics
+
+  Returns:
+    bool: False if no areas were changed (the previous areas are copied)
+  """
+  pool.clear() # No analysis is reused from an earlier run in the process
+  new_units = r'memory\OppdaterteBruksenheter'
+  extract_units(municipality, new_units, units)
+
+  old = read_points(previous_points, [unit_id_field, 'AreaID'])
+  new = read_points(new_units, [unit_id_field])
+  old_xy = np.column_stack([old['SHAPE@X'], old['SHAPE@Y']])
+  new_xy = np.column_stack([new['SHAPE@X'], new['SHAPE@Y']])
+
+  fields = [field for field in statistics_fields if field_exists(previous_areas, field)]
+  _, polygons, rows = read_polygons(previous_areas, ['AreaID'] + fields)
+  polygon_area = np.array([str(row[0]) for row in rows], dtype=object)
+
+  # The previous areas are taken from the polygons, they may have been merged after the points were made
+  old_area = containing_areas(old_xy, polygons, polygon_area)
+  outside = old_area == None
+  old_area[outside] = old['AreaID'][outside].astype(str)
+
+  diff = UnitDiff(old[unit_id_field], old_xy, new[unit_id_field], new_xy, move_tolerance)
+  log.info(f'{len(diff.added)} nye, {len(diff.moved)} flyttede og {len(diff.removed)} fjernede bruksenheter av {len(new)}')
+  if diff.changed() == 0:
+    log.info('Ingen endringer, beholder rodene som de er')
+    export_dataset(previous_areas, result_polys)
+    if result_points is not None:
+      export_dataset(previous_points, result_points)
+    return False
+
+  changed_units = np.flatnonzero(~diff.kept)
+  containing = containing_areas(new_xy[changed_units], polygons, polygon_area)
+  area = assign_units(diff, old_area, new_xy, containing)
+  changed = changed_areas(diff, old_area, area)
+
+  # Split and merge only the changed areas that are outside the band
+  children = split_oversized(new_xy, area, changed, feature_spatial_reference(new_units))
+  changed |= {part for parts in children.values() for part in parts}
+  adjacency = split_adjacency(area_adjacency(polygon_area, polygons), children)
+
+  time_pr_unit = {}
+  if 'Join_Count' in fields and 'Total_traveltime' in fields:
+    statistics = np.array([[row[1 + fields.index('Join_Count')] or 0, row[1 + fields.index('Total_traveltime')] or 0] for row in rows], dtype=np.float64).reshape(-1, 2)
+    for area_id in set(polygon_area.tolist()):
+      count, time = statistics[polygon_area == area_id].sum(axis=0)
+      time_pr_unit[area_id] = time / count if count > 0 else 0
+    for parent, parts in children.items():
+      time_pr_unit.update({part: time_pr_unit.get(parent, 0) for part in parts})
+  merged = merge_undersized(area, adjacency, time_pr_unit, changed)
+  changed |= set(merged.values())
+
+  # Areas left without units are redrawn by their neighbours
+  remaining = set(area.tolist())
+  for area_id in set(polygon_area.tolist()) - remaining:
+    changed |= adjacency.get(area_id, set()) & remaining
+
+  # Redraw the changed areas within the region they covered
+  redraw = np.isin(polygon_area, list(changed))
+  units_to_draw = np.flatnonzero(np.isin(area, list(changed)))
+  outside_xy = new_xy[changed_units][containing == None]
+  region = redraw_region(polygons, redraw, outside_xy, aoi_buffer_size)
+  log.info(f'Tegner {len(set(area[units_to_draw].tolist()))} endrede roder på nytt, beholder {len(set(polygon_area[~redraw].tolist()))} roder')
+  ids, new_polygons = area_polygons(new_xy[units_to_draw], area[units_to_draw].astype(str), np.array([region]))
+
+  redrawn = r'memory\OppdaterteRoder'
+  write_polygons(redrawn, ids, new_polygons, 'AreaID', new_units)
+  table = np.empty(len(new), dtype=[('OID@', np.int64), ('AreaID', 'U64')])
+  table['OID@'], table['AreaID'] = new['OID@'], area.astype(str)
+  update_table(new_units, table)
+  if fields:
+    redrawn = enrich_areas(redrawn, new_units, travel_mode)
+
+  export_dataset(previous_areas, result_polys)
+  with arcpy.da.UpdateCursor(result_polys, ['AreaID']) as cursor:
+    for row in cursor:
+      if str(row[0]) in changed:
+        cursor.deleteRow()
+  arcpy.management.Append(redrawn, result_polys, 'NO_TEST')
+
+  if result_points is not None:
+    export_dataset(new_units, result_points)
+  log.info(f'Oppdaterte roder lagret i {result_polys}')
+  return True
+
+###############################################################################
+if __name__ == '__main__':
+  # Script inputs
+  update_areas(
+    arcpy.GetParameterAsText(0), # Municipality (kommunenavn)
+    arcpy.GetParameterAsText(1), # Units of the previous run
+    arcpy.GetParameterAsText(2), # Areas of the previous run
+    arcpy.GetParameterAsText(3), # Updated areas
+    arcpy.GetParameterAsText(4) or None # Updated units
+  )